@@ -1,4 +1,5 @@
 from sequence_encoder import DAPs
-from visual_encoder import C3D
+from stream import DAPsStream
+from visual_encoder import C3D, C3DMemmap
 
 EPSILON = 10e-8
@@ -0,0 +1,254 @@
+import multiprocessing
+
+import numpy as np
+
+from daps.utils.segment import iou_chunks
+
+TIOU_THRESHOLDS = np.linspace(0.5, 1.0, 11)
+
+
+def group_segments(df, sort_by_score=False, video_names=None):
+    """Split a table of segments by video in a single sort pass
+
+    Parameters
+    ----------
+    df : DataFrame
+        Table with columns 'video-name', 'f-init', 'f-end' and 'score' (only
+        required if sort_by_score).
+    sort_by_score : bool, optional
+        Sort segments of each video by decreasing score.
+    video_names : ndarray, optional
+        Sorted names of the videos of interest. By default, all the videos
+        in df.
+
+    Outputs
+    -------
+    video_names : ndarray
+        1d-ndarray with the sorted name of each video.
+    segments : list of ndarray
+        2d-ndarray [num-segments, 2] with f-init, f-end of each video. Empty
+        if the video does not appear in df.
+
+    """
+    names = df['video-name'].values
+    if video_names is None:
+        video_names = np.unique(names)
+    if len(video_names) == 0:
+        return video_names, []
+    codes = np.searchsorted(video_names, names)
+    # Discard videos out of video_names
+    codes[codes == len(video_names)] = 0
+    valid = video_names[codes] == names
+    codes = codes[valid]
+
+    segments = df.loc[valid, ['f-init', 'f-end']].values
+    if sort_by_score:
+        idx = np.lexsort((-df.loc[valid, 'score'].values, codes))
+    else:
+        idx = np.argsort(codes, kind='mergesort')
+    segments, codes = segments[idx, :], codes[idx]
+    edges = np.searchsorted(codes, np.arange(len(video_names) + 1))
+    return video_names, [segments[edges[i]:edges[i + 1], :]
+                         for i in range(len(video_names))]
+
+
+def first_hit(ground_truth, proposals, tiou_thresholds=TIOU_THRESHOLDS,
+              max_memory=None):
+    """Rank of the first proposal matching each ground-truth segment
+
+    Parameters
+    ----------
+    ground_truth : ndarray
+        2d-ndarray [m, 2] with f-init, f-end of ground-truth segments.
+    proposals : ndarray
+        2d-ndarray [n, 2] with f-init, f-end of proposals sorted by
+        decreasing score.
+    tiou_thresholds : ndarray, optional
+        1d-ndarray [k] with tIoU thresholds.
+    max_memory : int, optional
+        Max number of bytes of temporary arrays. Check segment.iou.
+
+    Outputs
+    -------
+    rank : ndarray
+        2d-ndarray [m, k] with the (0-based) rank of the first proposal with
+        tIoU >= threshold. It is -1 if none matches.
+
+    """
+    tiou_thresholds = np.asarray(tiou_thresholds)
+    m, n = ground_truth.shape[0], proposals.shape[0]
+    rank = np.empty((m, len(tiou_thresholds)), dtype=int)
+    rank.fill(-1)
+    if m == 0 or n == 0:
+        return rank
+
+    for rows, tiou in iou_chunks(ground_truth, proposals,
+                                 max_memory=max_memory):
+        # Running max along the ranking makes it monotonic, thus the first
+        # match is a sorted search per threshold
+        best = np.maximum.accumulate(tiou, axis=1)
+        for i, j in enumerate(range(rows.start, rows.stop)):
+            rank[j, :] = np.searchsorted(best[i, :], tiou_thresholds)
+    rank[rank == n] = -1
+    return rank
+
+
+def _first_hit_video(args):
+    """Worker of first_hit_rank"""
+    return first_hit(*args)
+
+
+def first_hit_rank(proposals, ground_truth, tiou_thresholds=TIOU_THRESHOLDS,
+                   num_workers=1, max_memory=None):
+    """Rank of the first proposal matching each ground-truth segment
+
+    Parameters
+    ----------
+    proposals : DataFrame
+        Table with columns 'video-name', 'f-init', 'f-end' and 'score'.
+    ground_truth : DataFrame
+        Table with columns 'video-name', 'f-init' and 'f-end'.
+    tiou_thresholds : ndarray, optional
+        1d-ndarray [k] with tIoU thresholds.
+    num_workers : int, optional
+        Number of processes used to score the videos.
+    max_memory : int, optional
+        Max number of bytes of temporary arrays per video.
+
+    Outputs
+    -------
+    rank : ndarray
+        2d-ndarray [num-ground-truth, k] with the (0-based) rank, inside its
+        video, of the first proposal with tIoU >= threshold. It is -1 if
+        none matches.
+    num_proposals : ndarray
+        1d-ndarray [num-videos] with number of proposals of each video with
+        ground-truth.
+
+    """
+    tiou_thresholds = np.asarray(tiou_thresholds, dtype=float)
+    video_names, gt_segments = group_segments(ground_truth)
+    _, prop_segments = group_segments(proposals, True, video_names)
+    jobs = [(gt, prop, tiou_thresholds, max_memory)
+            for gt, prop in zip(gt_segments, prop_segments)]
+
+    if num_workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            chunksize = max(1, len(jobs) // (4 * num_workers))
+            rank_list = pool.map(_first_hit_video, jobs, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rank_list = [_first_hit_video(i) for i in jobs]
+
+    num_proposals = np.array([len(i) for i in prop_segments], dtype=int)
+    if len(rank_list) == 0:
+        return np.empty((0, len(tiou_thresholds)), dtype=int), num_proposals
+    return np.vstack(rank_list), num_proposals
+
+
+def recall_vs_proposals(proposals, ground_truth, num_proposals=None,
+                        tiou_thresholds=TIOU_THRESHOLDS, num_workers=1,
+                        max_memory=None):
+    """Recall as a function of the number of proposals per video
+
+    Parameters
+    ----------
+    proposals : DataFrame
+        Table with columns 'video-name', 'f-init', 'f-end' and 'score'.
+    ground_truth : DataFrame
+        Table with columns 'video-name', 'f-init' and 'f-end'.
+    num_proposals : ndarray, optional
+        1d-ndarray [p] with the number of top-scored proposals retrieved per
+        video. By default, all values from 1 to the max number of proposals
+        of a video.
+    tiou_thresholds : ndarray, optional
+        1d-ndarray [k] with tIoU thresholds.
+    num_workers : int, optional
+        Number of processes used to score the videos.
+    max_memory : int, optional
+        Max number of bytes of temporary arrays per video.
+
+    Outputs
+    -------
+    avg_num_proposals : ndarray
+        1d-ndarray [p] with the average number of proposals per video.
+    recall : ndarray
+        2d-ndarray [p, k] with recall at each tIoU threshold. Average recall
+        is recall.mean(axis=1).
+
+    """
+    rank, video_num_proposals = first_hit_rank(
+        proposals, ground_truth, tiou_thresholds, num_workers, max_memory)
+    max_proposals = max([1] + video_num_proposals.tolist())
+    if num_proposals is None:
+        num_proposals = np.arange(1, max_proposals + 1)
+    num_proposals = np.asarray(num_proposals, dtype=int)
+
+    # Histogram of ranks per threshold, a cumulative sum gives the number
+    # of matched ground-truth for any number of proposals
+    num_ground_truth, num_thresholds = rank.shape
+    rank[rank < 0] = max_proposals
+    hits = np.zeros((max_proposals + 1, num_thresholds))
+    for i in range(num_thresholds):
+        hits[:, i] = np.bincount(rank[:, i], minlength=max_proposals + 1)
+    hits = np.cumsum(hits[:-1, :], axis=0)
+    idx = np.clip(num_proposals, 1, max_proposals) - 1
+    recall = hits[idx, :] / max(num_ground_truth, 1)
+
+    avg_num_proposals = np.minimum(
+        num_proposals[:, np.newaxis], video_num_proposals).mean(axis=1)
+    return avg_num_proposals, recall
+
+
+def average_recall_vs_proposals(proposals, ground_truth, num_proposals=None,
+                                tiou_thresholds=TIOU_THRESHOLDS,
+                                num_workers=1):
+    """Average recall over tIoU thresholds vs average number of proposals
+
+    Check recall_vs_proposals for details about the arguments.
+
+    Outputs
+    -------
+    avg_num_proposals : ndarray
+        1d-ndarray [p] with the average number of proposals per video.
+    average_recall : ndarray
+        1d-ndarray [p] with average recall.
+
+    """
+    avg_num_proposals, recall = recall_vs_proposals(
+        proposals, ground_truth, num_proposals, tiou_thresholds, num_workers)
+    return avg_num_proposals, recall.mean(axis=1)
+
+
+def recall_vs_tiou(proposals, ground_truth, num_proposals=None,
+                   tiou_thresholds=TIOU_THRESHOLDS, num_workers=1):
+    """Recall at fixed tIoU thresholds
+
+    Parameters
+    ----------
+    proposals : DataFrame
+        Table with columns 'video-name', 'f-init', 'f-end' and 'score'.
+    ground_truth : DataFrame
+        Table with columns 'video-name', 'f-init' and 'f-end'.
+    num_proposals : int, optional
+        Number of top-scored proposals retrieved per video. By default, all
+        of them.
+    tiou_thresholds : ndarray, optional
+        1d-ndarray [k] with tIoU thresholds.
+    num_workers : int, optional
+        Number of processes used to score the videos.
+
+    Outputs
+    -------
+    recall : ndarray
+        1d-ndarray [k] with recall at each tIoU threshold.
+
+    """
+    rank, video_num_proposals = first_hit_rank(
+        proposals, ground_truth, tiou_thresholds, num_workers)
+    if num_proposals is None:
+        num_proposals = max([1] + video_num_proposals.tolist())
+    return ((rank >= 0) & (rank < num_proposals)).mean(axis=0)
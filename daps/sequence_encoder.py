@@ -1,18 +1,93 @@
-import lasagne
+import cPickle as pickle
+import hashlib
+import time
+
 import numpy as np
-import theano
-from lasagne.layers import DenseLayer, InputLayer, LSTMLayer, SliceLayer
-from lasagne.layers import get_all_layers, get_output, set_all_param_values
-from lasagne.utils import floatX
+try:
+    import lasagne
+    import theano
+    from lasagne.layers import DenseLayer, InputLayer, LSTMLayer, SliceLayer
+    from lasagne.layers import get_all_layers, get_output
+    from lasagne.layers import set_all_param_values
+    FLOATX = theano.config.floatX
+except ImportError:
+    # Theano & Lasagne are only required by the theano backend
+    lasagne, theano = None, None
+    FLOATX = 'float32'
+
+from daps.utils import instrument
+from daps.utils.lstm import LSTM_NUM_PARAMS, dense_forward, lstm_forward
+from daps.utils.lstm import lstm_params, rectify, sigmoid
+
+BACKENDS = ('theano', 'numpy')
+HYPER_PARAMETERS = ('num_outputs', 'seq_length', 'depth', 'width',
+                    'input_size')
+
+
+def compiled_key(num_outputs=64, seq_length=32, depth=1, width=256,
+                 input_size=500, backend='theano'):
+    """Identifier of a compiled DAPs model
+
+    Hash of the architecture hyper-parameters, backend and the Theano setup
+    (version and configuration affecting the compiled function).
+
+    Raises
+    ------
+    ValueError
+        theano backend without Theano.
 
-from daps.utils.segment import format as segment_format
+    """
+    setup = [num_outputs, seq_length, depth, width, input_size, backend,
+             FLOATX]
+    if backend == 'theano':
+        if theano is None:
+            raise ValueError('theano backend requires Theano and Lasagne')
+        config = theano.config
+        setup += [theano.__version__, lasagne.__version__, config.device,
+                  config.mode, config.optimizer, config.cxx]
+    return hashlib.sha1(repr(setup)).hexdigest()
+
+
+def model_architecture(filename):
+    """Architecture hyper-parameters of a DAPs model saved as npz-file
+
+    The sequence length is not part of the parameters, thus it is not
+    inferred.
+
+    Parameters
+    ----------
+    filename : str
+        Fullpath of npz-file with weights of the network (check load_model).
+
+    Returns
+    -------
+    architecture : dict
+        num_outputs, depth, width and input_size of the model.
+
+    Raises
+    ------
+    ValueError
+        Parameters do not match the architecture of DAPs.
+
+    """
+    with np.load(filename) as f:
+        shapes = [f['arr_%d' % i].shape for i in range(len(f.files))]
+    depth, remainder = divmod(len(shapes) - 4, LSTM_NUM_PARAMS)
+    if depth < 1 or remainder != 0:
+        raise ValueError('Mismatch between parameters and architecture.')
+    # W_in_to_ingate [input-size, width] of the first LSTM layer and bias of
+    # the confidence layer [num-outputs]
+    input_size, width = shapes[0]
+    return {'num_outputs': shapes[-1][0], 'depth': depth, 'width': width,
+            'input_size': input_size}
 
 
 class DAPs(object):
     """Deep Action Proposal (seq. enconder & proposal generation)
     """
     def __init__(self, num_outputs=64, seq_length=32, depth=1, width=256,
-                 input_size=500, receptive_field=512, anchors=None):
+                 input_size=500, receptive_field=512, anchors=None,
+                 backend='theano', batch_size=None, max_memory=None):
         """Initialize DAPs architecture
 
         Parameters
@@ -33,11 +108,22 @@ class DAPs(object):
             2d-ndarray of size [num_outputs, 2] with anchor segment locations
             normalized with respect to receptive field. The anchor format
             should be [central-frame, duration].
+        backend : str, optional
+            Inference engine. 'theano' compiles the Lasagne network.
+            'numpy' runs the same network with NumPy matrix products, it does
+            not require Theano nor Lasagne and its startup is negligible.
+        batch_size : int, optional
+            Max number of streams per call of the network. By default, all
+            the streams are processed at once. Check autotune_batch_size.
+        max_memory : int, optional
+            Max number of bytes of the temporary arrays of each call of the
+            network. It caps the number of streams per call.
 
         Raises
         ------
         ValueError
-            number of anchors is different than number of outputs
+            - number of anchors is different than number of outputs
+            - unknown backend
 
         """
         self.num_outputs = num_outputs
@@ -48,7 +134,21 @@ class DAPs(object):
         self.model = None
         self.receptive_field = receptive_field
         self.anchors = None
-        self._build()
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend {}'.format(backend))
+        if backend == 'theano' and theano is None:
+            raise ValueError('theano backend requires Theano and Lasagne')
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_memory = max_memory
+        self.network = None
+        self.param_values = None
+        self.timings = {}
+        self._conf_model = None
+        if backend == 'theano':
+            start_time = time.time()
+            self._build()
+            self.timings['build'] = time.time() - start_time
 
         if anchors is not None:
             if anchors.shape[0] != num_outputs:
@@ -56,6 +156,18 @@ class DAPs(object):
                                   'outputs'))
             self.anchors = anchors
 
+    @property
+    def anchors(self):
+        """2d-ndarray [num-outputs, 2] with normalized center, duration"""
+        return self._anchors
+
+    @anchors.setter
+    def anchors(self, value):
+        # Boundaries of the anchors are memoized per receptive field, assign
+        # a new array instead of editing the anchors in-place.
+        self._anchors = value
+        self._anchor_boundaries = {}
+
     def _build(self, forget_bias=5.0, grad_clip=10.0):
         """Build architecture
         """
@@ -88,7 +200,7 @@ class DAPs(object):
                                                  deterministic=True)
 
     def compile(self, **kwargs):
-        """Compile theano function
+        """Compile theano function (or setup numpy backend)
 
         Parameters
         ----------
@@ -99,18 +211,127 @@ class DAPs(object):
         if callable(self.model):
             print 'Model is already compile'
             return None
-        self.model = theano.function([self.input_var],
-                                     [self.loc_var, self.conf_var])
+        start_time = time.time()
+        if self.backend == 'numpy':
+            self.model = self._numpy_forward
+        else:
+            self.model = theano.function([self.input_var],
+                                         [self.loc_var, self.conf_var])
+        self.timings['compile'] = time.time() - start_time
+
+    def compiled_key(self):
+        """Identifier of the compiled model. Check compiled_key for details
+        """
+        kwargs = dict((i, getattr(self, i)) for i in HYPER_PARAMETERS)
+        return compiled_key(backend=self.backend, **kwargs)
+
+    def save_compiled(self, filename):
+        """Serialize compiled model with its weights and hyper-parameters
+
+        Parameters
+        ----------
+        filename : str
+            Fullpath of pickle-file.
+
+        Raises
+        ------
+        ValueError
+            Model has not been compiled or its parameters are not set.
+
+        """
+        if not callable(self.model) or self.param_values is None:
+            raise ValueError('Compile model and set its parameters first')
+        artifact = {'key': self.compiled_key(),
+                    'backend': self.backend,
+                    'hyper_parameters': dict(
+                        (i, getattr(self, i)) for i in HYPER_PARAMETERS),
+                    'param_values': self.param_values,
+                    'receptive_field': self.receptive_field,
+                    'anchors': self.anchors,
+                    'model': None}
+        if self.backend == 'theano':
+            artifact['model'] = self.model
+        with open(filename, 'wb') as f:
+            pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load_compiled(cls, filename, receptive_field=None, anchors=None):
+        """Instantiate a compiled model serialized with save_compiled
 
-    def forward_pass(self, input_data):
+        Parameters
+        ----------
+        filename : str
+            Fullpath of pickle-file.
+        receptive_field : int, optional
+            Override receptive field of serialized model.
+        anchors : ndarray, optional
+            Override anchors of serialized model.
+
+        Returns
+        -------
+        model : DAPs
+            Compiled instance ready to retrieve proposals. Its parameters can
+            not be changed with the theano backend.
+
+        Raises
+        ------
+        ValueError
+            The serialized model was compiled with a different setup.
+
+        """
+        start_time = time.time()
+        with open(filename, 'rb') as f:
+            artifact = pickle.load(f)
+        hyper_parameters = artifact['hyper_parameters']
+        key = compiled_key(backend=artifact['backend'], **hyper_parameters)
+        if key != artifact['key']:
+            raise ValueError('Model was compiled with a different setup')
+
+        model = cls.__new__(cls)
+        for name, value in hyper_parameters.items():
+            setattr(model, name, value)
+        model.backend = artifact['backend']
+        model.batch_size, model.max_memory = None, None
+        model.network = None
+        model.param_values = artifact['param_values']
+        model.receptive_field = artifact['receptive_field']
+        if receptive_field is not None:
+            model.receptive_field = receptive_field
+        model.anchors = artifact['anchors']
+        if anchors is not None:
+            if anchors.shape[0] != model.num_outputs:
+                raise ValueError(('Mismatch between number of anchors and'
+                                  'outputs'))
+            model.anchors = anchors
+        model.model = artifact['model']
+        if model.backend == 'numpy':
+            model.model = model._numpy_forward
+        model.timings = {'load_compiled': time.time() - start_time}
+        model._conf_model = None
+        return model
+
+    def forward_pass(self, input_data, batch_size=None, max_memory=None,
+                     out=None, return_loc=True):
         """Foward-pass over sequence encoder
 
-        Generate segment proposals and their confidence for bunch of clips
+        Generate segment proposals and their confidence for bunch of clips.
+        Streams are processed in micro-batches, thus the memory of the
+        network does not grow with the number of streams.
 
         Parameters
         ----------
         input_data : ndarray
             3d-ndarray of size [n_streams, seq-length, input-dim]
+        batch_size : int, optional
+            Max number of streams per call of the network. By default, the
+            batch_size of the instance.
+        max_memory : int, optional
+            Max number of bytes of the temporary arrays of each call of the
+            network. By default, the max_memory of the instance.
+        out : tuple of ndarray, optional
+            Preallocated loc and conf arrays where the outputs are placed.
+        return_loc : bool, optional
+            If False, the localization head is skipped and loc is None.
 
         Returns
         -------
@@ -126,6 +347,7 @@ class DAPs(object):
             - input_data is not a 3d-ndarray
             - input_data.shape[1] is different than seq-length
             - input_data.shape[2] is different than input-size
+            - out arrays have a wrong shape
 
         """
         if not callable(self.model):
@@ -136,9 +358,81 @@ class DAPs(object):
             raise ValueError('Incorrect input data size along 2nd dimension.')
         if input_data.shape[2] != self.input_size:
             raise ValueError('Incorrect input data size along 3rd dimension.')
+        n_streams = input_data.shape[0]
+        outputs = None
+        if out is not None:
+            outputs = list(out)
+            if ((return_loc and outputs[0].shape !=
+                 (n_streams, 2 * self.num_outputs)) or
+                    outputs[1].shape != (n_streams, self.num_outputs)):
+                raise ValueError('Incorrect shape of out arrays.')
+
+        model = self.model if return_loc else self._conf_forward
+        step = self._micro_batch_size(batch_size, max_memory) or n_streams
+        for start in range(0, max(n_streams, 1), max(step, 1)):
+            stop = min(start + step, n_streams)
+            batch = model(input_data[start:stop])
+            if outputs is None:
+                if stop == n_streams:
+                    # Single call, nothing to gather
+                    return tuple(batch)
+                outputs = [np.empty((n_streams,) + i.shape[1:], dtype=i.dtype)
+                           if i is not None else None for i in batch]
+            for output, value in zip(outputs, batch):
+                if value is not None:
+                    output[start:stop, ...] = value
+        if not return_loc:
+            outputs[0] = None
+        return tuple(outputs)
+
+    def autotune_batch_size(self, candidates=(32, 64, 128, 256, 512, 1024),
+                            repeat=3, seed=0):
+        """Set the batch size with the best throughput on this machine
+
+        Each candidate is timed on random streams. Candidates beyond the
+        max_memory of the instance are skipped.
 
-        loc, conf = self.model(input_data)
-        return loc, conf
+        Parameters
+        ----------
+        candidates : list of int, optional
+            Batch sizes to try.
+        repeat : int, optional
+            Number of timed passes per candidate, the fastest one is kept.
+        seed : int, optional
+            Seed of the random streams.
+
+        Returns
+        -------
+        batch_size : int
+            Batch size with the max number of streams per second. It is set
+            as the batch_size of the instance.
+        throughput : dict
+            Streams per second of each candidate.
+
+        """
+        if self.max_memory:
+            max_size = max(1, self.max_memory // self._window_bytes())
+            candidates = [i for i in candidates if i <= max_size] or [
+                max_size]
+        num_streams = max(candidates)
+        rng = np.random.RandomState(seed)
+        input_data = rng.rand(num_streams, self.seq_length,
+                              self.input_size).astype(FLOATX)
+        out = (np.empty((num_streams, 2 * self.num_outputs), dtype=FLOATX),
+               np.empty((num_streams, self.num_outputs), dtype=FLOATX))
+
+        start_time, throughput = time.time(), {}
+        for batch_size in candidates:
+            elapsed_time = []
+            for _ in range(repeat):
+                batch_time = time.time()
+                self.forward_pass(input_data, batch_size, out=out)
+                elapsed_time.append(time.time() - batch_time)
+            throughput[batch_size] = num_streams / max(min(elapsed_time),
+                                                       1e-8)
+        self.batch_size = max(throughput, key=throughput.get)
+        self.timings['autotune'] = time.time() - start_time
+        return self.batch_size, throughput
 
     def load_model(self, filename):
         """Set parameters of DAPs model
@@ -151,9 +445,37 @@ class DAPs(object):
         """
         with np.load(filename) as f:
             param_values = [f['arr_%d' % i] for i in range(len(f.files))]
-        set_all_param_values(self.network, param_values)
+        self.set_param_values(param_values)
+
+    def set_param_values(self, param_values):
+        """Set parameters of DAPs model
 
-    def retrieve_proposals(self, c3d_stack, f_init_array, override=False):
+        Parameters
+        ----------
+        param_values : list of ndarray
+            Parameters of the network in the order given by
+            lasagne.layers.get_all_param_values.
+
+        Raises
+        ------
+        ValueError
+            - Mismatch between number of parameters and architecture.
+            - Model loaded with load_compiled and theano backend.
+
+        """
+        if len(param_values) != LSTM_NUM_PARAMS * self.depth + 4:
+            raise ValueError('Mismatch between parameters and architecture.')
+        if self.backend == 'theano':
+            if self.network is None:
+                raise ValueError('Parameters of a serialized theano model '
+                                 'can not be changed')
+            set_all_param_values(self.network, param_values)
+        self.param_values = [np.asarray(i, dtype=FLOATX)
+                             for i in param_values]
+
+    def retrieve_proposals(self, c3d_stack, f_init_array, override=False,
+                           receptive_field=None, batch_size=None,
+                           max_memory=None, out=None):
         """Retrieve proposals for multiple streams.
 
         Parameters
@@ -168,6 +490,21 @@ class DAPs(object):
         override : bool, optional.
             If True, override predicted locations with anchors. Make sure of
             initialize your instance properly in order to use the anchors.
+            The localization head is not evaluated and the boundaries of the
+            anchors are computed once per receptive field.
+        receptive_field : int or ndarray, optional.
+            Receptive field of all the streams or 1d-ndarray with the
+            receptive field of each stream. By default, it uses the receptive
+            field of the instance.
+        batch_size : int, optional
+            Max number of streams per call of the network. Check
+            forward_pass.
+        max_memory : int, optional
+            Max number of bytes of the temporary arrays of each call of the
+            network. Check forward_pass.
+        out : ndarray, optional.
+            Preallocated [num-streams, num-outputs, 2] integer array (e.g.
+            int32) where the proposals are placed.
 
         Returns
         -------
@@ -181,7 +518,8 @@ class DAPs(object):
         Raises
         ------
         ValueError
-            Mistmatch between c3d_stack.shape[0] and f_init_array.size
+            - Mistmatch between c3d_stack.shape[0] and f_init_array.size
+            - out has a wrong shape
 
         """
         if c3d_stack.ndim == 2 and c3d_stack.shape[0] == self.seq_length:
@@ -189,22 +527,139 @@ class DAPs(object):
         if c3d_stack.shape[0] != f_init_array.size:
             raise ValueError('Mismatch between c3d_stack and f_init_array')
         n_streams = c3d_stack.shape[0]
+        if receptive_field is None:
+            receptive_field = self.receptive_field
+        receptive_field = np.broadcast_to(np.reshape(receptive_field, -1),
+                                          (n_streams,))
+        if out is None:
+            out = np.empty((n_streams, self.num_outputs, 2), dtype=int)
+        elif out.shape != (n_streams, self.num_outputs, 2):
+            raise ValueError('Incorrect shape of out.')
+        override = override and self.anchors is not None
+
+        with instrument.stage('daps.forward', windows=n_streams) as s:
+            loc, score = self.forward_pass(
+                np.asarray(c3d_stack, dtype=FLOATX), batch_size, max_memory,
+                return_loc=not override)
+            s.update(proposals=score.size, array_bytes=score.nbytes + (
+                loc.nbytes if loc is not None else 0))
+
+        if override:
+            for value in np.unique(receptive_field):
+                out[receptive_field == value] = self.anchor_boundaries(value)
+        else:
+            loc = loc.reshape((n_streams, -1, 2))
+            _relative_boundaries(loc, receptive_field.reshape((-1, 1, 1)))
+            np.copyto(out, loc, casting='unsafe')
+        # Shift to absolute location in the video
+        out += np.reshape(f_init_array, (n_streams, 1, 1))
+        return out, score
+
+    def anchor_boundaries(self, receptive_field=None):
+        """Boundaries of the anchors relative to the start of a stream
+
+        They are computed once per receptive field.
 
-        loc, score = self.forward_pass(floatX(c3d_stack))
+        Parameters
+        ----------
+        receptive_field : int, optional.
+            Receptive field of the stream. By default, the receptive field of
+            the instance.
 
-        if override and self.anchors is not None:
-            loc[:, ...] = self.anchors.reshape(-1)
+        Returns
+        -------
+        boundaries : ndarray
+            2d-ndarray [num-outputs, 2] with f-init, f-end of each anchor.
 
-        # Clip proposals inside receptive field
-        loc.clip(0, 1, out=loc)
-        loc *= self.receptive_field
+        Raises
+        ------
+        ValueError
+            Instance without anchors.
 
-        # Shift center to absolute location in the video
-        loc = loc.reshape((n_streams, -1, 2))
-        loc[:, :, 0] += f_init_array.reshape((n_streams, 1))
+        """
+        if self.anchors is None:
+            raise ValueError('Initialize the instance with anchors.')
+        if receptive_field is None:
+            receptive_field = self.receptive_field
+        key = float(receptive_field)
+        if key not in self._anchor_boundaries:
+            loc = np.array(self.anchors, dtype=FLOATX).reshape((-1, 2))
+            _relative_boundaries(loc, receptive_field)
+            self._anchor_boundaries[key] = loc.astype(int)
+        return self._anchor_boundaries[key]
+
+    def _micro_batch_size(self, batch_size=None, max_memory=None):
+        """Number of streams per call of the network (None means all)"""
+        batch_size = batch_size or self.batch_size
+        max_memory = max_memory or self.max_memory
+        if max_memory:
+            memory_size = max(1, int(max_memory // self._window_bytes()))
+            batch_size = min(batch_size or memory_size, memory_size)
+        return batch_size
+
+    def _window_bytes(self):
+        """Bytes of the temporary arrays of the network per stream
+
+        Input, pre-activation of the gates and hidden & cell states of all
+        the time-steps of a layer.
+        """
+        num_values = self.seq_length * (max(self.input_size, self.width) +
+                                        6 * self.width)
+        return num_values * np.dtype(FLOATX).itemsize
 
-        # Transform center 2 boundaries
-        proposals = np.reshape(
-            segment_format(loc.reshape((-1, 2)), 'c2b'),
-            (n_streams, -1, 2)).astype(int)
-        return proposals, score
+    def _conf_forward(self, input_data):
+        """Foward-pass computing the confidence only (loc is None)
+        """
+        if self.backend == 'numpy':
+            return self._numpy_forward(input_data, return_loc=False)
+        if self.network is None:
+            # Serialized theano model, only the whole network is compiled
+            return None, self.model(input_data)[1]
+        if self._conf_model is None:
+            self._conf_model = theano.function([self.input_var],
+                                               self.conf_var)
+        return None, self._conf_model(input_data)
+
+    def _numpy_forward(self, input_data, return_loc=True):
+        """Foward-pass over sequence encoder with numpy backend
+        """
+        if self.param_values is None:
+            raise ValueError('Load model before feeding data up')
+        hid = input_data
+        for i in range(self.depth):
+            params = lstm_params(self.param_values[
+                i * LSTM_NUM_PARAMS:(i + 1) * LSTM_NUM_PARAMS])
+            hid = lstm_forward(hid, params,
+                               only_return_final=i == self.depth - 1)
+
+        W_loc, b_loc, W_conf, b_conf = self.param_values[-4:]
+        loc = None
+        if return_loc:
+            loc = dense_forward(hid, W_loc, b_loc, rectify)
+        conf = dense_forward(hid, W_conf, b_conf, sigmoid)
+        return loc, conf
+
+
+def _relative_boundaries(loc, receptive_field):
+    """Transform in-place normalized [center, duration] into [f-init, f-end]
+
+    Boundaries are relative to the start of the stream, same as
+    segment.format(..., 'c2b') after scaling by the receptive field.
+
+    Parameters
+    ----------
+    loc : ndarray
+        [..., 2] float ndarray with normalized center and duration.
+    receptive_field : int or ndarray
+        Receptive field broadcastable against loc.
+
+    """
+    loc.clip(0, 1, out=loc)
+    loc *= np.asarray(receptive_field, dtype=loc.dtype)
+    f_init, duration = loc[..., 0], loc[..., 1]
+    f_init -= 0.5 * duration
+    np.ceil(f_init, out=f_init)
+    # f-end = f-init + duration - 1
+    duration += f_init
+    duration -= 1.0
+    return loc
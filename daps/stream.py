@@ -0,0 +1,119 @@
+import numpy as np
+
+from daps.utils.pooling import pool_windows
+
+
+class DAPsStream(object):
+    """Online proposal generation over a live stream of C3D features
+
+    Keep a ring buffer with the latest C3D features of the stream and
+    retrieve the proposals of each sliding window as soon as all its features
+    have been pushed. Memory is constant and the work done by each push only
+    depends on the number of rows pushed.
+
+    """
+    def __init__(self, model, f_res=16, f_stride=8,
+                 pool_type='concat-32-mean', stride=64, override=False):
+        """Setup stream
+
+        Parameters
+        ----------
+        model : DAPs
+            Compiled instance of DAPs. Its receptive field defines the
+            duration of the sliding windows.
+        f_res : int, optional.
+            Temporal receptive field of C3D encoder. Check C3D for details.
+        f_stride : int, optional.
+            Temporal stride between features used by the pooling. Check C3D
+            for details.
+        pool_type : str, optional.
+            Temporal pooling strategy over the features of a window. Check
+            C3D for details.
+        stride : int, optional.
+            Sliding stride (in frames) of the windows along the stream.
+        override : bool, optional.
+            If True, override predicted locations with anchors.
+
+        """
+        self.model = model
+        self.f_res = f_res
+        self.f_stride = f_stride
+        self.pool_type = pool_type
+        self.stride = stride
+        self.override = override
+        self.duration = model.receptive_field
+        # Number of features (one per frame) spanned by each window
+        self.span = self.duration - f_res + 1
+        self.buffer = None
+        self.reset()
+
+    def reset(self):
+        """Forget all the features pushed so far
+        """
+        self.num_rows = 0
+        self.next_f_init = 0
+
+    def push(self, feature_rows):
+        """Push features into the stream
+
+        Parameters
+        ----------
+        feature_rows : ndarray
+            2d-ndarray [n, feat-dim] with the C3D features of the next n
+            frames of the stream.
+
+        Returns
+        -------
+        proposals : ndarray
+            3d-ndarray [num-windows, num-outputs, 2] with the proposals of the
+            windows completed by this push in terms of f-init, f-end.
+        conf : ndarray
+            2d-ndarray [num-windows, num-outputs] action likelihood of each
+            proposal.
+
+        Raises
+        ------
+        ValueError
+            feature_rows is not a 2d-ndarray
+
+        """
+        if feature_rows.ndim != 2:
+            raise ValueError('feature_rows must be a 2-dim array.')
+        if self.buffer is None:
+            # Each row is written twice, thus any window is a contiguous
+            # slice of the buffer
+            self.buffer = np.zeros((2 * self.span, feature_rows.shape[1]),
+                                   dtype=feature_rows.dtype)
+
+        f_init_list, feat_list = [], []
+        row_init, row_end = self.num_rows, self.num_rows + len(feature_rows)
+        while self.next_f_init + self.span <= row_end:
+            f_init = self.next_f_init
+            self._write(feature_rows, row_init, f_init + self.span)
+            pos = f_init % self.span
+            windows = np.array([[pos, pos + self.span]])
+            feat_list.append(pool_windows(self.buffer, windows,
+                                          self.pool_type, self.f_stride))
+            f_init_list.append(f_init)
+            self.next_f_init += self.stride
+        self._write(feature_rows, row_init, row_end)
+
+        if len(f_init_list) == 0:
+            num_outputs = self.model.num_outputs
+            return np.empty((0, num_outputs, 2), dtype=int), np.empty(
+                (0, num_outputs))
+        return self.model.retrieve_proposals(
+            np.concatenate(feat_list), np.array(f_init_list), self.override)
+
+    def _write(self, feature_rows, row_init, row_end):
+        """Copy rows of the stream, up to row_end, into the ring buffer
+        """
+        if row_end <= self.num_rows:
+            return
+        # Rows older than the buffer are never read again
+        first_row = max(self.num_rows, row_end - self.span)
+        rows = np.arange(first_row, row_end)
+        values = feature_rows[rows - row_init, :]
+        self.buffer[rows % self.span, :] = values
+        self.buffer[rows % self.span + self.span, :] = values
+        self.num_rows = row_end
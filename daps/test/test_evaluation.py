@@ -0,0 +1,62 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import daps.evaluation as evaluation
+
+
+class test_evaluation(unittest.TestCase):
+    def setUp(self):
+        self.ground_truth = pd.DataFrame(
+            {'video-name': ['a', 'a', 'b', 'c'],
+             'f-init': [10, 50, 0, 5],
+             'f-end': [20, 90, 30, 15]})
+        self.proposals = pd.DataFrame(
+            {'video-name': ['b', 'a', 'a', 'a', 'd'],
+             'f-init': [0, 50, 10, 0, 5],
+             'f-end': [29, 90, 20, 100, 15],
+             'score': [0.5, 0.2, 0.9, 0.7, 1.0]})
+
+    def test_group_segments(self):
+        names, segments = evaluation.group_segments(self.proposals, True)
+        np.testing.assert_array_equal(names, ['a', 'b', 'd'])
+        np.testing.assert_array_equal(segments[0],
+                                      [[10, 20], [0, 100], [50, 90]])
+        names, segments = evaluation.group_segments(
+            self.proposals, video_names=np.array(['a', 'c']))
+        self.assertEqual(3, len(segments[0]))
+        self.assertEqual(0, len(segments[1]))
+
+    def test_first_hit(self):
+        gt = np.array([[10, 20], [50, 90], [200, 300]])
+        proposals = np.array([[0, 100], [10, 20], [50, 90]])
+        rank = evaluation.first_hit(gt, proposals, [0.4, 1.0])
+        np.testing.assert_array_equal(rank, [[1, 1], [0, 2], [-1, -1]])
+        rank = evaluation.first_hit(gt, proposals[:0], [0.4, 1.0])
+        np.testing.assert_array_equal(rank, -np.ones((3, 2)))
+
+    def test_recall_vs_proposals(self):
+        avg_num_proposals, recall = evaluation.recall_vs_proposals(
+            self.proposals, self.ground_truth, tiou_thresholds=[0.5, 1.0])
+        np.testing.assert_array_almost_equal(avg_num_proposals,
+                                             [2.0 / 3, 1, 4.0 / 3])
+        np.testing.assert_array_almost_equal(
+            recall, [[0.5, 0.25], [0.5, 0.25], [0.75, 0.5]])
+        # Multiple processes
+        _, recall_pool = evaluation.recall_vs_proposals(
+            self.proposals, self.ground_truth, tiou_thresholds=[0.5, 1.0],
+            num_workers=2)
+        np.testing.assert_array_equal(recall, recall_pool)
+        _, ar = evaluation.average_recall_vs_proposals(
+            self.proposals, self.ground_truth, [3],
+            tiou_thresholds=[0.5, 1.0])
+        np.testing.assert_array_almost_equal(ar, [0.625])
+
+    def test_recall_vs_tiou(self):
+        recall = evaluation.recall_vs_tiou(
+            self.proposals, self.ground_truth, tiou_thresholds=[0.5, 1.0])
+        np.testing.assert_array_almost_equal(recall, [0.75, 0.5])
+        recall = evaluation.recall_vs_tiou(
+            self.proposals, self.ground_truth, 1, [0.5, 1.0])
+        np.testing.assert_array_almost_equal(recall, [0.5, 0.25])
@@ -0,0 +1,143 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from daps.sequence_encoder import compiled_key, DAPs, FLOATX
+from daps.sequence_encoder import model_architecture
+from daps.utils.lstm import random_param_values
+from daps.utils.segment import format as segment_format
+
+
+def test_model_architecture():
+    tmp_dir = tempfile.mkdtemp()
+    filename = os.path.join(tmp_dir, 'daps.npz')
+    for num_outputs, depth, width, input_size in [(4, 2, 6, 5),
+                                                  (16, 1, 8, 12)]:
+        np.savez(filename, *random_param_values(num_outputs, depth, width,
+                                                input_size))
+        assert model_architecture(filename) == {
+            'num_outputs': num_outputs, 'depth': depth, 'width': width,
+            'input_size': input_size}
+    # Parameters of another architecture
+    np.savez(filename, *random_param_values(4, 1, 6, 5)[:-1])
+    np.testing.assert_raises(ValueError, model_architecture, filename)
+    shutil.rmtree(tmp_dir)
+
+
+class test_daps(unittest.TestCase):
+    def setUp(self):
+        self.model = DAPs(4, 8, 2, 6, 5, 128, backend='numpy')
+        self.model.set_param_values(random_param_values(4, 2, 6, 5))
+        self.model.compile()
+        rng = np.random.RandomState(1)
+        self.input_data = rng.rand(23, 8, 5).astype(FLOATX)
+
+    def test_forward_pass_micro_batch(self):
+        loc, conf = self.model.forward_pass(self.input_data)
+        for batch_size in [1, 5, 23, 64]:
+            loc_batch, conf_batch = self.model.forward_pass(
+                self.input_data, batch_size)
+            np.testing.assert_allclose(loc, loc_batch, rtol=1e-5)
+            np.testing.assert_allclose(conf, conf_batch, rtol=1e-5)
+
+        # Memory budget of 3 streams per call
+        max_memory = 3 * self.model._window_bytes()
+        self.assertEqual(3, self.model._micro_batch_size(None, max_memory))
+        self.assertEqual(2, self.model._micro_batch_size(2, max_memory))
+        out = (np.empty_like(loc), np.empty_like(conf))
+        loc_batch, conf_batch = self.model.forward_pass(
+            self.input_data, max_memory=max_memory, out=out)
+        self.assertIs(out[0], loc_batch)
+        self.assertIs(out[1], conf_batch)
+        np.testing.assert_allclose(loc, loc_batch, rtol=1e-5)
+        np.testing.assert_allclose(conf, conf_batch, rtol=1e-5)
+        self.assertRaises(ValueError, self.model.forward_pass,
+                          self.input_data, out=(loc[:2], conf[:2]))
+
+    def test_save_compiled(self):
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, 'daps.pkl')
+        self.model.save_compiled(filename)
+        model = DAPs.load_compiled(filename)
+        for output, output_loaded in zip(
+                self.model.forward_pass(self.input_data),
+                model.forward_pass(self.input_data)):
+            np.testing.assert_array_equal(output, output_loaded)
+        self.assertEqual(128, model.receptive_field)
+        self.assertEqual(compiled_key(4, 8, 2, 6, 5, 'numpy'),
+                         model.compiled_key())
+
+        anchors = np.c_[np.zeros(4), np.ones(4)]
+        model = DAPs.load_compiled(filename, receptive_field=256,
+                                   anchors=anchors)
+        self.assertEqual(256, model.receptive_field)
+        np.testing.assert_array_equal(anchors, model.anchors)
+        self.assertRaises(ValueError, DAPs.load_compiled, filename,
+                          anchors=anchors[:2])
+
+        # Artifact compiled with another setup
+        with open(filename, 'rb') as f:
+            artifact = pickle.load(f)
+        artifact['key'] = compiled_key(4, 8, 2, 6, 6, 'numpy')
+        with open(filename, 'wb') as f:
+            pickle.dump(artifact, f)
+        self.assertRaises(ValueError, DAPs.load_compiled, filename)
+        shutil.rmtree(tmp_dir)
+
+    def test_autotune_batch_size(self):
+        batch_size, throughput = self.model.autotune_batch_size(
+            [4, 16], repeat=1)
+        self.assertIn(batch_size, [4, 16])
+        self.assertEqual(batch_size, self.model.batch_size)
+        self.assertEqual([4, 16], sorted(throughput))
+        self.model.max_memory = 8 * self.model._window_bytes()
+        batch_size, throughput = self.model.autotune_batch_size(
+            [4, 16], repeat=1)
+        self.assertEqual(4, batch_size)
+
+    def test_retrieve_proposals(self):
+        rng = np.random.RandomState(2)
+        self.model.anchors = np.c_[rng.rand(4), rng.rand(4)]
+        f_init = np.arange(23) * 64
+        receptive_field = np.where(np.arange(23) % 3, 128, 100)
+        loc, score = self.model.forward_pass(self.input_data)
+        for override in [False, True]:
+            if override:
+                loc[...] = self.model.anchors.reshape(-1)
+            # Previous implementation: shift the center to absolute frames
+            # before transforming it into boundaries, all in FLOATX.
+            loc_ref = loc.clip(0, 1)
+            loc_ref *= receptive_field[:, np.newaxis]
+            self.assertEqual(FLOATX, loc_ref.dtype)
+            boundaries = []
+            for dtype in [FLOATX, np.float64]:
+                loc_abs = loc_ref.astype(dtype).reshape((23, -1, 2))
+                loc_abs[..., 0] += f_init[:, np.newaxis]
+                boundaries.append(segment_format(
+                    loc_abs.reshape((-1, 2)), 'c2b').reshape((23, -1, 2)))
+            proposals_ref = boundaries[0].astype(int)
+            # Rounding of the offset in FLOATX is the only source of mismatch
+            offset_rounding = boundaries[0] != boundaries[1]
+
+            out = np.empty((23, 4, 2), dtype=np.int32)
+            proposals, score_override = self.model.retrieve_proposals(
+                self.input_data, f_init, override, receptive_field, out=out)
+            self.assertIs(out, proposals)
+            np.testing.assert_allclose(score, score_override, rtol=1e-6)
+            np.testing.assert_array_equal(
+                proposals[~offset_rounding], proposals_ref[~offset_rounding])
+            np.testing.assert_array_equal(
+                proposals[offset_rounding],
+                boundaries[1][offset_rounding].astype(int))
+        np.testing.assert_array_equal(
+            proposals[1] - f_init[1], self.model.anchor_boundaries(128))
+        # New anchors invalidate the boundaries computed with the old ones
+        self.model.anchors = self.model.anchors[::-1].copy()
+        np.testing.assert_array_equal(
+            proposals[1, ::-1] - f_init[1], self.model.anchor_boundaries(128))
+        self.assertRaises(ValueError, self.model.retrieve_proposals,
+                          self.input_data, f_init, out=out[:2])
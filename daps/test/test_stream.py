@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from daps.sequence_encoder import DAPs
+from daps.stream import DAPsStream
+from daps.utils.lstm import random_param_values
+from daps.visual_encoder import C3D
+
+
+class test_daps_stream(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.c3d_hdf5 = os.path.join(self.tmp_dir, 'c3d.hdf5')
+        rng = np.random.RandomState(0)
+        self.feat = rng.randn(700, 5)
+        with h5py.File(self.c3d_hdf5, 'w') as f:
+            f.create_group('video_0').create_dataset('c3d_features',
+                                                     data=self.feat)
+        self.model = DAPs(4, 8, 1, 6, 5, 128, backend='numpy')
+        self.model.set_param_values(random_param_values(4, 1, 6, 5))
+        self.model.compile()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_push(self):
+        stream = DAPsStream(self.model, pool_type='concat-8-mean', stride=64)
+        # Uneven chunks wrap around the ring buffer (113 rows), the last one
+        # completes several windows at once
+        edges = [0, 50, 51, 163, 310, 311, 700]
+        proposals, score, num_windows = [], [], []
+        for row_init, row_end in zip(edges[:-1], edges[1:]):
+            chunk_proposals, chunk_score = stream.push(
+                self.feat[row_init:row_end])
+            proposals.append(chunk_proposals)
+            score.append(chunk_score)
+            num_windows.append(len(chunk_score))
+        self.assertEqual([0, 0, 1, 3, 0, 6], num_windows)
+
+        c3d = C3D(self.c3d_hdf5, pool_type='concat-8-mean')
+        c3d.open_instance()
+        f_init = np.arange(0, 700 - stream.span + 1, 64)
+        feat_stack = c3d.read_feat_batch_from_video('video_0', f_init,
+                                                    duration=128)
+        c3d.close_instance()
+        proposals_ref, score_ref = self.model.retrieve_proposals(
+            feat_stack, f_init)
+        np.testing.assert_array_equal(proposals_ref,
+                                      np.concatenate(proposals))
+        np.testing.assert_array_equal(score_ref, np.concatenate(score))
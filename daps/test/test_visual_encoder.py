@@ -0,0 +1,225 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from daps.utils.cache import LRUCache
+from daps.visual_encoder import C3D, C3DMemmap, pack_features
+
+
+class test_c3d(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.c3d_hdf5 = os.path.join(self.tmp_dir, 'c3d.hdf5')
+        self.filename = os.path.join(self.tmp_dir, 'c3d.npy')
+        rng = np.random.RandomState(0)
+        with h5py.File(self.c3d_hdf5, 'w') as f:
+            for i, n in enumerate([700, 1500, 400]):
+                f.create_group('video_{}'.format(i)).create_dataset(
+                    'c3d_features', data=rng.randn(n, 8).astype(np.float32))
+        pack_features(self.c3d_hdf5, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_feat_batch_from_video(self):
+        for pool_type in ['concat-32-mean', 'concat-8-max', None]:
+            c3d = C3D(self.c3d_hdf5, pool_type=pool_type)
+            c3d_memmap = C3DMemmap(self.filename, pool_type=pool_type)
+            c3d.open_instance()
+            c3d_memmap.open_instance()
+            self.assertEqual(sorted(c3d.video_names()),
+                             sorted(c3d_memmap.video_names()))
+            for video_name in c3d.video_names():
+                num_features = c3d.num_features(video_name)
+                self.assertEqual(num_features,
+                                 c3d_memmap.num_features(video_name))
+                f_init = np.arange(0, num_features - 512, 64)
+                np.testing.assert_array_equal(
+                    c3d.read_feat_batch_from_video(video_name, f_init),
+                    c3d_memmap.read_feat_batch_from_video(video_name, f_init))
+            c3d.close_instance()
+            c3d_memmap.close_instance()
+
+    def test_pack_features_dtype(self):
+        c3d_hdf5 = os.path.join(self.tmp_dir, 'c3d_float64.hdf5')
+        filename = os.path.join(self.tmp_dir, 'c3d_float64.npy')
+        with h5py.File(c3d_hdf5, 'w') as f:
+            f.create_group('video_0').create_dataset(
+                'c3d_features', data=np.random.RandomState(0).randn(700, 8))
+        # Precision of the source is kept by default
+        pack_features(c3d_hdf5, filename)
+        c3d = C3D(c3d_hdf5)
+        c3d_memmap = C3DMemmap(filename)
+        c3d.open_instance()
+        c3d_memmap.open_instance()
+        self.assertEqual(np.float64, c3d_memmap.fobj['video_0'][
+            'c3d_features'].dtype)
+        f_init = np.arange(0, 128, 64)
+        np.testing.assert_array_equal(
+            c3d.read_feat_batch_from_video('video_0', f_init),
+            c3d_memmap.read_feat_batch_from_video('video_0', f_init))
+        c3d.close_instance()
+        c3d_memmap.close_instance()
+
+    def test_invalid_file(self):
+        self.assertRaises(ValueError, C3DMemmap, self.c3d_hdf5)
+
+    def test_cache(self):
+        c3d = C3D(self.c3d_hdf5)
+        c3d_cache = C3D(self.c3d_hdf5, cache=LRUCache())
+        c3d.open_instance()
+        c3d_cache.open_instance()
+        feat = c3d.read_feat_batch_from_video('video_1', [0, 64, 128])
+        for i in range(2):
+            # Second time comes from the cache
+            rows_read = c3d_cache.rows_read
+            feat_cache = c3d_cache.read_feat_batch_from_video(
+                'video_1', [0, 64, 128])
+            np.testing.assert_array_equal(feat, feat_cache)
+        self.assertEqual(rows_read, c3d_cache.rows_read)
+        self.assertEqual(1, c3d_cache.cache.hits)
+        # Another batch, receptive field or resolution is another entry
+        c3d_cache.read_feat_batch_from_video('video_1', [0, 64])
+        c3d_cache.read_feat_batch_from_video('video_1', [0, 64, 128], 768)
+        c3d_cache.f_res = 8
+        c3d_cache.read_feat_batch_from_video('video_1', [0, 64, 128])
+        self.assertEqual(1, c3d_cache.cache.hits)
+        self.assertEqual(4, c3d_cache.cache.misses)
+        c3d.close_instance()
+        c3d_cache.close_instance()
+
+        # Entries of a file that was rewritten are not used
+        with h5py.File(self.c3d_hdf5, 'a') as f:
+            f['video_1']['c3d_features'][0] += 1
+        mtime = os.stat(self.c3d_hdf5).st_mtime + 10
+        os.utime(self.c3d_hdf5, (mtime, mtime))
+        c3d_cache.open_instance()
+        c3d_cache.f_res = 16
+        c3d_cache.read_feat_batch_from_video('video_1', [0, 64, 128])
+        self.assertEqual(1, c3d_cache.cache.hits)
+        c3d_cache.close_instance()
+
+    def test_pool_index(self):
+        index_file = os.path.join(self.tmp_dir, 'index.hdf5')
+        c3d = C3D(self.c3d_hdf5, pool_type='concat-8-max')
+        c3d_index = C3D(self.c3d_hdf5, pool_type='concat-8-max',
+                        pool_index=True, index_file=index_file)
+        c3d.open_instance()
+        c3d_index.open_instance()
+        f_init = np.arange(0, 128, 64)
+        for video_name in ['video_0', 'video_1', 'video_0']:
+            for pool_type in ['concat-8-max', 'concat-16-mean']:
+                # Each pooling has its own index
+                c3d.pool_type = c3d_index.pool_type = pool_type
+                np.testing.assert_allclose(
+                    c3d.read_feat_batch_from_video(video_name, f_init),
+                    c3d_index.read_feat_batch_from_video(video_name, f_init),
+                    rtol=1e-5, atol=1e-6)
+                self.assertEqual(1, len(c3d_index._index))
+        c3d.close_instance()
+        c3d_index.close_instance()
+        # Evicted and remaining indices are saved
+        with h5py.File(index_file, 'r') as f:
+            self.assertEqual(['video_0', 'video_1'], sorted(f.keys()))
+            self.assertEqual(2, len(f['video_1']))
+
+    def test_dtype(self):
+        filename = os.path.join(self.tmp_dir, 'c3d_float16.npy')
+        pack_features(self.c3d_hdf5, filename, dtype=np.float16)
+        c3d = C3D(self.c3d_hdf5)
+        c3d_memmap = C3DMemmap(filename, dtype=np.float32,
+                               cache=LRUCache())
+        c3d.open_instance()
+        c3d_memmap.open_instance()
+        f_init = np.arange(0, 512, 64)
+        feat = c3d.read_feat_batch_from_video('video_1', f_init)
+        out = np.empty(feat.shape, dtype=np.float32)
+        for i in range(2):
+            # Second time comes from the cache
+            feat_memmap = c3d_memmap.read_feat_batch_from_video(
+                'video_1', f_init, out=out)
+            self.assertIs(out, feat_memmap)
+            np.testing.assert_allclose(feat, feat_memmap, atol=1e-3)
+        c3d.close_instance()
+        c3d_memmap.close_instance()
+
+    def test_read_feat_batches_from_video(self):
+        c3d = C3D(self.c3d_hdf5)
+        c3d.open_instance()
+        batches = [(np.arange(0, 512, 64), 512, 'concat-32-mean'),
+                   (np.arange(0, 768, 64), 256, 'concat-16-max')]
+        feat_stacks = c3d.read_feat_batches_from_video('video_1', batches)
+        rows_read = c3d.rows_read
+        for (f_init, duration, pool_type), feat in zip(batches, feat_stacks):
+            c3d.pool_type = pool_type
+            np.testing.assert_array_equal(
+                feat, c3d.read_feat_batch_from_video('video_1', f_init,
+                                                     duration))
+        # Features shared by the batches are read once
+        self.assertLess(rows_read, c3d.rows_read - rows_read)
+        c3d.close_instance()
+
+    def test_pca(self):
+        rng = np.random.RandomState(1)
+        raw_hdf5 = os.path.join(self.tmp_dir, 'fc7.hdf5')
+        reduced_hdf5 = os.path.join(self.tmp_dir, 'fc7_pca.hdf5')
+        pca_file = os.path.join(self.tmp_dir, 'pca.hdf5')
+        U = np.linalg.qr(rng.randn(32, 32))[0]
+        x_mean = rng.rand(32)
+        with h5py.File(pca_file, 'w') as f:
+            f.create_dataset('U', data=U)
+            f.create_dataset('x_mean', data=x_mean)
+            f.create_dataset('S', data=np.ones(32))
+        feat = rng.rand(700, 32)
+        with h5py.File(raw_hdf5, 'w') as f:
+            f.create_group('video_0').create_dataset('c3d_features',
+                                                     data=feat)
+        with h5py.File(reduced_hdf5, 'w') as f:
+            f.create_group('video_0').create_dataset(
+                'c3d_features', data=np.dot(feat - x_mean, U[:, :8]))
+
+        f_init = np.arange(0, 128, 64)
+        for pool_type in ['concat-32-mean', 'concat-8-max', 'mean', None]:
+            for pool_index in [False, True]:
+                if pool_index and not pool_type:
+                    continue
+                c3d = C3D(raw_hdf5, pool_type=pool_type, pca_file=pca_file,
+                          pca_dim=8, pool_index=pool_index)
+                c3d_reduced = C3D(reduced_hdf5, pool_type=pool_type,
+                                  pool_index=pool_index)
+                c3d.open_instance()
+                c3d_reduced.open_instance()
+                np.testing.assert_allclose(
+                    c3d.read_feat_batch_from_video('video_0', f_init),
+                    c3d_reduced.read_feat_batch_from_video('video_0',
+                                                           f_init),
+                    rtol=1e-7, atol=1e-10)
+                c3d.close_instance()
+                c3d_reduced.close_instance()
+
+        # Caches and saved indices of other projections are not reused
+        other_pca_file = os.path.join(self.tmp_dir, 'other_pca.hdf5')
+        with h5py.File(other_pca_file, 'w') as f:
+            f.create_dataset('U', data=U[:, ::-1])
+            f.create_dataset('x_mean', data=x_mean)
+        index_file = os.path.join(self.tmp_dir, 'index.hdf5')
+        cache = LRUCache()
+        feat_list = []
+        for filename, pca_dim in [(pca_file, 8), (pca_file, 4),
+                                  (other_pca_file, 8)]:
+            c3d = C3D(raw_hdf5, pool_type='concat-8-max', pca_file=filename,
+                      pca_dim=pca_dim, cache=cache, pool_index=True,
+                      index_file=index_file)
+            c3d.open_instance()
+            feat_list.append(c3d.read_feat_batch_from_video('video_0',
+                                                            f_init))
+            c3d.close_instance()
+        self.assertEqual(3, cache.misses)
+        self.assertEqual((2, 8, 4), feat_list[1].shape)
+        self.assertFalse(np.allclose(feat_list[0], feat_list[2]))
+        with h5py.File(index_file, 'r') as f:
+            self.assertEqual(3, len(f['video_0']))
@@ -0,0 +1,359 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LRUCache(object):
+    """Size-bounded least-recently-used cache of ndarrays
+
+    Entries evicted from memory are optionally spilled to disk (one npy-file
+    per entry), thus they are still available for later runs.
+
+    """
+    def __init__(self, max_bytes=2**30, spill_dir=None):
+        """Setup cache
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Max number of bytes of the arrays kept in memory.
+        spill_dir : str, optional
+            Folder to save the entries evicted from memory. It is created if
+            it does not exist.
+
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        if spill_dir is not None and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+        self._entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (
+            self.spill_dir is not None and
+            os.path.isfile(self._spill_filename(key)))
+
+    def get(self, key):
+        """Value of a key or None if it is not cached
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the entry. Its repr identifies the entry on disk.
+
+        Returns
+        -------
+        value : ndarray or None
+            Read-only array.
+
+        """
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+        if self.spill_dir is not None:
+            try:
+                value = np.load(self._spill_filename(key))
+            except IOError:
+                value = None
+            if value is not None:
+                self.spill_hits += 1
+                self.put(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Add an entry, evict least recently used ones if required
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the entry.
+        value : ndarray
+            Value of the entry. It becomes read-only. Arrays larger than
+            max_bytes are only spilled.
+
+        """
+        if key in self._entries:
+            self.num_bytes -= self._entries.pop(key).nbytes
+        value.flags.writeable = False
+        if value.nbytes > self.max_bytes:
+            self._spill(key, value)
+            return
+        self._entries[key] = value
+        self.num_bytes += value.nbytes
+        while self.num_bytes > self.max_bytes:
+            old_key, old_value = self._entries.popitem(last=False)
+            self.num_bytes -= old_value.nbytes
+            self.evictions += 1
+            self._spill(old_key, old_value)
+
+    def flush(self):
+        """Spill entries in memory to disk (if there is a spill folder)
+        """
+        for key, value in self._entries.items():
+            self._spill(key, value)
+
+    def clear(self):
+        """Remove entries in memory (entries on disk remain)
+        """
+        self._entries.clear()
+        self.num_bytes = 0
+
+    def stats(self):
+        """Counters of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'spill_hits': self.spill_hits, 'evictions': self.evictions,
+                'entries': len(self._entries), 'bytes': self.num_bytes}
+
+    def _spill(self, key, value):
+        """Save entry on disk (if there is a spill folder)
+        """
+        if self.spill_dir is None:
+            return
+        filename = self._spill_filename(key)
+        if not os.path.isfile(filename):
+            # Write and rename, other processes never read partial files
+            tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                np.save(f, value)
+            os.rename(tmp_filename, filename)
+
+    def _spill_filename(self, key):
+        """npy-file of an entry
+        """
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.spill_dir, digest + '.npy')
+
+
+class ResultCache(object):
+    """Content-addressed cache of results (one npz-file per entry)
+
+    Entries are identified by a digest of everything that determines them
+    (check content_key), thus a re-run only recomputes the entries whose
+    inputs changed. Call prune to bound the size of the folder, least
+    recently used entries are removed first.
+
+    """
+    def __init__(self, cache_dir, max_bytes=0):
+        """Setup cache
+
+        Parameters
+        ----------
+        cache_dir : str
+            Folder with the entries. It is created if it does not exist.
+        max_bytes : int, optional
+            Max number of bytes of the entries kept by prune. 0 means no
+            limit.
+
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.pruned = 0
+
+    def __contains__(self, key):
+        return os.path.isfile(self._filename(key))
+
+    def get(self, key):
+        """Arrays of an entry or None if it is not cached
+
+        Parameters
+        ----------
+        key : str
+            Digest of the entry.
+
+        Returns
+        -------
+        value : dict or None
+            ndarrays of the entry.
+
+        """
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as f:
+                value = dict((i, f[i]) for i in f.files)
+        except IOError:
+            self.misses += 1
+            return None
+        # Access time may not be updated (noatime), prune relies on mtime
+        os.utime(filename, None)
+        self.hits += 1
+        return value
+
+    def put(self, key, **arrays):
+        """Add an entry
+
+        Parameters
+        ----------
+        key : str
+            Digest of the entry.
+        **arrays
+            ndarrays of the entry.
+
+        """
+        filename = self._filename(key)
+        # Write and rename, other processes never read partial files
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp_filename, filename)
+        self.stores += 1
+
+    def prune(self, max_bytes=None):
+        """Remove least recently used entries until they fit in max_bytes
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Max number of bytes of the entries. By default, max_bytes of the
+            cache (nothing is removed if it is 0).
+
+        Returns
+        -------
+        num_removed : int
+            Number of entries removed.
+
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes <= 0:
+            return 0
+        entries = sorted(self._entries(), key=lambda x: x[1])
+        num_bytes = sum(i[2] for i in entries)
+        num_removed = 0
+        for filename, _, size in entries:
+            if num_bytes <= max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                # Removed by another process
+                pass
+            num_bytes -= size
+            num_removed += 1
+        self.pruned += num_removed
+        return num_removed
+
+    def stats(self):
+        """Counters of the cache and size of the folder
+        """
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses,
+                'stores': self.stores, 'pruned': self.pruned,
+                'entries': len(entries), 'bytes': sum(i[2] for i in entries)}
+
+    def _entries(self):
+        """Filename, modification time and size of each entry"""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith('.npz'):
+                continue
+            filename = os.path.join(self.cache_dir, filename)
+            try:
+                info = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((filename, info.st_mtime, info.st_size))
+        return entries
+
+    def _filename(self, key):
+        """npz-file of an entry
+        """
+        return os.path.join(self.cache_dir, key + '.npz')
+
+
+def file_digest(filename, block_size=2**20):
+    """SHA1 of the content of a file, None if it does not exist
+
+    Parameters
+    ----------
+    filename : str
+        Fullpath of the file.
+    block_size : int, optional
+        Number of bytes read at once.
+
+    """
+    if not os.path.isfile(filename):
+        return None
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def array_digest(x, chunk_size=2**24):
+    """SHA1 of the shape, dtype and values of an array
+
+    Parameters
+    ----------
+    x : ndarray, memmap or h5py.Dataset
+        Array with at least one dimension, it is read by chunks of rows.
+    chunk_size : int, optional
+        Approximate number of bytes read at once.
+
+    """
+    sha1 = hashlib.sha1(repr((x.shape, np.dtype(x.dtype).str)).encode())
+    row_bytes = max(int(np.prod(x.shape[1:])) * x.dtype.itemsize, 1)
+    num_rows = max(chunk_size // row_bytes, 1)
+    for i in range(0, x.shape[0], num_rows):
+        sha1.update(np.ascontiguousarray(x[i:i + num_rows]).data)
+    return sha1.hexdigest()
+
+
+def array_fingerprint(x, num_rows=16):
+    """SHA1 of the shape, dtype and a sample of rows of an array
+
+    Cheap alternative to array_digest, only num_rows evenly spaced rows
+    (including the first and last one) are read. Changes of the rows in
+    between go unnoticed.
+
+    Parameters
+    ----------
+    x : ndarray, memmap or h5py.Dataset
+        Array with at least one dimension.
+    num_rows : int, optional
+        Number of rows read.
+
+    """
+    sha1 = hashlib.sha1(repr((x.shape, np.dtype(x.dtype).str)).encode())
+    if x.shape[0] > 0:
+        for i in np.unique(np.linspace(0, x.shape[0] - 1, num_rows,
+                                       dtype=int)):
+            sha1.update(np.ascontiguousarray(x[i]).data)
+    return sha1.hexdigest()
+
+
+def content_key(*digests, **params):
+    """Key of an entry of ResultCache
+
+    Parameters
+    ----------
+    *digests : str
+        Digests of the inputs e.g. file_digest or array_digest.
+    **params
+        Parameters of the computation. Their repr must be deterministic
+        e.g. numbers, strings and tuples.
+
+    """
+    content = repr((digests, sorted(params.items())))
+    return hashlib.sha1(content.encode()).hexdigest()
@@ -0,0 +1,208 @@
+"""Lightweight instrumentation of the stages of the proposal pipeline
+
+Stages report a record (dict) with its name, wall time, peak resident memory
+of the process and the metrics given by the stage e.g. rows read, windows,
+proposals or bytes of the arrays allocated. Records are passed to every hook
+added with add_hook. Without hooks, instrumentation is disabled and a stage
+costs a function call and a few attribute lookups.
+
+Example
+-------
+>>> from daps.utils import instrument
+>>> log = instrument.log_to('pipeline.jsonl')
+>>> summary = instrument.add_hook(instrument.StageSummary())
+>>> # run the pipeline
+>>> instrument.remove_hook(log); log.close()
+
+"""
+import json
+import numbers
+import time
+try:
+    import resource
+except ImportError:
+    # Peak memory is not reported if resource is not available (Windows)
+    resource = None
+
+_hooks = []
+
+
+def add_hook(hook):
+    """Call hook with the record of each stage
+
+    Parameters
+    ----------
+    hook : callable
+        Function receiving a dict with the record of a stage.
+
+    Returns
+    -------
+    hook : callable
+        Same hook, handy to keep a reference.
+
+    """
+    _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    """Stop calling a hook
+    """
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def clear_hooks():
+    """Remove all the hooks, it disables instrumentation
+    """
+    del _hooks[:]
+
+
+def enabled():
+    """True if any hook is listening
+    """
+    return len(_hooks) > 0
+
+
+def emit(record):
+    """Pass a record to all the hooks
+    """
+    for hook in _hooks:
+        hook(record)
+
+
+def max_rss():
+    """Peak resident memory of the process in bytes (None if unknown)
+    """
+    if resource is None:
+        return None
+    # Linux reports KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class stage(object):
+    """Context manager timing a stage of the pipeline
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage e.g. 'c3d.read'.
+    **metrics
+        Metrics known in advance e.g. video name.
+
+    Example
+    -------
+    >>> with stage('nms', proposals_in=len(dets)) as s:
+    ...     dets = non_maxima_supression(dets)
+    ...     s.update(proposals_out=len(dets))
+
+    """
+    __slots__ = ('record', 'start_time')
+
+    def __init__(self, name, **metrics):
+        self.record = None
+        if _hooks:
+            self.record = metrics
+            self.record['stage'] = name
+
+    def __enter__(self):
+        if self.record is not None:
+            self.start_time = time.time()
+        return self
+
+    def update(self, **metrics):
+        """Add metrics to the record of the stage
+        """
+        if self.record is not None:
+            self.record.update(metrics)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.record is None or exc_type is not None:
+            return False
+        self.record['wall_time'] = time.time() - self.start_time
+        self.record['max_rss'] = max_rss()
+        emit(self.record)
+        return False
+
+
+class JSONLinesLog(object):
+    """Hook writing each record as a line of JSON
+
+    Parameters
+    ----------
+    filename : str
+        Fullpath of log file. Records are appended, thus several processes
+        can share it.
+
+    """
+    def __init__(self, filename):
+        self.fobj = open(filename, 'a')
+
+    def __call__(self, record):
+        self.fobj.write(json.dumps(record, sort_keys=True,
+                                   default=to_builtin) + '\n')
+        self.fobj.flush()
+
+    def close(self):
+        self.fobj.close()
+
+
+def log_to(filename):
+    """Add a JSONLinesLog hook
+
+    Returns
+    -------
+    log : JSONLinesLog
+        Remove it with remove_hook and close it when you are done.
+
+    """
+    return add_hook(JSONLinesLog(filename))
+
+
+class StageSummary(object):
+    """Hook aggregating wall time and metrics per stage
+    """
+    def __init__(self):
+        self.stages = {}
+
+    def __call__(self, record):
+        summary = self.stages.setdefault(record['stage'], {'calls': 0})
+        summary['calls'] += 1
+        for key, value in record.items():
+            if key == 'max_rss' or not isinstance(value, numbers.Number):
+                continue
+            summary[key] = summary.get(key, 0) + value
+
+    def merge(self, stages):
+        """Add the stages summarized by another StageSummary
+
+        Parameters
+        ----------
+        stages : dict
+            Attribute stages of a StageSummary e.g. of another process.
+
+        """
+        for name, other in stages.items():
+            summary = self.stages.setdefault(name, {})
+            for key, value in other.items():
+                summary[key] = summary.get(key, 0) + value
+
+    def report(self):
+        """Lines with the summary of each stage sorted by wall time
+        """
+        lines = []
+        for name, summary in sorted(self.stages.items(),
+                                    key=lambda x: -x[1]['wall_time']):
+            metrics = ', '.join('{}={}'.format(k, v)
+                                for k, v in sorted(summary.items())
+                                if k not in ('calls', 'wall_time'))
+            lines.append('{}: {:.3f}s in {} calls {}'.format(
+                name, summary['wall_time'], summary['calls'], metrics))
+        return lines
+
+
+def to_builtin(value):
+    """Serialize numpy scalars (default of json.dumps)"""
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
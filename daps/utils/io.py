@@ -0,0 +1,259 @@
+import h5py
+import numpy as np
+import pandas as pd
+
+# Columns of proposals in the HDF5-file
+COLUMNS = ('f-init', 'f-end', 'score', 'video-index')
+DTYPES = {'f-init': np.int64, 'f-end': np.int64, 'score': np.float32,
+          'video-index': np.int32}
+
+
+class ProposalWriter(object):
+    """Append proposals of many videos to a single HDF5-file
+
+    Each column (f-init, f-end, score and video-index) is a chunked and
+    compressed HDF5-dataset. The name of each video and the offset of its
+    first proposal are kept in the datasets video-name and video-offset,
+    thus the proposals of the i-th video are the rows
+    [video-offset[i], video-offset[i + 1]) of each column.
+
+    """
+    def __init__(self, filename, buffer_size=2**16, chunk_size=2**14,
+                 compression='gzip', mode='w'):
+        """Create output file
+
+        Parameters
+        ----------
+        filename : str
+            Fullpath of HDF5-file.
+        buffer_size : int, optional
+            Number of proposals kept in memory before writing them in bulk.
+        chunk_size : int, optional
+            Number of proposals per HDF5-chunk.
+        compression : str, optional
+            Compression filter of HDF5-datasets.
+        mode : str, optional
+            'w' to create a new file or 'a' to append to an existing one.
+
+        """
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.fobj = h5py.File(filename, mode)
+        if 'video-name' in self.fobj:
+            self.video_names = list(self.fobj['video-name'][...].astype(str))
+            self.video_offset = self.fobj['video-offset'][...].tolist()
+        else:
+            self.video_names, self.video_offset = [], [0]
+            for name in COLUMNS:
+                self.fobj.create_dataset(
+                    name, shape=(0,), maxshape=(None,), dtype=DTYPES[name],
+                    chunks=(chunk_size,), compression=compression)
+        self._buffer = dict((name, []) for name in COLUMNS)
+        self._num_buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, video_name, proposals, score):
+        """Append proposals of a video
+
+        Parameters
+        ----------
+        video_name : str
+            Video identifier.
+        proposals : ndarray
+            2d-ndarray [n, 2] with f-init, f-end of each proposal.
+        score : ndarray
+            1d-ndarray [n] with score of each proposal.
+
+        Raises
+        ------
+        ValueError
+            - Mismatch between proposals and score.
+            - Proposals of the video were written before another video.
+
+        """
+        proposals = np.asarray(proposals).reshape((-1, 2))
+        score = np.asarray(score).reshape(-1)
+        if proposals.shape[0] != score.shape[0]:
+            raise ValueError('Mismatch between proposals and score.')
+
+        if not self.video_names or self.video_names[-1] != video_name:
+            if video_name in self.video_names:
+                raise ValueError('Proposals of {} must be written '
+                                 'together.'.format(video_name))
+            self.video_names.append(video_name)
+            self.video_offset.append(self.video_offset[-1])
+        self.video_offset[-1] += score.shape[0]
+
+        video_index = len(self.video_names) - 1
+        self._buffer['f-init'].append(proposals[:, 0])
+        self._buffer['f-end'].append(proposals[:, 1])
+        self._buffer['score'].append(score)
+        self._buffer['video-index'].append(
+            np.repeat(video_index, score.shape[0]))
+        self._num_buffered += score.shape[0]
+        if self._num_buffered >= self.buffer_size:
+            self.flush()
+
+    def write_dataframe(self, df):
+        """Append proposals in a DataFrame
+
+        Parameters
+        ----------
+        df : DataFrame
+            Table with columns video-name, f-init, f-end and score. Rows of
+            the same video must be contiguous.
+
+        """
+        names = df['video-name'].values
+        if len(names) == 0:
+            return
+        edges = np.hstack([0, np.where(names[1:] != names[:-1])[0] + 1,
+                           len(names)])
+        proposals = df[['f-init', 'f-end']].values
+        score = df['score'].values
+        for i, j in zip(edges[:-1], edges[1:]):
+            self.write(names[i], proposals[i:j, :], score[i:j])
+
+    def flush(self):
+        """Write buffered proposals and index to disk
+        """
+        if self._num_buffered > 0:
+            for name in COLUMNS:
+                dset = self.fobj[name]
+                values = np.concatenate(self._buffer[name])
+                num_rows = dset.shape[0]
+                dset.resize((num_rows + values.shape[0],))
+                dset[num_rows:] = values.astype(DTYPES[name])
+                self._buffer[name] = []
+            self._num_buffered = 0
+
+        # The index is small, thus it is rewritten
+        for name in ('video-name', 'video-offset'):
+            if name in self.fobj:
+                del self.fobj[name]
+        self.fobj.create_dataset(
+            'video-name', data=np.array(self.video_names, dtype='S'))
+        self.fobj.create_dataset('video-offset',
+                                 data=np.array(self.video_offset))
+        self.fobj.flush()
+
+    def close(self):
+        """Flush and close file
+        """
+        if self.fobj:
+            self.flush()
+            self.fobj.close()
+            self.fobj = None
+
+
+class ProposalReader(object):
+    """Read proposals of a file created by ProposalWriter
+
+    Proposals of a video are sliced from disk without loading the others.
+
+    """
+    def __init__(self, filename):
+        """Open file
+
+        Parameters
+        ----------
+        filename : str
+            Fullpath of HDF5-file.
+
+        """
+        self.filename = filename
+        self.fobj = h5py.File(filename, 'r')
+        self.video_names = list(self.fobj['video-name'][...].astype(str))
+        self.video_offset = self.fobj['video-offset'][...]
+        self._video_index = dict(
+            (name, i) for i, name in enumerate(self.video_names))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.video_names)
+
+    def __contains__(self, video_name):
+        return video_name in self._video_index
+
+    def read(self, video_name):
+        """Proposals of a video
+
+        Parameters
+        ----------
+        video_name : str
+            Video identifier.
+
+        Returns
+        -------
+        proposals : ndarray
+            2d-ndarray [n, 2] with f-init, f-end of each proposal.
+        score : ndarray
+            1d-ndarray [n] with score of each proposal.
+
+        Raises
+        ------
+        KeyError
+            Unknown video.
+
+        """
+        i = self._video_index[video_name]
+        rows = slice(self.video_offset[i], self.video_offset[i + 1])
+        proposals = np.stack([self.fobj['f-init'][rows],
+                              self.fobj['f-end'][rows]], axis=1)
+        return proposals, self.fobj['score'][rows]
+
+    def read_dataframe(self, video_names=None):
+        """Proposals as a DataFrame
+
+        Parameters
+        ----------
+        video_names : list of str, optional
+            Videos of interest. By default, all of them.
+
+        Returns
+        -------
+        df : DataFrame
+            Table with columns video-name, f-init, f-end and score.
+
+        """
+        if video_names is None:
+            columns = dict((name, self.fobj[name][...])
+                           for name in ('f-init', 'f-end', 'score'))
+            video_index = self.fobj['video-index'][...]
+            columns['video-name'] = np.array(self.video_names)[video_index]
+            return pd.DataFrame(columns)
+
+        df_list = []
+        for video_name in video_names:
+            proposals, score = self.read(video_name)
+            df_list.append(pd.DataFrame(
+                {'f-init': proposals[:, 0], 'f-end': proposals[:, 1],
+                 'score': score,
+                 'video-name': [video_name] * score.shape[0]}))
+        if len(df_list) == 0:
+            return pd.DataFrame(columns=['f-end', 'f-init', 'score',
+                                         'video-name'])
+        return pd.concat(df_list, ignore_index=True)
+
+    def to_csv(self, filename, video_names=None):
+        """Export proposals as CSV-file (same format as generate_proposals)
+        """
+        df = self.read_dataframe(video_names)
+        df.to_csv(filename, index=None, sep=' ')
+
+    def close(self):
+        """Close file
+        """
+        if self.fobj:
+            self.fobj.close()
+            self.fobj = None
@@ -0,0 +1,176 @@
+import numpy as np
+
+# Number of parameters of a Lasagne LSTMLayer with peepholes and fixed
+# initial states.
+LSTM_NUM_PARAMS = 17
+
+
+def sigmoid(x):
+    """Logistic function (overflow-free)"""
+    return 0.5 * (1.0 + np.tanh(0.5 * x))
+
+
+def rectify(x):
+    """Rectified linear unit"""
+    return np.maximum(x, 0)
+
+
+def lstm_params(param_values):
+    """Arrange parameters of a Lasagne LSTMLayer for lstm_forward
+
+    Parameters
+    ----------
+    param_values : list of ndarray
+        Parameters of the layer in the order given by Lasagne:
+        [W_in, W_hid, b] of ingate, forgetgate, cell and outgate, followed by
+        W_cell of ingate, forgetgate and outgate (peepholes), cell_init and
+        hid_init.
+
+    Returns
+    -------
+    params : dict
+        W_in [input-dim, 4 * num-units], W_hid [num-units, 4 * num-units] and
+        b [4 * num-units] stacked in the order ingate, forgetgate, cell and
+        outgate. W_cell [3, num-units] with peepholes. cell_init and hid_init
+        [1, num-units].
+
+    Raises
+    ------
+    ValueError
+        Unexpected number of parameters.
+
+    """
+    if len(param_values) != LSTM_NUM_PARAMS:
+        raise ValueError('LSTMLayer has {} parameters, {} given.'.format(
+            LSTM_NUM_PARAMS, len(param_values)))
+    gates = param_values[:12]
+    return {'W_in': np.hstack(gates[0::3]),
+            'W_hid': np.hstack(gates[1::3]),
+            'b': np.hstack(gates[2::3]),
+            'W_cell': np.vstack(param_values[12:15]),
+            'cell_init': param_values[15],
+            'hid_init': param_values[16]}
+
+
+def lstm_forward(x, params, only_return_final=False):
+    """Forward pass of an LSTM layer as implemented by Lasagne
+
+    Parameters
+    ----------
+    x : ndarray
+        3d-ndarray [num-batch, seq-length, input-dim].
+    params : dict
+        Parameters of the layer. Check lstm_params.
+    only_return_final : bool, optional
+        Return hidden state of last time-step only.
+
+    Returns
+    -------
+    hid : ndarray
+        3d-ndarray [num-batch, seq-length, num-units] with the hidden state
+        of each time step or 2d-ndarray [num-batch, num-units] if
+        only_return_final.
+
+    """
+    n, seq_length, _ = x.shape
+    W_hid, W_cell = params['W_hid'], params['W_cell']
+    num_units = W_hid.shape[0]
+
+    # Input contribution of all time-steps in a single matrix product
+    input_gates = np.dot(x.reshape((n * seq_length, -1)), params['W_in'])
+    input_gates += params['b']
+    input_gates = input_gates.reshape((n, seq_length, 4 * num_units))
+
+    cell = np.repeat(params['cell_init'], n, axis=0)
+    hid = np.repeat(params['hid_init'], n, axis=0)
+    if not only_return_final:
+        hid_all = np.empty((n, seq_length, num_units), dtype=hid.dtype)
+    for t in range(seq_length):
+        gates = input_gates[:, t, :] + np.dot(hid, W_hid)
+        ingate = gates[:, :num_units] + cell * W_cell[0]
+        forgetgate = gates[:, num_units:2 * num_units] + cell * W_cell[1]
+        cell_input = gates[:, 2 * num_units:3 * num_units]
+
+        cell = (sigmoid(forgetgate) * cell +
+                sigmoid(ingate) * np.tanh(cell_input))
+        outgate = gates[:, 3 * num_units:] + cell * W_cell[2]
+        hid = sigmoid(outgate) * np.tanh(cell)
+        if not only_return_final:
+            hid_all[:, t, :] = hid
+
+    if only_return_final:
+        return hid
+    return hid_all
+
+
+def dense_forward(x, W, b, nonlinearity=rectify):
+    """Forward pass of a Lasagne DenseLayer
+
+    Parameters
+    ----------
+    x : ndarray
+        2d-ndarray [num-batch, input-dim].
+    W : ndarray
+        2d-ndarray [input-dim, num-units].
+    b : ndarray
+        1d-ndarray [num-units].
+    nonlinearity : callable, optional
+        Activation function. Default is rectify as Lasagne.
+
+    Returns
+    -------
+    y : ndarray
+        2d-ndarray [num-batch, num-units]
+
+    """
+    y = np.dot(x, W)
+    y += b
+    if nonlinearity is None:
+        return y
+    return nonlinearity(y)
+
+
+def random_param_values(num_outputs=64, depth=1, width=256, input_size=500,
+                        scale=0.1, seed=0):
+    """Random parameters of DAPs in the order given by Lasagne
+
+    depth LSTM layers (check lstm_params for their order) followed by W, b of
+    the localization and the score layers. Weights are normal with standard
+    deviation scale, biases of the localization are uniform in [0, 1) and
+    the rest are zero.
+
+    Parameters
+    ----------
+    num_outputs : int, optional
+        Number of proposals per window.
+    depth : int, optional
+        Number of LSTM layers.
+    width : int, optional
+        Number of hidden units per layer.
+    input_size : int, optional
+        Dimensionality of the input features.
+    scale : float, optional
+        Standard deviation of the weights.
+    seed : int, optional
+        Seed of random number generator.
+
+    Returns
+    -------
+    param_values : list of ndarray
+
+    """
+    rng = np.random.RandomState(seed)
+    param_values = []
+    for i in range(depth):
+        layer_input = input_size if i == 0 else width
+        for _ in range(4):
+            param_values += [rng.randn(layer_input, width) * scale,
+                             rng.randn(width, width) * scale,
+                             np.zeros(width)]
+        param_values += [rng.randn(width) * scale for _ in range(3)]
+        param_values += [np.zeros((1, width)), np.zeros((1, width))]
+    param_values += [rng.randn(width, 2 * num_outputs) * scale,
+                     rng.rand(2 * num_outputs),
+                     rng.randn(width, num_outputs) * scale,
+                     np.zeros(num_outputs)]
+    return param_values
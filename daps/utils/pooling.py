@@ -29,32 +29,505 @@ def concat1d(x, n=8, pool_type='mean', norm=True, unit=False):
         when n > m.
 
     """
-    m, d = x.shape
+    d = x.shape[1]
+    concat_feat = concat1d_batch(x[np.newaxis, ...], n, pool_type, norm, unit)
+    return concat_feat.reshape(n * d)
+
+
+def concat1d_batch(x, n=8, pool_type='mean', norm=True, unit=False,
+                   dtype=np.float64):
+    """1D-concat representation of a stack of windows
+
+    Vectorized version of concat1d. All the windows are pooled and
+    normalized at once.
+
+    Parameters
+    ----------
+    x : ndarray.
+        [k x m x d] array of features. k is the number of windows, m is the
+        number of features per window and d is the dimensionality of the
+        feature space.
+    n : int
+        Number of chunks.
+    pool_type : str, optional.
+        Pooling strategy over a bunch of features.
+    norm : bool, optional.
+        Normalize each region before concatenate them.
+    unit : bool, optional.
+        Normalize the final input vector.
+    dtype : dtype, optional.
+        Data type of output. Mean pooling accumulates float16 features in
+        float32.
+
+    Outputs
+    -------
+    concat_feat : ndarray
+        [k x n x d] ndarray with concat feature of each window. Reshape it as
+        [k x n * d] to get the output of concat1d for each window.
+
+    Raises
+    ------
+    ValueError
+        - when n > m.
+        - unknown pool_type.
+
+    """
+    k, m, d = x.shape
     if n > m:
         raise ValueError(
             'n > m. This is an odd case. Define appropriate value for n '
             'considering that num-chunks {} > num-features {}'.format(n, m))
-    arr = [np.empty(d) for i in range(n)]
     pool_type = pool_type.lower()
 
+    edges = _chunk_edges(m, n)
+    if edges[-1] < m:
+        x = x[:, :edges[-1], :]
+    if pool_type == 'mean':
+        # Accumulate row by row (same summation order and accumulator as
+        # ndarray.mean) for all the chunks at once.
+        acc_dtype = np.float64
+        if x.dtype.kind == 'f':
+            acc_dtype = np.promote_types(x.dtype, np.float32)
+        counts = np.diff(edges)
+        pooled = x[:, edges[:-1], :].astype(acc_dtype)
+        for offset in range(1, counts.max()):
+            idx = np.where(counts > offset)[0]
+            pooled[:, idx, :] += x[:, edges[idx] + offset, :]
+        np.true_divide(pooled, counts.reshape((1, n, 1)), out=pooled,
+                       casting='unsafe')
+    elif pool_type == 'max':
+        pooled = np.maximum.reduceat(x, edges[:-1], axis=1)
+    else:
+        raise ValueError('Unknown pooling type {}'.format(pool_type))
+    concat_feat = pooled.astype(dtype, copy=False)
+
+    if norm:
+        _l2_normalize(concat_feat)
+    if unit:
+        concat_feat /= n
+    return concat_feat
+
+
+def concat1d_windows(x, windows, n=8, pool_type='mean', norm=True,
+                     unit=False, step=1, batch_size=256, dtype=np.float64,
+                     out=None):
+    """1D-concat representation of multiple windows over a feature array
+
+    Parameters
+    ----------
+    x : ndarray.
+        [m x d] array of features. m is the number of features and d is the
+        dimensionality of the feature space.
+    windows : ndarray.
+        [k x 2] array of window edges. Each row is [row-init, row-end) i.e.
+        the window is x[row-init:row-end:step].
+    n : int
+        Number of chunks.
+    pool_type : str, optional.
+        Pooling strategy over a bunch of features.
+    norm : bool, optional.
+        Normalize each region before concatenate them.
+    unit : bool, optional.
+        Normalize the final input vector.
+    step : int, optional.
+        Sampling stride inside each window.
+    batch_size : int, optional.
+        Max number of windows stacked in memory at once.
+    dtype : dtype, optional.
+        Data type of output.
+    out : ndarray, optional.
+        [k x n x d] array where the output is placed.
+
+    Outputs
+    -------
+    concat_feat : ndarray
+        [k x n x d] ndarray with concat feature of each window.
+
+    Raises
+    ------
+    ValueError
+        - when n > number of features of any window.
+        - unknown pool_type.
+        - out has a wrong shape.
+
+    """
+    windows = np.asarray(windows, dtype=int).reshape((-1, 2))
+    num_feat, d = x.shape
+    k = windows.shape[0]
+
+    # Number of features of each window (same semantics as slicing)
+    w_init = windows[:, 0]
+    w_end = np.minimum(windows[:, 1], num_feat)
+    lengths = np.maximum(0, (w_end - w_init + step - 1) // step)
+
+    concat_feat = _output_buffer((k, n, d), dtype, out)
+    for m in np.unique(lengths):
+        idx_windows = np.where(lengths == m)[0]
+        offsets = step * np.arange(m)
+        for i in range(0, idx_windows.size, batch_size):
+            idx = idx_windows[i:i + batch_size]
+            rows = w_init[idx, np.newaxis] + offsets
+            concat_feat[idx, ...] = concat1d_batch(
+                x[rows, :], n, pool_type, norm, unit, concat_feat.dtype)
+    return concat_feat
+
+
+def pool_windows(x, windows, pool_type='concat-32-mean', step=1,
+                 dtype=np.float64, out=None, norm=True):
+    """Pooling of multiple windows over a feature array
+
+    Parameters
+    ----------
+    x : ndarray or PoolingIndex.
+        [m x d] array of features or pooling index over such array. In the
+        latter case, step is given by the index.
+    windows : ndarray.
+        [k x 2] array of window edges. Each row is [row-init, row-end) i.e.
+        the window is x[row-init:row-end:step].
+    pool_type : str, optional.
+        Temporal pooling strategy over the features of each window. You can
+        choose among: None, '', 'mean', 'max', 'concat-n-mean/max'.
+    step : int, optional.
+        Sampling stride inside each window.
+    dtype : dtype, optional.
+        Data type of output e.g. float32 to feed DAPs without copies.
+    out : ndarray, optional.
+        [k x n x d] array where the output is placed.
+    norm : bool, optional.
+        Normalize each region of concat pooling.
+
+    Outputs
+    -------
+    pooled_feat : ndarray
+        [k x n x d] ndarray with pooled feature of each window. For a pooling
+        strategy equal to (None or ''), n is the number of features of each
+        window. For 'mean' or 'max', n = 1. For 'concat-3-mean', n = 3.
+
+    Raises
+    ------
+    ValueError
+        - incorrect pool_type.
+        - windows with different number of features when pool_type is None.
+        - out has a wrong shape.
+
+    """
+    windows = np.asarray(windows, dtype=int).reshape((-1, 2))
+    if isinstance(x, PoolingIndex):
+        def pooling(n, pool_type, **kwargs):
+            return x.concat1d_windows(windows, n, dtype=dtype, out=out,
+                                      **kwargs)
+    else:
+        def pooling(n, pool_type, **kwargs):
+            return concat1d_windows(x, windows, n, pool_type, step=step,
+                                    dtype=dtype, out=out, **kwargs)
+
+    if pool_type == '' or pool_type is None:
+        lengths = (windows[:, 1] - windows[:, 0] + step - 1) // step
+        if lengths.size and lengths.min() != lengths.max():
+            raise ValueError('Windows must have the same number of features')
+        m = lengths.max() if lengths.size else 0
+        rows = windows[:, 0:1] + step * np.arange(m)
+        pooled_feat = _output_buffer(rows.shape + (x.shape[1],), dtype, out)
+        pooled_feat[...] = x[rows, :]
+        return pooled_feat
+    elif pool_type == 'mean' or pool_type == 'max':
+        return pooling(1, pool_type, norm=False)
+    elif 'concat' in pool_type:
+        _, levels, pool_type = pool_type.split('-')
+        return pooling(int(levels), pool_type, norm=norm)
+    else:
+        raise ValueError('Incorrect pool_type')
+
+
+def pca_projection(x, U, x_mean=None, norm=False, out=None):
+    """Project features onto a PCA basis
+
+    Parameters
+    ----------
+    x : ndarray
+        [... x D] ndarray with features along the last dimension e.g.
+        [k x n x D] output of pool_windows.
+    U : ndarray
+        [D x d] ndarray with principal components.
+    x_mean : ndarray, optional.
+        [D] ndarray with mean of the features.
+    norm : bool, optional.
+        Normalize each projected vector.
+    out : ndarray, optional.
+        [... x d] array where the output is placed.
+
+    Outputs
+    -------
+    x_red : ndarray
+        [... x d] ndarray with projected features, np.dot(x - x_mean, U).
+
+    Raises
+    ------
+    ValueError
+        out has a wrong shape.
+
+    """
+    D, d = U.shape
+    x_red = _output_buffer(x.shape[:-1] + (d,), np.result_type(x, U), out)
+    # A single GEMM for all the vectors, the mean is subtracted after it
+    x_red[...] = np.dot(x.reshape((-1, D)), U).reshape(x_red.shape)
+    if x_mean is not None:
+        x_red -= np.dot(np.reshape(x_mean, -1), U)
+    if norm:
+        _l2_normalize(x_red)
+    return x_red
+
+
+def pool_and_project(x, windows, pool_type='concat-32-mean', step=1,
+                     dtype=np.float64, pca=None, out=None):
+    """Pool windows over features and project them onto a PCA basis
+
+    Mean pooling commutes with the projection, thus the windows are pooled
+    first and their regions are normalized after the projection. Otherwise,
+    the features are projected before pooling them.
+
+    Parameters
+    ----------
+    x, windows, pool_type, step, dtype : optional
+        Check pool_windows. A PoolingIndex for max-pooling must be built
+        over projected features.
+    pca : tuple, optional.
+        Principal components and mean of the features (check
+        pca_projection). Without it, the windows are only pooled.
+    out : ndarray, optional.
+        [k x n x d] array where the output is placed.
+
+    Outputs
+    -------
+    pooled_feat : ndarray
+        [k x n x d] ndarray with pooled (and projected) feature of each
+        window.
+
+    """
+    mean_pooling = bool(pool_type) and pool_type.split('-')[-1] == 'mean'
+    if pca is None or (isinstance(x, PoolingIndex) and not mean_pooling):
+        # Index of max-pooling is built over projected features
+        return pool_windows(x, windows, pool_type, step, dtype, out)
+    if mean_pooling:
+        # Normalize regions after the projection
+        feat_stack = pool_windows(x, windows, pool_type, step, dtype,
+                                  norm=False)
+        return pca_projection(feat_stack, *pca, norm='concat' in pool_type,
+                              out=out)
+    x = pca_projection(x, *pca)
+    return pool_windows(x, windows, pool_type, step, dtype, out)
+
+
+def _chunk_edges(m, n):
+    """Boundaries of n chunks of approximately equal size over m items
+    """
     edges = np.ones(n + 1, dtype=int) * 1.0 / n
     edges[0] = 0
-    edges = np.round(np.cumsum(edges) * m).astype(int)
-    for j in range(n):
-        if pool_type == 'mean':
-            arr[j][...] = x[edges[j]:edges[j + 1], :].mean(axis=0)
-        elif pool_type == 'max':
-            arr[j][...] = x[edges[j]:edges[j + 1], :].max(axis=0)
-        else:
+    return np.round(np.cumsum(edges) * m).astype(int)
+
+
+def _output_buffer(shape, dtype=np.float64, out=None):
+    """Allocate output array or check shape of the given one
+    """
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.shape != shape:
+        raise ValueError('out must have shape {}'.format(shape))
+    return out
+
+
+def _l2_normalize(x):
+    """Normalize in-place vectors along the last dimension of x
+    """
+    feat_norm = np.sqrt((x ** 2).sum(axis=-1, keepdims=True))
+    feat_norm[feat_norm == 0] = 1.0
+    x /= feat_norm
+    return x
+
+
+class PoolingIndex(object):
+    """Constant-time pooling of strided chunks over a feature array
+
+    Precompute a summary of a [m x d] feature array such that pooling a chunk
+    of rows x[init:init + count * step:step] takes a couple of lookups
+    independently of its size.
+
+    - 'mean': strided cumulative sum (integral feature). Results match
+      ndarray.mean up to floating point rounding.
+    - 'max': strided sparse table. Results are exact.
+
+    """
+    def __init__(self, x=None, step=1, pool_type='mean', tables=None):
+        """Build the index of a feature array
+
+        Parameters
+        ----------
+        x : ndarray, optional.
+            [m x d] array of features. Not required if tables are given.
+        step : int, optional.
+            Stride between consecutive rows of a chunk.
+        pool_type : str, optional.
+            Pooling strategy served by the index, 'mean' or 'max'.
+        tables : list of ndarray, optional.
+            Precomputed tables e.g. loaded from disk.
+
+        Raises
+        ------
+        ValueError
+            - unknown pool_type.
+            - x and tables are None.
+
+        """
+        self.step = int(step)
+        self.pool_type = pool_type.lower()
+        if self.pool_type not in ('mean', 'max'):
             raise ValueError('Unknown pooling type {}'.format(pool_type))
 
+        if tables is not None:
+            self.tables = list(tables)
+        elif x is None:
+            raise ValueError('Provide features or precomputed tables.')
+        elif self.pool_type == 'mean':
+            self.tables = [_strided_cumsum(x, self.step)]
+        else:
+            self.tables = [np.asarray(x)]
+
+        self.num_features = self.tables[0].shape[0]
+        if self.pool_type == 'mean':
+            self.num_features -= self.step
+        self.feat_dim = self.tables[0].shape[1]
+
+    def reduce(self, init, count):
+        """Pool chunks of features
+
+        Parameters
+        ----------
+        init : ndarray.
+            Array of initial rows of each chunk.
+        count : ndarray.
+            Array (broadcastable with init) with number of rows of each chunk.
+
+        Returns
+        -------
+        pooled : ndarray.
+            [init.shape x d] ndarray with pooled feature of each chunk.
+
+        Raises
+        ------
+        ValueError
+            empty chunks or chunks out of bounds.
+
+        """
+        init, count = np.broadcast_arrays(np.asarray(init, dtype=int),
+                                          np.asarray(count, dtype=int))
+        if init.size and (count.min() < 1 or init.min() < 0 or
+                          (init + (count - 1) * self.step).max() >=
+                          self.num_features):
+            raise ValueError('Chunks must be non-empty and inside the array')
+
+        if self.pool_type == 'mean':
+            cumsum = self.tables[0]
+            pooled = cumsum[init + count * self.step, :] - cumsum[init, :]
+            pooled /= count[..., np.newaxis]
+            return pooled
+
+        pooled = np.empty(init.shape + (self.feat_dim,))
+        level = np.zeros(count.shape, dtype=int)
+        if count.size:
+            level = np.floor(np.log2(count)).astype(int)
+            self._build_max_tables(level.max())
+        for i in np.unique(level):
+            idx = level == i
+            table = self.tables[i]
+            pooled[idx, :] = np.maximum(
+                table[init[idx], :],
+                table[init[idx] + (count[idx] - 2**i) * self.step, :])
+        return pooled
+
+    def concat1d_windows(self, windows, n=8, norm=True, unit=False,
+                         dtype=np.float64, out=None):
+        """1D-concat representation of multiple windows
+
+        Parameters
+        ----------
+        windows : ndarray.
+            [k x 2] array of window edges. Each row is [row-init, row-end)
+            i.e. the window is x[row-init:row-end:step].
+        n : int
+            Number of chunks.
+        norm : bool, optional.
+            Normalize each region before concatenate them.
+        unit : bool, optional.
+            Normalize the final input vector.
+        dtype : dtype, optional.
+            Data type of output.
+        out : ndarray, optional.
+            [k x n x d] array where the output is placed.
+
+        Outputs
+        -------
+        concat_feat : ndarray
+            [k x n x d] ndarray with concat feature of each window. Same as
+            concat1d_windows over the indexed array.
+
+        Raises
+        ------
+        ValueError
+            - when n > number of features of any window.
+            - out has a wrong shape.
+
+        """
+        windows = np.asarray(windows, dtype=int).reshape((-1, 2))
+        w_init = windows[:, 0]
+        w_end = np.minimum(windows[:, 1], self.num_features)
+        lengths = np.maximum(0, (w_end - w_init + self.step - 1) // self.step)
+
+        concat_feat = _output_buffer((windows.shape[0], n, self.feat_dim),
+                                     dtype, out)
+        for m in np.unique(lengths):
+            if n > m:
+                raise ValueError(
+                    'n > m. This is an odd case. Define appropriate value for '
+                    'n considering that num-chunks {} > num-features '
+                    '{}'.format(n, m))
+            idx = np.where(lengths == m)[0]
+            edges = _chunk_edges(m, n)
+            init = w_init[idx, np.newaxis] + self.step * edges[:-1]
+            concat_feat[idx, ...] = self.reduce(init, np.diff(edges))
+
         if norm:
-            feat_norm = np.sqrt((arr[j] ** 2).sum())
-            if feat_norm == 0:
-                feat_norm = 1.0
-            arr[j] /= feat_norm
+            _l2_normalize(concat_feat)
+        if unit:
+            concat_feat /= n
+        return concat_feat
 
-    concat_feat = np.hstack(arr)
-    if unit:
-        return concat_feat / n
-    return concat_feat
+    def _build_max_tables(self, level):
+        """Extend sparse table up to a given level
+        """
+        while len(self.tables) <= level:
+            prev = self.tables[-1]
+            shift = 2**(len(self.tables) - 1) * self.step
+            table = np.array(prev, copy=True)
+            if shift < table.shape[0]:
+                np.maximum(table[:-shift, :], prev[shift:, :],
+                           out=table[:-shift, :])
+            self.tables.append(table)
+
+
+def _strided_cumsum(x, step=1):
+    """Cumulative sum of rows of x with a given stride
+
+    Outputs
+    -------
+    cumsum : ndarray
+        [(m + step) x d] float64 ndarray. Row i + step is the sum of rows
+        i, i - step, i - 2*step, ... of x. The first step rows are zero.
+
+    """
+    m, d = x.shape
+    num_blocks = (m + step - 1) // step
+    cumsum = np.zeros(((num_blocks + 1) * step, d))
+    cumsum[step:m + step, :] = x
+    cumsum = cumsum.reshape((num_blocks + 1, step, d))
+    np.cumsum(cumsum, axis=0, out=cumsum)
+    return cumsum.reshape((-1, d))[:m + step, :]
@@ -0,0 +1,155 @@
+"""Produce the items of an iterable ahead of time on a background thread
+
+Reading (h5py) and pooling (large NumPy reductions) release the GIL, thus a
+background thread reading the next videos overlaps disk I/O with the forward
+pass of the sequence encoder running on the main thread.
+
+Example
+-------
+>>> with Prefetcher(video_stream(), depth=2) as stream:
+...     results = list(retrieve_proposals_batch(sequence_encoder, stream))
+>>> stream.stats()
+
+"""
+import Queue
+import sys
+import threading
+import time
+
+from daps.utils import instrument
+
+# Marker of the end of the iterable
+_END = object()
+
+
+class Prefetcher(object):
+    """Iterate over the items of an iterable consumed by a background thread
+
+    Items are kept in a bounded queue, thus at most depth items are produced
+    ahead of the consumer. Exceptions of the iterable (any BaseException)
+    are raised by the consumer, RuntimeError if the background thread dies
+    without reporting one.
+
+    Starvation metrics help to size depth. The consumer is starved when it
+    asks for an item and the queue is empty (I/O is not hidden), while the
+    producer is blocked when the queue is full (compute is the bottleneck).
+    Each request of an item is reported as the stage 'prefetch.wait' (check
+    daps.utils.instrument).
+
+    """
+    def __init__(self, iterable, depth=2):
+        """Start producing items
+
+        Parameters
+        ----------
+        iterable : iterable
+            Source of items e.g. a generator reading features.
+        depth : int, optional
+            Max number of items produced ahead of the consumer.
+
+        Raises
+        ------
+        ValueError
+            depth < 1.
+
+        """
+        if depth < 1:
+            raise ValueError('depth must be at least 1.')
+        self.depth = depth
+        self.items = 0
+        self.starved = 0
+        self.wait_time = 0.0
+        self.blocked = 0
+        self.blocked_time = 0.0
+        self._done = False
+        self._queue = Queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(iter(iterable),))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        with instrument.stage('prefetch.wait') as s:
+            starved = self._queue.empty()
+            start_time = time.time()
+            while True:
+                # Timeout keeps the main thread responsive to Ctrl-C
+                try:
+                    item, exc_info = self._queue.get(timeout=0.1)
+                    break
+                except Queue.Empty:
+                    # Producer gone without putting anything e.g. killed
+                    if not self._thread.is_alive() and self._queue.empty():
+                        self._done = True
+                        raise RuntimeError('prefetch thread died')
+            s.update(starved=int(starved))
+        if starved:
+            self.starved += 1
+            self.wait_time += time.time() - start_time
+
+        if exc_info is not None:
+            self._done = True
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if item is _END:
+            self._done = True
+            raise StopIteration
+        self.items += 1
+        return item
+
+    def close(self):
+        """Stop the background thread, pending items are discarded
+        """
+        self._done = True
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                pass
+            self._thread.join(0.1)
+
+    def stats(self):
+        """Starvation metrics
+        """
+        return {'depth': self.depth, 'items': self.items,
+                'starved': self.starved, 'wait_time': self.wait_time,
+                'blocked': self.blocked, 'blocked_time': self.blocked_time}
+
+    def _produce(self, iterator):
+        """Fill the queue, run by the background thread"""
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+            self._put((_END, None))
+        except BaseException:
+            # Forward SystemExit, GeneratorExit, ... as well, otherwise the
+            # consumer waits for an item that never comes
+            self._put((None, sys.exc_info()))
+
+    def _put(self, value):
+        """Put value in the queue unless close is called. False if closed"""
+        blocked = self._queue.full()
+        start_time = time.time()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(value, timeout=0.1)
+            except Queue.Full:
+                continue
+            if blocked:
+                self.blocked += 1
+                self.blocked_time += time.time() - start_time
+            return True
+        return False
@@ -1,5 +1,9 @@
+import bisect
+
 import numpy as np
 
+from daps.utils import instrument
+
 
 def format(X, mthd='c2b'):
     """Transform between temporal/frame annotations
@@ -38,7 +42,8 @@ def format(X, mthd='c2b'):
         return np.stack([Xinit, Xend], axis=-1)
 
 
-def intersection(target_segments, test_segments, return_ratio_target=False):
+def intersection(target_segments, test_segments, return_ratio_target=False,
+                 dtype=np.float64, max_memory=None):
     """Compute intersection btw segments
 
     Parameters
@@ -50,6 +55,11 @@ def intersection(target_segments, test_segments, return_ratio_target=False):
     return_ratio_target : bool, optional.
         extra ndarray output with ratio btw size of intersection over size of
         target-segments.
+    dtype : dtype, optional.
+        Data type of outputs e.g. np.float32 halves memory footprint.
+    max_memory : int, optional.
+        Max number of bytes of temporary arrays. Target segments are
+        processed in chunks fitting this budget.
 
     Outputs
     -------
@@ -71,27 +81,30 @@ def intersection(target_segments, test_segments, return_ratio_target=False):
     """
     if target_segments.ndim != 2 or test_segments.ndim != 2:
         raise ValueError('Dimension of arguments is incorrect')
+    target_segments = target_segments.astype(dtype, copy=False)
+    test_segments = test_segments.astype(dtype, copy=False)
     m, n = target_segments.shape[0], test_segments.shape[0]
     if return_ratio_target:
-        ratio_target = np.zeros((m, n))
-
-    intersect = np.zeros((m, n, 2))
-    for i in xrange(m):
-        target_size = target_segments[i, 1] - target_segments[i, 0] + 1.0
-        tt1 = np.maximum(target_segments[i, 0], test_segments[:, 0])
-        tt2 = np.minimum(target_segments[i, 1], test_segments[:, 1])
-
-        intersect[i, :, 0], intersect[i, :, 1] = tt1, tt2
+        ratio_target = np.empty((m, n), dtype=dtype)
+
+    intersect = np.empty((m, n, 2), dtype=dtype)
+    for rows in _row_chunks(m, n, 3 * np.dtype(dtype).itemsize, max_memory):
+        target = target_segments[rows, np.newaxis, :]
+        tt1 = intersect[rows, :, 0]
+        tt2 = intersect[rows, :, 1]
+        np.maximum(target[..., 0], test_segments[:, 0], out=tt1)
+        np.minimum(target[..., 1], test_segments[:, 1], out=tt2)
         if return_ratio_target:
+            target_size = target[..., 1] - target[..., 0] + 1.0
             isegs_size = (tt2 - tt1 + 1.0).clip(0)
-            ratio_target[i, :] = isegs_size / target_size
+            ratio_target[rows, :] = isegs_size / target_size
 
     if return_ratio_target:
         return intersect, ratio_target
     return intersect
 
 
-def iou(target_segments, test_segments):
+def iou(target_segments, test_segments, dtype=np.float64, max_memory=None):
     """Compute intersection over union btw segments
 
     Parameters
@@ -100,6 +113,11 @@ def iou(target_segments, test_segments):
         2d-ndarray of size [m, 2] with format [t-init, t-end].
     test_segments : ndarray.
         2d-ndarray of size [n x 2] with format [t-init, t-end].
+    dtype : dtype, optional.
+        Data type of output e.g. np.float32 halves memory footprint.
+    max_memory : int, optional.
+        Max number of bytes of temporary arrays. Target segments are
+        processed in chunks fitting this budget.
 
     Outputs
     -------
@@ -120,30 +138,84 @@ def iou(target_segments, test_segments):
         raise ValueError('Dimension of arguments is incorrect')
 
     m, n = target_segments.shape[0], test_segments.shape[0]
-    iou = np.empty((m, n))
-    for i in xrange(m):
-        tt1 = np.maximum(target_segments[i, 0], test_segments[:, 0])
-        tt2 = np.minimum(target_segments[i, 1], test_segments[:, 1])
+    iou = np.empty((m, n), dtype=dtype)
+    for rows, iou_chunk in iou_chunks(target_segments, test_segments, dtype,
+                                      max_memory):
+        iou[rows, :] = iou_chunk
+    return iou
+
+
+def iou_chunks(target_segments, test_segments, dtype=np.float64,
+               max_memory=None):
+    """Compute intersection over union btw segments chunk by chunk
+
+    Generator version of iou. It never allocates the whole [m x n] matrix,
+    thus it can stream arbitrarily large problems.
+
+    Parameters
+    ----------
+    target_segments : ndarray.
+        2d-ndarray of size [m, 2] with format [t-init, t-end].
+    test_segments : ndarray.
+        2d-ndarray of size [n x 2] with format [t-init, t-end].
+    dtype : dtype, optional.
+        Data type of output.
+    max_memory : int, optional.
+        Max number of bytes of the arrays allocated for each chunk. By
+        default, a single chunk is generated.
+
+    Yields
+    ------
+    rows : slice
+        Target segments of the chunk.
+    iou : ndarray
+        2d-ndarray of size [chunk-size x n] with tIoU ratio.
+
+    """
+    target_segments = target_segments.astype(dtype, copy=False)
+    test_segments = test_segments.astype(dtype, copy=False)
+    m, n = target_segments.shape[0], test_segments.shape[0]
+    test_size = test_segments[:, 1] - test_segments[:, 0] + 1
+    for rows in _row_chunks(m, n, 3 * np.dtype(dtype).itemsize, max_memory):
+        target = target_segments[rows, np.newaxis, :]
+        tt1 = np.maximum(target[..., 0], test_segments[:, 0])
+        tt2 = np.minimum(target[..., 1], test_segments[:, 1])
 
         # Non-negative overlap score
-        intersection = (tt2 - tt1 + 1.0).clip(0)
-        union = ((test_segments[:, 1] - test_segments[:, 0] + 1) +
-                 (target_segments[i, 1] - target_segments[i, 0] + 1) -
-                 intersection)
+        intersection = tt2
+        intersection -= tt1
+        intersection += 1.0
+        intersection.clip(0, out=intersection)
+        union = tt1
+        np.add(test_size, target[..., 1] - target[..., 0] + 1, out=union)
+        union -= intersection
         # Compute overlap as the ratio of the intersection
         # over union of two segments at the frame level.
-        iou[i, :] = intersection / union
-    return iou
+        intersection /= union
+        yield rows, intersection
 
 
-def non_maxima_supression(dets, score=None, overlap=0.7, measure='iou'):
+def _row_chunks(m, n, row_bytes, max_memory=None):
+    """Split m rows, each one with n elements of row_bytes, into chunks
+    whose size fits max_memory bytes"""
+    chunk_size = m
+    if max_memory is not None:
+        chunk_size = max(1, int(max_memory // max(1, n * row_bytes)))
+    for i in range(0, m, max(1, chunk_size)):
+        yield slice(i, min(i + chunk_size, m))
+
+
+def non_maxima_supression(dets, score=None, overlap=0.7, measure='iou',
+                          max_proposals=None):
     """Non-maximum suppression
 
     Greedily select high-scoring detections and skip detections that are
     significantly covered by a previously selected detection.
 
     This version is translated from Matlab code by Tomasz Malisiewicz,
-    who sped up Pedro Felzenszwalb's code.
+    who sped up Pedro Felzenszwalb's code. Selected detections are kept
+    sorted by initial frame, thus each detection is only compared against
+    the selected ones that may intersect it.
 
     Parameters
     ----------
@@ -156,6 +228,8 @@ def non_maxima_supression(dets, score=None, overlap=0.7, measure='iou'):
     measure : str, optional.
         Overlap measure used to perform NMS either IoU ('iou') or ratio of
         intersection ('overlap')
+    max_proposals : int, optional.
+        Stop after selecting this number of detections.
 
     Outputs
     -------
@@ -176,6 +250,8 @@ def non_maxima_supression(dets, score=None, overlap=0.7, measure='iou'):
         score = dets[:, 1]
     if score.shape[0] != dets.shape[0]:
         raise ValueError('Mismatch between dets and score.')
+    if measure not in ('iou', 'overlap'):
+        raise ValueError('Unknown overlap measure for NMS')
     if dets.dtype.kind == "i":
             dets = dets.astype("float")
     # Discard incorrect segments (avoid infinite loop due to NaN)
@@ -185,25 +261,155 @@ def non_maxima_supression(dets, score=None, overlap=0.7, measure='iou'):
     t1 = dets[idx_correct, 0]
     t2 = dets[idx_correct, 1]
 
-    area = t2 - t1 + 1
     idx = np.argsort(score[idx_correct])
-    pick = []
-    while len(idx) > 0:
-        last = len(idx) - 1
-        i = idx[last]
-        pick.append(i)
+    with instrument.stage('nms', proposals_in=dets.shape[0]) as s:
+        pick = _greedy_nms(t1, t2, idx[::-1], overlap, measure,
+                           max_proposals)
+        s.update(proposals_out=len(pick))
+    return dets[idx_correct[pick], :].astype("int"), score[idx_correct[pick]]
 
-        tt1 = np.maximum(t1[i], t1[idx])
-        tt2 = np.minimum(t2[i], t2[idx])
 
-        wh = np.maximum(0, tt2 - tt1 + 1)
-        if measure == 'overlap':
-            o = wh / area[idx]
-        elif measure == 'iou':
-            o = wh / (area[i] + area[idx] - wh)
-        else:
-            raise ValueError('Unknown overlap measure for NMS')
+def non_maxima_supression_batch(dets, score, group, overlap=0.7,
+                                measure='iou', max_proposals=None):
+    """Non-maximum suppression of several groups (e.g. videos) at once
 
-        idx = np.delete(idx, np.where(o > overlap)[0])
+    Same as calling non_maxima_supression on each group, suppression never
+    crosses group boundaries. Detections of each group are visited in the
+    same order as non_maxima_supression, also those with the same score.
 
-    return dets[idx_correct[pick], :].astype("int"), score[idx_correct[pick]]
+    Parameters
+    ----------
+    dets : ndarray.
+        2d-ndarray of size [num-segments, 2]. Each row is ['f-init', 'f-end'].
+    score : ndarray.
+        1d-ndarray of with detection scores. Size [num-segments].
+    group : ndarray.
+        1d-ndarray with group id (e.g. video index) of each detection.
+    overlap : float, optional.
+        Minimum overlap ratio.
+    measure : str, optional.
+        Overlap measure used to perform NMS either IoU ('iou') or ratio of
+        intersection ('overlap')
+    max_proposals : int, optional.
+        Max number of detections selected per group.
+
+    Outputs
+    -------
+    pick : ndarray.
+        1d-ndarray with indices of remaining detections sorted by group and
+        decreasing score. Use it to index dets, score and group or to set a
+        keep-mask.
+
+    Raises
+    ------
+    ValueError
+        - Mismatch between score, group and dets
+        - Unknown measure for defining overlap
+
+    """
+    measure = measure.lower()
+    if score.shape[0] != dets.shape[0] or group.shape[0] != dets.shape[0]:
+        raise ValueError('Mismatch between dets, score and group.')
+    if measure not in ('iou', 'overlap'):
+        raise ValueError('Unknown overlap measure for NMS')
+    dets = dets.astype("float")
+    # Discard incorrect segments (avoid infinite loop due to NaN)
+    idx_correct = np.where(dets[:, 1] > dets[:, 0])[0]
+
+    # Sort by group and decreasing score. Each group is sorted on its own as
+    # non_maxima_supression does, ties are broken in the same way.
+    groups, group_correct = np.unique(group[idx_correct],
+                                      return_inverse=True)
+    score_correct = score[idx_correct]
+    by_group = np.argsort(group_correct, kind='mergesort')
+    edges = np.searchsorted(group_correct[by_group],
+                            np.arange(len(groups) + 1))
+    idx = np.zeros(0, dtype=int)
+    if len(groups) > 0:
+        idx = np.concatenate([
+            i[np.argsort(score_correct[i])[::-1]]
+            for i in np.split(by_group, edges[1:-1])])
+    with instrument.stage('nms', proposals_in=dets.shape[0]) as s:
+        pick = _greedy_nms(dets[idx_correct, 0], dets[idx_correct, 1], idx,
+                           overlap, measure, max_proposals, group_correct)
+        s.update(proposals_out=len(pick), groups=len(groups))
+    return idx_correct[np.array(pick, dtype=int)]
+
+
+def _greedy_nms(t1, t2, order, overlap=0.7, measure='iou',
+                max_proposals=None, group=None):
+    """Greedy suppression of segments visited in a given order
+
+    Parameters
+    ----------
+    t1, t2 : ndarray.
+        1d-ndarray with initial and ending frame of the segments.
+    order : ndarray.
+        1d-ndarray with indices of segments sorted by decreasing priority.
+    overlap : float, optional.
+        Minimum overlap ratio.
+    measure : str, optional.
+        'iou' or 'overlap'.
+    max_proposals : int, optional.
+        Stop after selecting this number of segments (per group).
+    group : ndarray, optional.
+        1d-ndarray with group id of each segment. Segments of different groups
+        never suppress each other.
+
+    Outputs
+    -------
+    pick : list.
+        Indices of selected segments in order of selection.
+
+    """
+    t1, t2 = t1.tolist(), t2.tolist()
+    if group is None:
+        group = np.zeros(len(t1), dtype=int)
+    group = group.tolist()
+    # Selected segments of each group sorted by initial frame
+    kept_t1, kept_t2, max_length = {}, {}, {}
+    pick = []
+    for i in order.tolist():
+        g = group[i]
+        if g not in kept_t1:
+            kept_t1[g], kept_t2[g], max_length[g] = [], [], 0
+        g_t1, g_t2 = kept_t1[g], kept_t2[g]
+        if max_proposals is not None and len(g_t1) >= max_proposals:
+            continue
+        it1, it2 = t1[i], t2[i]
+        area = it2 - it1 + 1
+
+        # Only selected segments starting in this range can overlap i more
+        # than the threshold
+        if measure == 'overlap' and overlap >= 0:
+            lo = it1 - 1 + overlap * area - max_length[g]
+            hi = it2 + 1 - overlap * area
+        elif measure == 'iou' and overlap > 0:
+            # iou = inter / (inter + |init shift| + |end shift|)
+            radius = area * (1 - overlap) / overlap
+            lo, hi = it1 - radius, it1 + radius
+        else:
+            lo, hi = it1 - max_length[g] - 1, it2 + 1
+        lo = bisect.bisect_left(g_t1, lo)
+        hi = bisect.bisect_right(g_t1, hi)
+        suppressed = False
+        for j in range(lo, hi):
+            wh = min(it2, g_t2[j]) - max(it1, g_t1[j]) + 1
+            if wh <= 0:
+                continue
+            if measure == 'overlap':
+                o = wh / area
+            else:
+                o = wh / ((g_t2[j] - g_t1[j] + 1) + area - wh)
+            if o > overlap:
+                suppressed = True
+                break
+        if suppressed:
+            continue
+
+        pick.append(i)
+        pos = bisect.bisect_right(g_t1, it1)
+        g_t1.insert(pos, it1)
+        g_t2.insert(pos, it2)
+        max_length[g] = max(max_length[g], it2 - it1)
+    return pick
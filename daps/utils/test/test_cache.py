@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from daps.utils.cache import array_digest, array_fingerprint, content_key
+from daps.utils.cache import LRUCache, ResultCache
+
+
+class test_lru_cache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(max_bytes=2 * 80)
+        for i in range(3):
+            cache.put(i, np.zeros(10) + i)
+        # Least recently used entry is evicted
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(160, cache.stats()['bytes'])
+        np.testing.assert_array_equal(cache.get(1), np.ones(10))
+        cache.put(3, np.zeros(10))
+        self.assertTrue(1 in cache)
+        self.assertFalse(2 in cache)
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(2, stats['evictions'])
+        # Cached arrays are read-only
+        self.assertFalse(cache.get(3).flags.writeable)
+        # Larger than the cache
+        cache.put(4, np.zeros(100))
+        self.assertFalse(4 in cache)
+
+    def test_spill(self):
+        spill_dir = tempfile.mkdtemp()
+        cache = LRUCache(max_bytes=80, spill_dir=spill_dir)
+        cache.put('a', np.arange(10))
+        cache.put('b', np.arange(10) + 1)
+        np.testing.assert_array_equal(cache.get('a'), np.arange(10))
+        self.assertEqual(1, cache.stats()['spill_hits'])
+        cache.flush()
+        # Another cache over the same folder e.g. a re-run
+        other = LRUCache(max_bytes=0, spill_dir=spill_dir)
+        np.testing.assert_array_equal(other.get('b'), np.arange(10) + 1)
+        self.assertIsNone(other.get('c'))
+        shutil.rmtree(spill_dir)
+
+
+class test_result_cache(unittest.TestCase):
+    def test_get_put(self):
+        cache_dir = tempfile.mkdtemp()
+        cache = ResultCache(cache_dir)
+        key = content_key(array_digest(np.arange(10)), stride=64)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, score=np.arange(3.0))
+        self.assertTrue(key in cache)
+        # Another cache over the same folder e.g. a re-run
+        other = ResultCache(cache_dir)
+        np.testing.assert_array_equal(other.get(key)['score'], np.arange(3.0))
+        stats = other.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(1, cache.stats()['misses'])
+        # Any change of content or parameters yields another key
+        self.assertFalse(content_key(array_digest(np.arange(10)),
+                                     stride=32) in cache)
+        self.assertFalse(content_key(array_digest(np.arange(10.0)),
+                                     stride=64) in cache)
+        shutil.rmtree(cache_dir)
+
+    def test_array_fingerprint(self):
+        x = np.random.RandomState(0).randn(100, 4)
+        key = array_fingerprint(x, num_rows=4)
+        self.assertEqual(key, array_fingerprint(x.copy(), num_rows=4))
+        # Only the first, last and evenly spaced rows are read
+        y = x.copy()
+        y[1] += 1
+        self.assertEqual(key, array_fingerprint(y, num_rows=4))
+        self.assertNotEqual(array_digest(x), array_digest(y))
+        y[-1] += 1
+        self.assertNotEqual(key, array_fingerprint(y, num_rows=4))
+        self.assertNotEqual(key, array_fingerprint(x[:99], num_rows=4))
+        self.assertNotEqual(key, array_fingerprint(x.astype(np.float32),
+                                                   num_rows=4))
+
+    def test_prune(self):
+        cache_dir = tempfile.mkdtemp()
+        cache = ResultCache(cache_dir)
+        for i, key in enumerate('abc'):
+            cache.put(key, x=np.zeros(100))
+            # Entries used one after the other
+            mtime = time.time() - 10 * (3 - i)
+            os.utime(os.path.join(cache_dir, key + '.npz'), (mtime, mtime))
+        num_bytes = cache.stats()['bytes']
+        # Least recently used entry is removed
+        cache.get('a')
+        self.assertEqual(1, cache.prune(num_bytes - 1))
+        self.assertFalse('b' in cache)
+        self.assertTrue('a' in cache)
+        # Size limit of the cache
+        mtime = time.time() - 5
+        os.utime(os.path.join(cache_dir, 'a.npz'), (mtime, mtime))
+        cache.put('d', x=np.zeros(100))
+        self.assertEqual(0, cache.prune())
+        cache.max_bytes = num_bytes / 3
+        self.assertEqual(2, cache.prune())
+        stats = cache.stats()
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(3, stats['pruned'])
+        self.assertTrue('d' in cache)
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,59 @@
+import json
+import os
+import tempfile
+import unittest
+
+from daps.utils import instrument
+
+
+class test_instrument(unittest.TestCase):
+    def tearDown(self):
+        instrument.clear_hooks()
+
+    def test_stage(self):
+        # Disabled
+        self.assertFalse(instrument.enabled())
+        with instrument.stage('dummy', video='a') as s:
+            s.update(windows=3)
+        self.assertIsNone(s.record)
+
+        records = []
+        instrument.add_hook(records.append)
+        with instrument.stage('dummy', video='a') as s:
+            s.update(windows=3)
+        self.assertEqual(1, len(records))
+        self.assertEqual('dummy', records[0]['stage'])
+        self.assertEqual('a', records[0]['video'])
+        self.assertEqual(3, records[0]['windows'])
+        self.assertGreaterEqual(records[0]['wall_time'], 0)
+        # Failed stages are not reported
+        with self.assertRaises(RuntimeError):
+            with instrument.stage('dummy'):
+                raise RuntimeError
+        self.assertEqual(1, len(records))
+        instrument.remove_hook(records.append)
+        self.assertFalse(instrument.enabled())
+
+    def test_hooks(self):
+        summary = instrument.add_hook(instrument.StageSummary())
+        filename = os.path.join(tempfile.mkdtemp(), 'log.jsonl')
+        log = instrument.log_to(filename)
+        for i in range(2):
+            with instrument.stage('nms', proposals_in=10) as s:
+                s.update(proposals_out=i)
+        log.close()
+        self.assertEqual(2, summary.stages['nms']['calls'])
+        self.assertEqual(20, summary.stages['nms']['proposals_in'])
+        self.assertEqual(1, len(summary.report()))
+        # Summary of another process
+        other = instrument.StageSummary()
+        other({'stage': 'nms', 'wall_time': 1.0, 'proposals_in': 5})
+        other({'stage': 'c3d.read', 'wall_time': 2.0})
+        summary.merge(other.stages)
+        self.assertEqual(3, summary.stages['nms']['calls'])
+        self.assertEqual(25, summary.stages['nms']['proposals_in'])
+        self.assertEqual(['c3d.read', 'nms'], sorted(summary.stages))
+        with open(filename) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([0, 1], [i['proposals_out'] for i in records])
+        os.remove(filename)
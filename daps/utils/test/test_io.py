@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from daps.utils.io import ProposalReader, ProposalWriter
+
+
+class test_proposal_io(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(tempfile.mkdtemp(), 'proposals.hdf5')
+
+    def tearDown(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+    def test_write_read(self):
+        rng = np.random.RandomState(0)
+        proposals = {'a': rng.randint(0, 100, (5, 2)),
+                     'b': rng.randint(0, 100, (0, 2)),
+                     'c': rng.randint(0, 100, (7, 2))}
+        score = dict((k, rng.rand(len(v))) for k, v in proposals.items())
+        with ProposalWriter(self.filename, buffer_size=4) as writer:
+            for video_name in ['a', 'b', 'c']:
+                writer.write(video_name, proposals[video_name],
+                             score[video_name])
+            self.assertRaises(ValueError, writer.write, 'a',
+                              proposals['a'], score['a'])
+            self.assertRaises(ValueError, writer.write, 'd',
+                              proposals['a'], score['c'])
+
+        with ProposalReader(self.filename) as reader:
+            self.assertEqual(3, len(reader))
+            self.assertTrue('b' in reader)
+            for video_name in ['a', 'b', 'c']:
+                p, s = reader.read(video_name)
+                np.testing.assert_array_equal(proposals[video_name], p)
+                np.testing.assert_array_almost_equal(score[video_name], s)
+            df = reader.read_dataframe()
+            self.assertEqual(12, len(df))
+            self.assertEqual(['a'] * 5 + ['c'] * 7, list(df['video-name']))
+            df_c = reader.read_dataframe(['c'])
+            np.testing.assert_array_equal(
+                df_c[['f-init', 'f-end']].values, proposals['c'])
+
+    def test_dataframe(self):
+        df = pd.DataFrame({'video-name': ['x', 'x', 'y'],
+                           'f-init': [0, 10, 5], 'f-end': [8, 20, 9],
+                           'score': [0.5, 0.25, 1.0]})
+        with ProposalWriter(self.filename) as writer:
+            writer.write_dataframe(df)
+        # Append
+        with ProposalWriter(self.filename, mode='a') as writer:
+            writer.write('z', [[1, 2]], [0.125])
+        with ProposalReader(self.filename) as reader:
+            df_out = reader.read_dataframe()
+        self.assertEqual(['x', 'x', 'y', 'z'], list(df_out['video-name']))
+        np.testing.assert_array_equal(df_out['f-end'], [8, 20, 9, 2])
+        np.testing.assert_array_equal(df_out['score'], [0.5, 0.25, 1, 0.125])
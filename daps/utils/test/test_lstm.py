@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+
+import daps.utils.lstm as lstm
+
+
+class test_lstm_utilities(unittest.TestCase):
+    def setUp(self):
+        input_dim, num_units = 3, 2
+        gate_shapes = [(input_dim, num_units), (num_units, num_units),
+                       (num_units,)] * 4
+        peephole_shapes = [(num_units,)] * 3 + [(1, num_units)] * 2
+        self.param_values = [np.random.randn(*i)
+                             for i in gate_shapes + peephole_shapes]
+        self.param_values[-2:] = [np.zeros((1, num_units))] * 2
+
+    def test_lstm_params(self):
+        self.assertRaises(ValueError, lstm.lstm_params, self.param_values[1:])
+        params = lstm.lstm_params(self.param_values)
+        self.assertEqual((3, 8), params['W_in'].shape)
+        self.assertEqual((2, 8), params['W_hid'].shape)
+        self.assertEqual((8,), params['b'].shape)
+        self.assertEqual((3, 2), params['W_cell'].shape)
+
+    def test_lstm_forward(self):
+        params = lstm.lstm_params(self.param_values)
+        x = np.random.randn(5, 4, 3)
+        hid = lstm.lstm_forward(x, params)
+        self.assertEqual((5, 4, 2), hid.shape)
+        hid_final = lstm.lstm_forward(x, params, only_return_final=True)
+        np.testing.assert_array_equal(hid[:, -1, :], hid_final)
+        # First time-step (initial states are zero)
+        W_in, b = self.param_values[0:12:3], self.param_values[2:12:3]
+        W_cell = self.param_values[12:15]
+        ingate, _, cell, outgate = [np.dot(x[:, 0, :], W_in[i]) + b[i]
+                                    for i in range(4)]
+        cell = lstm.sigmoid(ingate) * np.tanh(cell)
+        outgate = lstm.sigmoid(outgate + cell * W_cell[2])
+        np.testing.assert_allclose(hid[:, 0, :], outgate * np.tanh(cell))
+
+    def test_dense_forward(self):
+        x, W, b = np.random.randn(4, 3), np.random.randn(3, 2), np.ones(2)
+        y = lstm.dense_forward(x, W, b)
+        np.testing.assert_allclose(y, np.maximum(np.dot(x, W) + 1, 0))
+        y = lstm.dense_forward(x, W, b, lstm.sigmoid)
+        np.testing.assert_allclose(y, 1 / (1 + np.exp(-np.dot(x, W) - 1)))
+
+    def test_random_param_values(self):
+        param_values = lstm.random_param_values(4, 2, 6, 5, scale=0.01)
+        self.assertEqual(2 * lstm.LSTM_NUM_PARAMS + 4, len(param_values))
+        self.assertEqual((5, 6), param_values[0].shape)
+        self.assertEqual((6, 6), param_values[lstm.LSTM_NUM_PARAMS].shape)
+        self.assertEqual((6, 8), param_values[-4].shape)
+        self.assertEqual((4,), param_values[-1].shape)
+        np.testing.assert_allclose(
+            param_values[0],
+            lstm.random_param_values(4, 2, 6, 5)[0] * 0.1)
@@ -1,7 +1,9 @@
 import nose.tools as nt
 import numpy as np
 
-from daps.utils.pooling import concat1d
+from daps.utils.pooling import concat1d, concat1d_batch, concat1d_windows
+from daps.utils.pooling import pca_projection, pool_and_project
+from daps.utils.pooling import pool_windows, PoolingIndex
 
 
 def test_concat1d():
@@ -13,3 +15,116 @@ def test_concat1d():
         rst = concat1d(a, 2, pool_type, False, False)
         np.testing.assert_equal(rst, answer[i])
     # TODO: test norm, unit flags
+
+
+def test_concat1d_batch():
+    k, m, d = 7, 23, 4
+    a = np.random.rand(k, m, d)
+    nt.assert_raises(ValueError, concat1d_batch, a, m + 1)
+    nt.assert_raises(ValueError, concat1d_batch, a, 2, 'median')
+    for pool_type in ['mean', 'max']:
+        rst = concat1d_batch(a, 8, pool_type)
+        nt.assert_equal((k, 8, d), rst.shape)
+        for i in range(k):
+            np.testing.assert_array_equal(
+                rst[i, ...].reshape(-1), concat1d(a[i, ...], 8, pool_type))
+
+
+def test_concat1d_windows():
+    m, d = 100, 3
+    a = np.random.rand(m, d)
+    windows = np.array([[0, 50], [10, 60], [37, 90], [70, 150]])
+    rst = concat1d_windows(a, windows, 4, 'mean', step=3)
+    nt.assert_equal((windows.shape[0], 4, d), rst.shape)
+    for i, (w_init, w_end) in enumerate(windows):
+        np.testing.assert_array_equal(
+            rst[i, ...].reshape(-1), concat1d(a[w_init:w_end:3, :], 4))
+
+
+def test_pooling_index():
+    m, d = 100, 3
+    a = np.random.rand(m, d)
+    nt.assert_raises(ValueError, PoolingIndex, a, 1, 'median')
+    windows = np.array([[0, 50], [10, 60], [37, 90]])
+    for pool_type in ['mean', 'max']:
+        index = PoolingIndex(a, 3, pool_type)
+        nt.assert_raises(ValueError, index.reduce, 99, 2)
+        rst = index.concat1d_windows(windows, 4)
+        answer = concat1d_windows(a, windows, 4, pool_type, step=3)
+        np.testing.assert_allclose(rst, answer)
+
+
+def test_pool_windows():
+    m, d = 100, 3
+    a = np.random.rand(m, d)
+    windows = np.array([[0, 50], [10, 60]])
+    nt.assert_raises(ValueError, pool_windows, a, windows, 'median')
+    rst = pool_windows(a, windows, None, 2)
+    np.testing.assert_array_equal(rst[1, ...], a[10:60:2, :])
+    rst = pool_windows(a, windows, 'max', 2)
+    np.testing.assert_array_equal(rst[0, ...], a[0:50:2, :].max(axis=0,
+                                                                keepdims=True))
+    rst = pool_windows(a, windows, 'concat-4-mean', 2)
+    np.testing.assert_array_equal(rst[0, ...].reshape(-1),
+                                  concat1d(a[0:50:2, :], 4))
+
+
+def test_pool_windows_dtype():
+    m, d = 100, 3
+    a = np.random.rand(m, d).astype(np.float32)
+    windows = np.array([[0, 50], [10, 60]])
+    for pool_type in [None, 'max', 'concat-4-mean']:
+        rst = pool_windows(a, windows, pool_type, 2)
+        rst_32 = pool_windows(a, windows, pool_type, 2, np.float32)
+        nt.assert_equal(rst_32.dtype, np.float32)
+        np.testing.assert_allclose(rst_32, rst, rtol=1e-6)
+        out = np.empty_like(rst_32)
+        nt.assert_true(pool_windows(a, windows, pool_type, 2, np.float32,
+                                    out) is out)
+        np.testing.assert_array_equal(out, rst_32)
+    # PoolingIndex
+    index = PoolingIndex(a, 2, 'mean')
+    out = np.empty((2, 4, d), dtype=np.float32)
+    rst = pool_windows(index, windows, 'concat-4-mean', out=out)
+    nt.assert_true(rst is out)
+    np.testing.assert_allclose(rst, pool_windows(a, windows, 'concat-4-mean',
+                                                 2), rtol=1e-5)
+    nt.assert_raises(ValueError, pool_windows, a, windows, 'concat-4-mean',
+                     2, np.float32, out[:1, ...])
+    # float16 storage is upcast
+    a_16 = a.astype(np.float16)
+    rst = pool_windows(a_16, windows, 'concat-4-mean', 2, np.float32)
+    nt.assert_equal(rst.dtype, np.float32)
+    np.testing.assert_allclose(rst, pool_windows(a_16.astype(np.float32),
+                                                 windows, 'concat-4-mean', 2,
+                                                 np.float32))
+
+
+def test_pca_projection():
+    x = np.random.rand(4, 3, 6)
+    U, x_mean = np.random.rand(6, 2), np.random.rand(6)
+    rst = pca_projection(x, U, x_mean)
+    np.testing.assert_allclose(rst, np.dot(x - x_mean, U))
+    out = np.empty((4, 3, 2))
+    rst = pca_projection(x, U, x_mean, True, out)
+    nt.assert_true(rst is out)
+    np.testing.assert_allclose(np.linalg.norm(rst, axis=-1), 1)
+
+
+def test_pool_and_project():
+    x = np.random.rand(100, 6)
+    pca = np.random.rand(6, 2), np.random.rand(6)
+    windows = np.array([[0, 64], [30, 94]])
+    x_red = pca_projection(x, *pca)
+    # Projection of each feature, then pooling
+    for pool_type in ['concat-4-mean', 'concat-4-max', 'mean', 'max']:
+        np.testing.assert_allclose(
+            pool_and_project(x, windows, pool_type, 2, pca=pca),
+            pool_windows(x_red, windows, pool_type, 2))
+    np.testing.assert_array_equal(pool_windows(x, windows),
+                                  pool_and_project(x, windows))
+    # Index of max-pooling over projected features
+    index = PoolingIndex(x_red, 2, 'max')
+    np.testing.assert_allclose(
+        pool_and_project(index, windows, 'concat-4-max', pca=pca),
+        pool_windows(x_red, windows, 'concat-4-max', 2))
@@ -0,0 +1,80 @@
+import time
+import unittest
+
+from daps.utils import instrument
+from daps.utils.prefetch import Prefetcher
+
+
+def slow_range(n, delay=0.0):
+    for i in range(n):
+        time.sleep(delay)
+        yield i
+
+
+def failing_range(n):
+    for i in range(n):
+        yield i
+    raise RuntimeError('Failure reading item')
+
+
+def exiting_range(n):
+    for i in range(n):
+        yield i
+    raise SystemExit('Producer exits')
+
+
+class test_prefetcher(unittest.TestCase):
+    def tearDown(self):
+        instrument.clear_hooks()
+
+    def test_order(self):
+        with Prefetcher(slow_range(10), depth=3) as stream:
+            self.assertEqual(list(range(10)), list(stream))
+        stats = stream.stats()
+        self.assertEqual(10, stats['items'])
+        self.assertEqual(3, stats['depth'])
+        self.assertRaises(ValueError, Prefetcher, [], 0)
+
+    def test_exception(self):
+        items = []
+        with self.assertRaises(RuntimeError):
+            for i in Prefetcher(failing_range(3)):
+                items.append(i)
+        self.assertEqual([0, 1, 2], items)
+        # Exceptions that are not an Exception subclass
+        items = []
+        with self.assertRaises(SystemExit):
+            for i in Prefetcher(exiting_range(2)):
+                items.append(i)
+        self.assertEqual([0, 1], items)
+
+    def test_dead_producer(self):
+        class DeadPrefetcher(Prefetcher):
+            def _produce(self, iterator):
+                pass
+        stream = DeadPrefetcher(range(3))
+        self.assertRaises(RuntimeError, next, stream)
+        self.assertRaises(StopIteration, next, stream)
+
+    def test_starvation(self):
+        records = []
+        instrument.add_hook(records.append)
+        # Slow producer
+        with Prefetcher(slow_range(4, 0.02), depth=1) as stream:
+            self.assertEqual(4, len(list(stream)))
+        self.assertGreaterEqual(stream.starved, 4)
+        self.assertGreater(stream.wait_time, 0)
+        self.assertEqual(5, len(records))
+        self.assertEqual('prefetch.wait', records[0]['stage'])
+        # Slow consumer
+        with Prefetcher(slow_range(4), depth=1) as stream:
+            for i in stream:
+                time.sleep(0.02)
+        self.assertGreater(stream.blocked, 0)
+
+    def test_close(self):
+        stream = Prefetcher(slow_range(100), depth=2)
+        self.assertEqual(0, next(stream))
+        stream.close()
+        self.assertFalse(stream._thread.is_alive())
+        self.assertRaises(StopIteration, next, stream)
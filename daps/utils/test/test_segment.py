@@ -35,6 +35,11 @@ class test_segment_utilities(unittest.TestCase):
         results = segment.intersection(a, b, True)
         self.assertEqual(2, len(results))
         self.assertEqual((a.shape[0], b.shape[0]), results[1].shape)
+        a = np.array([[5, 15], [1, 12]])
+        results_chunked = segment.intersection(a, b, True, max_memory=1)
+        results = segment.intersection(a, b, True)
+        for i in range(2):
+            np.testing.assert_array_equal(results[i], results_chunked[i])
 
     def test_iou(self):
         a = np.array([[1, 10], [5, 20], [16, 25]])
@@ -54,6 +59,14 @@ class test_segment_utilities(unittest.TestCase):
         self.assertEqual(5.0/16, rst[2, 2])
         # segment to right
         self.assertEqual(6/15.0, rst[2, 3])
+        # chunked & float32
+        np.testing.assert_array_equal(rst, segment.iou(a, b, max_memory=1))
+        rst_32 = segment.iou(a, b, np.float32, 8 * b.shape[0])
+        self.assertEqual(np.float32, rst_32.dtype)
+        np.testing.assert_allclose(rst, rst_32, rtol=1e-6)
+        chunks = list(segment.iou_chunks(a, b, max_memory=1))
+        self.assertEqual(a.shape[0], len(chunks))
+        np.testing.assert_array_equal(rst[1:2, :], chunks[1][1])
 
     def test_nms_detection(self):
         boxes = np.array([[10, 13],
@@ -80,3 +93,43 @@ class test_segment_utilities(unittest.TestCase):
         bout, sout = segment.non_maxima_supression(boxes, scores,
                                                    measure='overlap')
         np.testing.assert_array_equal(bout, boxes[idx_sol, ...])
+        # With score, NMS by iou, early termination
+        bout, sout = segment.non_maxima_supression(boxes, scores, 0.5,
+                                                   max_proposals=2)
+        np.testing.assert_array_equal(bout, boxes[[0, 1], ...])
+        # Unknown measure
+        self.assertRaises(ValueError, segment.non_maxima_supression, boxes,
+                          scores, measure='dice')
+
+    def test_nms_batch(self):
+        boxes = np.array([[10, 13],
+                          [7, 11],
+                          [5, 7],
+                          [11, 12],
+                          [9, 15]])
+        scores = np.arange(boxes.shape[0])[::-1]
+        # Same detections in two groups, suppression never crosses groups
+        dets = np.vstack([boxes, boxes])
+        score = np.hstack([scores, scores])
+        group = np.array(['b'] * 5 + ['a'] * 5)
+        pick = segment.non_maxima_supression_batch(dets, score, group, 0.5)
+        np.testing.assert_array_equal(pick, [5, 6, 7, 8, 0, 1, 2, 3])
+        # Max number of detections per group
+        pick = segment.non_maxima_supression_batch(dets, score, group, 0.5,
+                                                   max_proposals=2)
+        np.testing.assert_array_equal(pick, [5, 6, 0, 1])
+        # Same as one call per group, also the order of tied scores
+        rng = np.random.RandomState(0)
+        dets = np.sort(rng.randint(0, 200, (300, 2)), axis=1)
+        score = rng.randint(0, 4, 300) / 4.0
+        group = rng.randint(0, 3, 300)
+        pick = segment.non_maxima_supression_batch(dets, score, group)
+        for g in range(3):
+            dets_group, score_group = segment.non_maxima_supression(
+                dets[group == g], score[group == g])
+            pick_group = pick[group[pick] == g]
+            np.testing.assert_array_equal(dets_group, dets[pick_group])
+            np.testing.assert_array_equal(score_group, score[pick_group])
+        # Mismatch between inputs
+        self.assertRaises(ValueError, segment.non_maxima_supression_batch,
+                          dets, score, group[:-1])
@@ -1,7 +1,16 @@
+import hashlib
+import os
+from collections import OrderedDict
+
 import h5py
 import numpy as np
 
-from daps.utils.pooling import concat1d
+from daps.utils import instrument
+from daps.utils.cache import array_digest, array_fingerprint, content_key
+from daps.utils.cache import file_digest
+from daps.utils.pooling import concat1d, pca_projection, pool_and_project
+from daps.utils.pooling import pool_windows
+from daps.utils.pooling import PoolingIndex
 
 
 class C3D(object):
@@ -15,7 +24,10 @@ class C3D(object):
 
     """
     def __init__(self, filename, f_res=16, f_stride=8,
-                 pool_type='concat-32-mean', feat_id='c3d_features'):
+                 pool_type='concat-32-mean', feat_id='c3d_features',
+                 pool_index=False, index_file=None, cache=None,
+                 dtype=np.float64, pca_file=None, pca_dim=500, num_indices=1,
+                 save_index=True):
         """Set the interface with your HDF5 file
 
         Parameters
@@ -36,6 +48,39 @@ class C3D(object):
         feat_id : str, optional.
             HDF5-dataset of interest for each video. Change it, if your
             HDF5-file does not support our definition.
+        pool_index : bool, optional.
+            Pool windows with a per-video PoolingIndex (integral feature for
+            mean-pooling, sparse table for max-pooling). It is built lazily
+            the first time that a video is requested. It makes the cost of
+            pooling independent of the duration of the windows.
+        index_file : str, optional.
+            HDF5-file used to persist the pooling index of each video. It is
+            created if it does not exist.
+        cache : LRUCache, optional.
+            Cache of pooled batches of windows (check daps.utils.cache).
+            Batches already in the cache are neither read nor pooled again.
+            Share it among instances over the same file e.g. models with
+            different receptive fields.
+        dtype : dtype, optional.
+            Data type of pooled features. Use the floatX of DAPs to avoid
+            casting (copying) the batches fed to the model. Features stored
+            with lower precision e.g. float16 are upcast per batch.
+        pca_file : str, optional.
+            HDF5-file with PCA of the features (datasets U and x_mean) e.g.
+            data/models/pca_c3d_fc7_thumos14.hdf5. Use it to read raw fc7
+            features, they are projected on the fly. Mean pooling happens
+            before the projection (both are linear), thus only the pooled
+            regions of each window are projected.
+        pca_dim : int, optional.
+            Number of principal components kept.
+        num_indices : int, optional.
+            Max number of pooling indices (one per video and pooling) kept
+            in memory. The least recently used is evicted, and saved into
+            index_file, when a new one is required.
+        save_index : bool, optional.
+            Save the pooling indices built by this instance into index_file.
+            Disable it when several processes share the same index_file,
+            HDF5-files do not support concurrent writers.
 
         """
         self.filename = filename
@@ -44,7 +89,30 @@ class C3D(object):
         self.f_res = f_res
         self.f_stride = f_stride
         self.pool_type = pool_type
-
+        self.pool_index = pool_index
+        self.index_file = index_file
+        self.num_indices = num_indices
+        self.save_index = save_index
+        # (video-name, pool-type) -> [index, number of tables saved]
+        self._index = OrderedDict()
+        self.rows_read = 0
+        self.bytes_read = 0
+        self.cache = cache
+        self.dtype = np.dtype(dtype)
+        self.pca_file = pca_file
+        self.pca = None
+        # Number of components and digest of the basis, it identifies the
+        # projection in caches and saved indices
+        self._pca_id = None
+        if pca_file is not None:
+            self.pca = load_pca(pca_file, pca_dim, self.dtype)
+            self._pca_id = '{}-{}'.format(self.pca[0].shape[1],
+                                          file_digest(pca_file)[:16])
+        self._check_file()
+
+    def _check_file(self):
+        """Raise ValueError if the file is not valid.
+        """
         with h5py.File(self.filename, 'r') as fobj:
             if not fobj:
                 raise ValueError('Invalid type of file.')
@@ -59,9 +127,52 @@ class C3D(object):
         """
         if not self.fobj:
             raise ValueError('The object instance is not open.')
+        self.flush_index()
         self.fobj.close()
         self.fobj = None
 
+    def video_names(self):
+        """List of videos in the file.
+        """
+        if not self.fobj:
+            raise ValueError('The object instance is not open.')
+        return list(self.fobj.keys())
+
+    def num_features(self, video_name):
+        """Number of features (one per frame) of a video.
+        """
+        if not self.fobj:
+            raise ValueError('The object instance is not open.')
+        return self.fobj[video_name][self.feat_id].shape[0]
+
+    def feature_digest(self, video_name, sampled=False):
+        """SHA1 of the raw features of a video (check cache.array_digest).
+
+        All the features of the video are read, it identifies the video in
+        content-addressed caches e.g. results of a previous run.
+
+        Parameters
+        ----------
+        video_name : str.
+            Video identifier.
+        sampled : bool, optional.
+            Unsafe shortcut that hashes the size and modification time of
+            the file, the name of the dataset and a sample of its rows
+            (check cache.array_fingerprint). Edits of other rows that keep
+            the size and modification time of the file go unnoticed.
+
+        """
+        if not self.fobj:
+            raise ValueError('The object instance is not open.')
+        feat = self.fobj[video_name][self.feat_id]
+        if not sampled:
+            return array_digest(feat)
+        info = os.stat(self.filename)
+        return content_key(array_fingerprint(feat),
+                           filename=os.path.abspath(self.filename),
+                           size=info.st_size, mtime=info.st_mtime,
+                           dataset=(video_name, self.feat_id))
+
     def read_feat(self, video_name, f_init=None, duration=None):
         """Stack C3D features in memory.
 
@@ -99,11 +210,13 @@ class C3D(object):
 
         frames_of_interest = slice(f_init, f_end, self.f_stride)
         feat = self.fobj[video_name][self.feat_id][frames_of_interest, ...]
+        if self.pca is not None:
+            feat = pca_projection(feat, *self.pca)
         pooled_feat = self._feature_pooling(feat)
         return pooled_feat
 
     def read_feat_batch_from_video(self, video_name, f_init_array,
-                                   duration=512):
+                                   duration=512, out=None):
         """Read batch of C3D features from a video.
 
         Parameters
@@ -114,13 +227,16 @@ class C3D(object):
             list of initial frames.
         duration : int.
             Segment size.
+        out : ndarray, optional.
+            Preallocated array where the batch is placed e.g. to reuse it
+            among batches. It must have the shape of feat_stack.
 
         Returns
         -------
         feat_stack : ndarray
             stack feature representation as 3dim array of shape
-            [len(f_init_array), x, feat-dim]. Check feat_stack for details
-            about value of x.
+            [len(f_init_array), x, feat-dim] and type dtype. Check feat_stack
+            for details about value of x.
 
         """
         if not self.fobj:
@@ -130,32 +246,175 @@ class C3D(object):
         # Sanitize.
         f_init_array = np.array(f_init_array).astype(int)
         duration = int(duration)
+        if self.cache is not None and f_init_array.size > 0:
+            return self._cached_feat_batch(video_name, f_init_array,
+                                           duration, out)
+        return self._feat_batch(video_name, f_init_array, duration, out)
 
-        # Load all features associated to video-name.
-        raw_feat_stack = self.fobj[video_name][self.feat_id].value
-        n_segments = len(f_init_array)
+    def _feat_batch(self, video_name, f_init_array, duration, out=None):
+        """Read and pool a batch of windows. Check read_feat_batch_from_video
+        """
+        # Edges of each segment in terms of features.
+        windows = np.stack([f_init_array,
+                            f_init_array + duration - self.f_res + 1], axis=-1)
+
+        if self.pool_index and self.pool_type:
+            with instrument.stage('c3d.index', video=video_name):
+                index = self.get_pooling_index(video_name)
+            with instrument.stage('c3d.pool', video=video_name,
+                                  windows=len(windows)) as s:
+                feat_stack = self._pool(index, windows, self.pool_type,
+                                        out=out)
+                s.update(array_bytes=feat_stack.nbytes)
+            return feat_stack
+
+        # Load only the features sampled by the segments.
+        with instrument.stage('c3d.read', video=video_name) as s:
+            rows_read, bytes_read = self.rows_read, self.bytes_read
+            raw_feat_stack, windows, step = self._window_source(video_name,
+                                                                windows)
+            s.update(rows_read=self.rows_read - rows_read,
+                     bytes_read=self.bytes_read - bytes_read)
+        with instrument.stage('c3d.pool', video=video_name,
+                              windows=len(windows)) as s:
+            feat_stack = self._pool(raw_feat_stack, windows, self.pool_type,
+                                    step, out)
+            s.update(array_bytes=feat_stack.nbytes)
+        return feat_stack
 
-        # Set feat stack size.
-        d = raw_feat_stack.shape[1]
-        if self.pool_type is None or self.pool_type == '':
-            m = (duration - self.f_res)/self.f_stride + 1
-        elif self.pool_type == 'mean' or self.pool_type == 'max':
-            m = 1
-        elif 'concat' in self.pool_type:
-            _, levels, pool_type = self.pool_type.split('-')
-            m = int(levels)
-        else:
-            raise ValueError('Incorrect pool_type')
-        feat_stack = np.empty((n_segments, m, d))
+    def read_feat_batches_from_video(self, video_name, batches):
+        """Read several batches of windows of a video with a single read.
 
-        # Iterate over each segment.
-        for i, f_init in enumerate(f_init_array):
-            frames_of_interest = slice(
-                f_init, f_init + duration - self.f_res + 1, self.f_stride)
-            feat_stack[i, ...] = self._feature_pooling(
-                raw_feat_stack[frames_of_interest, :])
+        Features sampled by the windows of all the batches are read once and
+        each batch is pooled on its own e.g. for models with different
+        receptive fields. The cache and pooling index are not used.
 
-        return feat_stack
+        Parameters
+        ----------
+        video-name : str.
+            Video identifier.
+        batches : list of tuple
+            f_init_array, duration and pool_type of each batch. Check
+            read_feat_batch_from_video.
+
+        Returns
+        -------
+        feat_stacks : list of ndarray
+            Stack of features of each batch. Check read_feat_batch_from_video.
+
+        """
+        if not self.fobj:
+            raise ValueError('The object instance is not open.')
+        windows = []
+        for f_init_array, duration, _ in batches:
+            f_init_array = np.array(f_init_array).astype(int).reshape(-1)
+            windows.append(np.stack(
+                [f_init_array, f_init_array + int(duration) - self.f_res + 1],
+                axis=-1))
+        edges = np.cumsum([0] + [len(i) for i in windows])
+
+        with instrument.stage('c3d.read', video=video_name) as s:
+            rows_read, bytes_read = self.rows_read, self.bytes_read
+            raw_feat_stack, feat_windows, step = self._window_source(
+                video_name, np.vstack(windows))
+            s.update(rows_read=self.rows_read - rows_read,
+                     bytes_read=self.bytes_read - bytes_read)
+
+        feat_stacks = []
+        for i, (_, _, pool_type) in enumerate(batches):
+            with instrument.stage('c3d.pool', video=video_name,
+                                  windows=edges[i + 1] - edges[i]) as s:
+                feat_stack = self._pool(
+                    raw_feat_stack, feat_windows[edges[i]:edges[i + 1]],
+                    pool_type, step)
+                s.update(array_bytes=feat_stack.nbytes)
+            feat_stacks.append(feat_stack)
+        return feat_stacks
+
+    def _pool(self, feat, windows, pool_type, step=1, out=None):
+        """Pool windows over features, project them if there is a PCA.
+
+        Check pool_and_project for details about the arguments.
+
+        """
+        return pool_and_project(feat, windows, pool_type, step, self.dtype,
+                                self.pca, out)
+
+    def _cached_feat_batch(self, video_name, f_init_array, duration,
+                           out=None):
+        """Read and pool a batch of windows unless it is in the cache.
+
+        Entries are whole batches, thus the cache (and its spill folder)
+        holds one entry per video in a sliding-window run.
+
+        """
+        # Size and modification time identify the content of the file
+        info = os.stat(self.filename)
+        key = (self.filename, info.st_size, info.st_mtime, self.feat_id,
+               video_name, hashlib.sha1(f_init_array.tobytes()).hexdigest(),
+               duration, self.f_res, self.f_stride, self.pool_type,
+               self.dtype.name, self._pca_id)
+        with instrument.stage('c3d.cache', video=video_name,
+                              windows=len(f_init_array)) as s:
+            feat_stack = self.cache.get(key)
+            s.update(misses=int(feat_stack is None))
+        if feat_stack is None:
+            feat_stack = self._feat_batch(video_name, f_init_array, duration,
+                                          out)
+            self.cache.put(key, feat_stack.copy())
+            return feat_stack
+        if out is None:
+            return feat_stack.copy()
+        if out.shape != feat_stack.shape:
+            raise ValueError('Invalid shape of out.')
+        out[...] = feat_stack
+        return out
+
+    def get_pooling_index(self, video_name):
+        """Get pooling index of a video, build it if it does not exist.
+
+        Parameters
+        ----------
+        video-name : str.
+            Video identifier.
+
+        Returns
+        -------
+        index : PoolingIndex
+            Index over the features of the video sampled every f_stride. It
+            corresponds to the current pool_type (mean or max).
+
+        """
+        pool_type = self.pool_type.split('-')[-1]
+        key = (video_name, pool_type)
+        if key in self._index:
+            entry = self._index.pop(key)
+            self._index[key] = entry
+            return entry[0]
+        if not self.fobj:
+            raise ValueError('The object instance is not open.')
+
+        index, num_saved = None, 0
+        if self.index_file is not None:
+            index = self._load_index(video_name, pool_type)
+        if index is not None:
+            num_saved = len(index.tables)
+        else:
+            feat = self.fobj[video_name][self.feat_id][...]
+            if self.pca is not None and pool_type != 'mean':
+                feat = pca_projection(feat, *self.pca)
+            index = PoolingIndex(feat, self.f_stride, pool_type)
+        while self._index and len(self._index) >= self.num_indices:
+            old_key, old_entry = self._index.popitem(last=False)
+            self._save_index(old_key[0], *old_entry)
+        self._index[key] = [index, num_saved]
+        return index
+
+    def flush_index(self):
+        """Save tables of the pooling indices in memory into index_file.
+        """
+        for (video_name, _), entry in self._index.items():
+            entry[1] = self._save_index(video_name, *entry)
 
     def _feature_pooling(self, x):
         """Compute pooling of a feature vector.
@@ -191,3 +450,260 @@ class C3D(object):
             _, level, pool_type = self.pool_type.split('-')
             x = concat1d(x, int(level), pool_type)
             return x.reshape((-1, d))
+
+    def _window_source(self, video_name, windows):
+        """Features sampled by a set of windows. Check _read_windows.
+
+        Returns
+        -------
+        feat : ndarray
+            [r, d] array with features.
+        feat_windows : ndarray
+            [k, 2] array of windows edges over feat.
+        step : int
+            Sampling stride of the rows of each window.
+
+        """
+        feat, feat_windows = self._read_windows(video_name, windows)
+        return feat, feat_windows, 1
+
+    def _read_windows(self, video_name, windows):
+        """Read the union of features sampled by a set of windows.
+
+        Features are read with strided hyperslabs, one per group of windows
+        sharing the same phase (initial row modulo f_stride). Windows
+        separated by less than a chunk of the HDF5-dataset are merged into
+        the same read because that chunk is read from disk anyway.
+
+        Parameters
+        ----------
+        video-name : str.
+            Video identifier.
+        windows : ndarray.
+            [k, 2] array of windows edges [row-init, row-end) over the
+            features of the video. Rows are sampled every f_stride inside each
+            window.
+
+        Returns
+        -------
+        feat : ndarray
+            [r, d] array with the features read.
+        feat_windows : ndarray
+            [k, 2] array of windows edges over feat. Windows are contiguous
+            i.e. its rows must be sampled with stride 1.
+
+        """
+        dset = self.fobj[video_name][self.feat_id]
+        num_feat = dset.shape[0]
+        step = self.f_stride
+        max_gap = max(step, dset.chunks[0] if dset.chunks else 1)
+
+        w_init = windows[:, 0]
+        w_end = np.minimum(windows[:, 1], num_feat)
+        lengths = np.maximum(0, (w_end - w_init + step - 1) // step)
+        w_last = w_init + (lengths - 1) * step
+
+        # Group windows into strided segments [row-init, row-last]
+        feat_windows = np.zeros_like(windows)
+        segments, offset = [], 0
+        for i in np.lexsort((w_init, w_init % step)):
+            if lengths[i] == 0:
+                continue
+            if (not segments or
+                    w_init[i] % step != segments[-1][0] % step or
+                    w_init[i] - segments[-1][1] > max_gap):
+                if segments:
+                    offset += (segments[-1][1] - segments[-1][0]) // step + 1
+                segments.append([w_init[i], w_last[i], offset])
+            segments[-1][1] = max(segments[-1][1], w_last[i])
+            feat_windows[i, 0] = offset + (w_init[i] - segments[-1][0]) // step
+            feat_windows[i, 1] = feat_windows[i, 0] + lengths[i]
+
+        num_rows = 0
+        if segments:
+            num_rows = offset + (segments[-1][1] - segments[-1][0]) // step + 1
+        feat = np.empty((num_rows,) + dset.shape[1:], dtype=dset.dtype)
+        for row_init, row_last, offset in segments:
+            n = (row_last - row_init) // step + 1
+            feat[offset:offset + n, ...] = dset[row_init:row_last + 1:step, ...]
+
+        self.rows_read += feat.shape[0]
+        self.bytes_read += feat.nbytes
+        return feat, feat_windows
+
+    def _index_key(self, video_name, pool_type):
+        """HDF5-path of the pooling index of a video in index_file.
+        """
+        key = '{}/{}-{}-{}'.format(video_name, self.feat_id, pool_type,
+                                   self.f_stride)
+        if self.pca is not None and pool_type != 'mean':
+            key += '-pca{}'.format(self._pca_id)
+        return key
+
+    def _load_index(self, video_name, pool_type):
+        """Load pooling index of a video from index_file.
+
+        Returns
+        -------
+        index : PoolingIndex or None
+            None if the index of the video is not in the file.
+
+        """
+        key = self._index_key(video_name, pool_type)
+        try:
+            fobj = h5py.File(self.index_file, 'r')
+        except IOError:
+            return None
+        with fobj:
+            if key not in fobj:
+                return None
+            grp = fobj[key]
+            tables = [grp[str(i)][...] for i in range(len(grp))]
+        return PoolingIndex(step=self.f_stride, pool_type=pool_type,
+                            tables=tables)
+
+    def _save_index(self, video_name, index, num_saved=0):
+        """Append tables of pooling index, not saved yet, into index_file.
+
+        Returns
+        -------
+        num_saved : int
+            Number of tables of the index in index_file.
+
+        """
+        if (self.index_file is None or not self.save_index or
+                num_saved >= len(index.tables)):
+            return num_saved
+        key = self._index_key(video_name, index.pool_type)
+        with h5py.File(self.index_file, 'a') as fobj:
+            grp = fobj.require_group(key)
+            for i in range(len(grp), len(index.tables)):
+                grp.create_dataset(str(i), data=index.tables[i], chunks=True)
+        return len(index.tables)
+
+
+def load_pca(filename, num_dims=500, dtype=np.float64):
+    """Principal components and mean of features in an HDF5-file
+
+    Parameters
+    ----------
+    filename : str
+        Fullpath of HDF5-file with datasets U [D x D'] and x_mean [D].
+    num_dims : int, optional
+        Number of principal components kept.
+    dtype : dtype, optional
+        Data type of the outputs.
+
+    Returns
+    -------
+    U : ndarray
+        [D x num_dims] ndarray with principal components.
+    x_mean : ndarray
+        [D] ndarray with mean of the features.
+
+    """
+    with h5py.File(filename, 'r') as f:
+        U = f['U'][:, :num_dims].astype(dtype)
+        x_mean = f['x_mean'][...].reshape(-1).astype(dtype)
+    return U, x_mean
+
+
+def index_filename(filename):
+    """Index of a file created by pack_features.
+    """
+    return os.path.splitext(filename)[0] + '_index.npz'
+
+
+def pack_features(c3d_hdf5, filename, feat_id='c3d_features',
+                  video_names=None, dtype=None):
+    """Pack features of all the videos into a contiguous npy-file
+
+    The index with the name of each video and the offset of its first
+    feature is saved next to it. Check index_filename and C3DMemmap.
+
+    Parameters
+    ----------
+    c3d_hdf5 : str.
+        HDF5-file with C3D features of each video.
+    filename : str.
+        Fullpath of npy-file.
+    feat_id : str, optional.
+        HDF5-dataset of interest for each video.
+    video_names : list, optional.
+        Videos to pack. By default, all the videos in c3d_hdf5.
+    dtype : dtype, optional.
+        Data type of the packed features. By default, the data type of the
+        features in c3d_hdf5 (the widest one if they differ), thus C3D and
+        C3DMemmap read the same values. Pass a narrower one e.g. float16 to
+        trade precision for size.
+
+    """
+    with h5py.File(c3d_hdf5, 'r') as fobj:
+        if video_names is None:
+            video_names = list(fobj.keys())
+        shapes = [fobj[i][feat_id].shape for i in video_names]
+        if dtype is None:
+            dtype = np.result_type(np.float16, *[fobj[i][feat_id].dtype
+                                                 for i in video_names])
+        offset = np.cumsum([0] + [i[0] for i in shapes])
+        feat_dim = shapes[0][1] if shapes else 0
+        data = np.lib.format.open_memmap(
+            filename, mode='w+', dtype=dtype,
+            shape=(int(offset[-1]), feat_dim))
+        for i, video_name in enumerate(video_names):
+            if offset[i + 1] > offset[i]:
+                data[offset[i]:offset[i + 1], :] = fobj[video_name][feat_id]
+        data.flush()
+        del data
+    np.savez(index_filename(filename), offset=offset,
+             video_names=np.array(video_names, dtype='S'))
+
+
+class C3DMemmap(C3D):
+    """C3D features packed into a contiguous npy-file
+
+    Alternative to C3D for files created with pack_features. The features
+    of each video are a view of a read-only memory map. Thus, there are no
+    HDF5 lookups, windows are pooled without copying the raw features and
+    concurrent processes share the page cache.
+
+    """
+    def _check_file(self):
+        """Raise ValueError if the file is not a npy-file with an index.
+        """
+        if (not os.path.isfile(self.filename) or
+                not os.path.isfile(index_filename(self.filename))):
+            raise ValueError('Invalid type of file.')
+        with open(self.filename, 'rb') as f:
+            try:
+                np.lib.format.read_magic(f)
+            except ValueError:
+                raise ValueError('Invalid type of file.')
+
+    def open_instance(self):
+        """Map file and keep it till a close call.
+        """
+        data = np.load(self.filename, mmap_mode='r')
+        with np.load(index_filename(self.filename)) as f:
+            video_names = f['video_names'].astype(str)
+            offset = f['offset']
+        # Same layout as the HDF5-file: fobj[video-name][feat-id]
+        self.fobj = dict(
+            (name, {self.feat_id: data[offset[i]:offset[i + 1], :]})
+            for i, name in enumerate(video_names))
+
+    def close_instance(self):
+        """Release memory map.
+        """
+        if self.fobj is None:
+            raise ValueError('The object instance is not open.')
+        self.flush_index()
+        self.fobj = None
+
+    def _window_source(self, video_name, windows):
+        """Features of the video as a view, windows sample them every f_stride
+        """
+        feat = self.fobj[video_name][self.feat_id]
+        windows = windows.copy()
+        windows[:, 1] = np.minimum(windows[:, 1], feat.shape[0])
+        return feat, windows, self.f_stride
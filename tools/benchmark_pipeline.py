@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+
+Benchmark each stage of the proposal pipeline over synthetic data
+
+"""
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from daps import DAPs
+from daps.utils.lstm import random_param_values
+from daps.sequence_encoder import FLOATX
+from daps.utils.pooling import pool_windows
+from daps.visual_encoder import pack_features
+from generate_proposals import generate_proposals, proposals_dataframe
+from generate_proposals import retrieve_proposals_batch, setup_visual_encoder
+from generate_proposals import video_windows
+
+STAGES = ('features', 'pooling', 'forward', 'nms', 'total')
+SWEEP_PARAMETERS = ('seq_encoder_stride', 'pool_type', 'batch_size',
+                    'num_outputs')
+# Setup shared by all the configurations of a benchmark, results recorded
+# with another setup are not comparable
+SETUP_PARAMETERS = ('num_videos', 'total_features', 'feat_dim',
+                    'seq_encoder_length', 'seq_encoder_width',
+                    'seq_encoder_depth', 'backend', 'floatx',
+                    'visual_encoder')
+
+
+def input_parser():
+    description = ('Time each stage of the proposal pipeline (reading and '
+                   'pooling C3D features, forward pass of DAPs and NMS) '
+                   'over synthetic videos.')
+    epilog = ('Note: Pass several values to an argument of the sweep to '
+              'benchmark all their combinations.')
+    p = ArgumentParser(description=description, epilog=epilog,
+                       formatter_class=ArgumentDefaultsHelpFormatter)
+    # Synthetic data
+    p.add_argument('-nv', '--num-videos', default=None, type=int,
+                   help='Number of synthetic videos (16 if not given)')
+    p.add_argument('-nf', '--num-features', default=None, type=int,
+                   help=('Number of C3D features (frames) per video (4096 '
+                         'if not given)'))
+    p.add_argument('-fd', '--feat-dim', default=None, type=int,
+                   help=('Dimensionality of visual representation (500 if '
+                         'not given)'))
+    p.add_argument('-ic3d', '--c3d-hdf5', default=None,
+                   help=('HDF5-file with synthetic features. It is created '
+                         'if it does not exist, otherwise its videos and '
+                         'feature dimension are used (ignoring -nv, -nf, '
+                         '-fd). By default, a temporary file'))
+    p.add_argument('-mm', '--memmap', action='store_true',
+                   help=('Pack features into a npy-file and read them with '
+                         'C3DMemmap instead of C3D'))
+    p.add_argument('-s', '--seed', default=0, type=int,
+                   help='Seed of random number generator')
+    # Sweep
+    p.add_argument('-ses', '--seq-encoder-stride', default=[64], type=int,
+                   nargs='+', help='Sliding stride of sequence encoder')
+    p.add_argument('-vept', '--pool-type', default=['concat-32-mean'],
+                   nargs='+', help='Pooling strategy for C3D features')
+    p.add_argument('-bs', '--batch-size', default=[512], type=int,
+                   nargs='+', help='Max number of windows per forward pass')
+    p.add_argument('-nppsl', '--num-outputs', default=[64], type=int,
+                   nargs='+', help='Number of proposals per window')
+    # DAPs
+    p.add_argument('-sel', '--seq-encoder-length', default=32, type=int,
+                   help='Length of sequence encoder')
+    p.add_argument('-sew', '--seq-encoder-width', default=256, type=int,
+                   help='Number of hidden units per layer')
+    p.add_argument('-sed', '--seq-encoder-depth', default=1, type=int,
+                   help='Depth of sequence encoder')
+    p.add_argument('-seb', '--seq-encoder-backend', default='numpy',
+                   choices=['theano', 'numpy'],
+                   help='Inference engine of sequence encoder')
+    # Measurement
+    p.add_argument('-r', '--repeat', default=3, type=int,
+                   help='Number of repetitions of each measurement')
+    p.add_argument('-oj', '--output-json', default=None,
+                   help='JSON-file to save results')
+    p.add_argument('-oc', '--output-csv', default=None,
+                   help='CSV-file to save results')
+    p.add_argument('-ib', '--baseline', default=None,
+                   help='JSON-file with results to compare against')
+    p.add_argument('-t', '--tolerance', default=0.1, type=float,
+                   help=('Max relative slow-down with respect to the '
+                         'baseline before reporting a regression'))
+    return p
+
+
+def synthetic_c3d(filename, num_videos=16, num_features=4096, feat_dim=500,
+                  feat_id='c3d_features', seed=0):
+    """Create HDF5-file with random C3D features
+
+    Parameters
+    ----------
+    filename : str
+        Fullpath of HDF5-file.
+    num_videos : int, optional
+        Number of videos.
+    num_features : int, optional
+        Number of features (one per frame) of each video.
+    feat_dim : int, optional
+        Dimensionality of features.
+    feat_id : str, optional
+        HDF5-dataset of each video.
+    seed : int, optional
+        Seed of random number generator.
+
+    Returns
+    -------
+    video_names : list of str
+        Name of each video.
+
+    """
+    rng = np.random.RandomState(seed)
+    video_names = ['video_{:05d}'.format(i) for i in range(num_videos)]
+    with h5py.File(filename, 'w') as fobj:
+        for video_name in video_names:
+            grp = fobj.create_group(video_name)
+            grp.create_dataset(feat_id, data=rng.randn(
+                num_features, feat_dim).astype(np.float32))
+    return video_names
+
+
+def timeit(fun, repeat=3):
+    """Time a function
+
+    Returns
+    -------
+    output : object
+        Output of the last call.
+    timings : list of float
+        Elapsed time (in seconds) of each call.
+
+    """
+    timings, output = [], None
+    for _ in range(repeat):
+        start_time = time.time()
+        output = fun()
+        timings.append(time.time() - start_time)
+    return output, timings
+
+
+def benchmark(c3d_file, video_names, seq_encoder_stride=64,
+              pool_type='concat-32-mean', batch_size=512, num_outputs=64,
+              seq_encoder_length=32, seq_encoder_width=256,
+              seq_encoder_depth=1, seq_encoder_backend='numpy', feat_dim=500,
+              repeat=3, seed=0):
+    """Time each stage of the pipeline for a configuration
+
+    Returns
+    -------
+    records : list of dict
+        Timing of each stage with the configuration.
+
+    """
+    visual_encoder = setup_visual_encoder(c3d_file, 16, 8, pool_type,
+                                          dtype=FLOATX)
+    visual_encoder.open_instance()
+    receptive_field = seq_encoder_length * visual_encoder.f_res
+    sequence_encoder = DAPs(num_outputs, seq_encoder_length,
+                            seq_encoder_depth, seq_encoder_width, feat_dim,
+                            receptive_field, backend=seq_encoder_backend)
+    sequence_encoder.set_param_values(random_param_values(
+        num_outputs, seq_encoder_depth, seq_encoder_width, feat_dim,
+        scale=0.01, seed=seed))
+    sequence_encoder.compile()
+
+    windows = [video_windows(visual_encoder, i, seq_encoder_length,
+                             seq_encoder_stride) for i in video_names]
+    total_features = sum(visual_encoder.num_features(i) for i in video_names)
+    num_windows = sum(i[0].size for i in windows)
+
+    def read_features():
+        return [visual_encoder.read_feat_batch_from_video(
+            name, f_init_arr, duration=rf)
+            for name, (f_init_arr, rf) in zip(video_names, windows)]
+
+    raw = [visual_encoder.fobj[i][visual_encoder.feat_id][...]
+           for i in video_names]
+
+    def pool_features():
+        for feat, (f_init_arr, rf) in zip(raw, windows):
+            win = np.stack([f_init_arr, f_init_arr + rf - visual_encoder.f_res
+                            + 1], axis=1)
+            pool_windows(feat, win, pool_type, visual_encoder.f_stride,
+                         FLOATX)
+
+    representation, timings = {}, {}
+    representation['features'], timings['features'] = timeit(
+        read_features, repeat)
+    _, timings['pooling'] = timeit(pool_features, repeat)
+
+    def forward():
+        stream = ((name, feat, f_init_arr, rf) for name, feat, (
+            f_init_arr, rf) in zip(video_names, representation['features'],
+                                   windows))
+        return zip(*retrieve_proposals_batch(sequence_encoder, stream,
+                                             batch_size))
+    results, timings['forward'] = timeit(forward, repeat)
+    df, timings['nms'] = timeit(lambda: proposals_dataframe(*results),
+                                repeat)
+    _, timings['total'] = timeit(lambda: generate_proposals(
+        visual_encoder, sequence_encoder, video_names, seq_encoder_length,
+        seq_encoder_stride, batch_size, verbose=False), repeat)
+    visual_encoder.close_instance()
+
+    config = {'seq_encoder_stride': seq_encoder_stride,
+              'pool_type': pool_type, 'batch_size': batch_size,
+              'num_outputs': num_outputs, 'num_videos': len(video_names),
+              'num_windows': num_windows, 'num_proposals': len(df),
+              'total_features': total_features, 'feat_dim': feat_dim,
+              'seq_encoder_length': seq_encoder_length,
+              'seq_encoder_width': seq_encoder_width,
+              'seq_encoder_depth': seq_encoder_depth,
+              'backend': seq_encoder_backend, 'floatx': FLOATX,
+              'visual_encoder': type(visual_encoder).__name__}
+    records = []
+    for stage in STAGES:
+        record = dict(config, stage=stage, time_min=min(timings[stage]),
+                      time_mean=np.mean(timings[stage]))
+        record['videos_per_s'] = len(video_names) / max(
+            record['time_min'], 1e-8)
+        records.append(record)
+    return records
+
+
+def compare_baseline(df, baseline, tolerance=0.1):
+    """Compare results against a baseline
+
+    Parameters
+    ----------
+    df : DataFrame
+        Results of benchmark.
+    baseline : DataFrame
+        Results of a previous benchmark.
+    tolerance : float, optional
+        Max relative slow-down before reporting a regression.
+
+    Returns
+    -------
+    comparison : DataFrame
+        Results present in both tables with their speed-up (ratio of
+        baseline over current time) and regression flag.
+
+    Raises
+    ------
+    ValueError
+        The baseline was recorded with another setup (check
+        SETUP_PARAMETERS) or it does not record its setup.
+
+    """
+    keys = list(SWEEP_PARAMETERS) + list(SETUP_PARAMETERS) + ['stage']
+    missing = [i for i in keys if i not in baseline]
+    if missing:
+        raise ValueError('Baseline does not record: {}'.format(
+            ', '.join(missing)))
+    comparison = pd.merge(df, baseline[keys + ['time_min']], on=keys,
+                          suffixes=('', '_baseline'))
+    if len(comparison) == 0 and len(df) > 0 and len(baseline) > 0:
+        setup = list(SETUP_PARAMETERS)
+        raise ValueError('Baseline recorded with another setup:\n{}'.format(
+            pd.concat([df[setup].drop_duplicates(),
+                       baseline[setup].drop_duplicates()],
+                      keys=['current', 'baseline'])))
+    comparison['speedup'] = (comparison['time_min_baseline'] /
+                             comparison['time_min'].clip(lower=1e-8))
+    comparison['regression'] = (comparison['time_min'] >
+                                comparison['time_min_baseline'] *
+                                (1 + tolerance))
+    return comparison
+
+
+def main(num_videos=None, num_features=None, feat_dim=None, c3d_hdf5=None,
+         seed=0, seq_encoder_stride=(64,), pool_type=('concat-32-mean',),
+         batch_size=(512,), num_outputs=(64,), seq_encoder_length=32,
+         seq_encoder_width=256, seq_encoder_depth=1,
+         seq_encoder_backend='numpy', repeat=3, output_json=None,
+         output_csv=None, baseline=None, tolerance=0.1, memmap=False):
+    tmp_dir = None
+    if c3d_hdf5 is None:
+        tmp_dir = tempfile.mkdtemp()
+        c3d_hdf5 = os.path.join(tmp_dir, 'c3d_synthetic.hdf5')
+    if os.path.isfile(c3d_hdf5):
+        ignored = [name for name, value in [
+            ('num-videos', num_videos), ('num-features', num_features),
+            ('feat-dim', feat_dim)] if value is not None]
+        if ignored:
+            warnings.warn(('Using the videos and feature dimension of the '
+                           'existing {}, ignoring: {}').format(
+                               c3d_hdf5, ', '.join(ignored)), RuntimeWarning)
+        with h5py.File(c3d_hdf5, 'r') as f:
+            video_names = sorted(f.keys())
+            # The model and the reported setup follow the file
+            feat_dim = f[video_names[0]]['c3d_features'].shape[1]
+    else:
+        print 'Creating synthetic C3D features'
+        feat_dim = feat_dim or 500
+        video_names = synthetic_c3d(c3d_hdf5, num_videos or 16,
+                                    num_features or 4096, feat_dim,
+                                    seed=seed)
+    c3d_file = c3d_hdf5
+    if memmap:
+        c3d_file = os.path.splitext(c3d_hdf5)[0] + '.npy'
+        if not os.path.isfile(c3d_file):
+            print 'Packing C3D features'
+            pack_features(c3d_hdf5, c3d_file, video_names=video_names)
+
+    records = []
+    try:
+        for args in itertools.product(seq_encoder_stride, pool_type,
+                                      batch_size, num_outputs):
+            config = dict(zip(SWEEP_PARAMETERS, args))
+            print 'Benchmarking {}'.format(config)
+            records += benchmark(
+                c3d_file, video_names, seq_encoder_length=seq_encoder_length,
+                seq_encoder_width=seq_encoder_width,
+                seq_encoder_depth=seq_encoder_depth,
+                seq_encoder_backend=seq_encoder_backend, feat_dim=feat_dim,
+                repeat=repeat, seed=seed, **config)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    df = pd.DataFrame(records)
+    print df.pivot_table(index=list(SWEEP_PARAMETERS), columns='stage',
+                         values='time_min')[list(STAGES)]
+    if output_json is not None:
+        with open(output_json, 'w') as f:
+            json.dump(records, f, indent=1, sort_keys=True)
+    if output_csv is not None:
+        df.to_csv(output_csv, index=None)
+
+    if baseline is not None:
+        with open(baseline) as f:
+            comparison = compare_baseline(df, pd.DataFrame(json.load(f)),
+                                          tolerance)
+        print comparison[list(SWEEP_PARAMETERS) + [
+            'stage', 'time_min', 'time_min_baseline', 'speedup']]
+        if comparison['regression'].any():
+            print 'Regression with respect to baseline'
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    p = input_parser()
+    sys.exit(main(**vars(p.parse_args())))
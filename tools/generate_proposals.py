@@ -4,7 +4,9 @@
 Generate action proposals for video
 
 """
+import multiprocessing
 import os
+import time
 import warnings
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
@@ -12,8 +14,20 @@ import h5py
 import numpy as np
 import pandas as pd
 
-from daps import C3D, DAPs
-from daps.utils.segment import non_maxima_supression
+from daps import C3D, C3DMemmap, DAPs
+from daps.sequence_encoder import compiled_key, FLOATX, model_architecture
+from daps.utils import instrument
+from daps.utils.cache import content_key, file_digest, LRUCache
+from daps.utils.cache import ResultCache
+from daps.utils.io import ProposalWriter
+from daps.utils.prefetch import Prefetcher
+from daps.utils.segment import non_maxima_supression_batch
+
+# Overlap threshold of the non-maxima suppression of each video
+NMS_OVERLAP = 0.7
+# Bump it when the proposals change without a change of the parameters or
+# inputs in the key of the result cache, it invalidates previous entries
+RESULT_CACHE_VERSION = 1
 
 
 def input_parser():
@@ -24,29 +38,96 @@ def input_parser():
     p = ArgumentParser(description=description, epilog=epilog,
                        formatter_class=ArgumentDefaultsHelpFormatter)
     # Video arguments
-    p.add_argument('-iv', '--video-name', required=True,
-                   help='Name of video-id in your HDF5-file with C3D features')
+    p.add_argument('-iv', '--video-name', nargs='+', default=None,
+                   help=('Name of video-id in your HDF5-file with C3D '
+                         'features. Pass several names to process them in '
+                         'batch mode'))
+    p.add_argument('-ivl', '--video-list', default=None,
+                   help='Text file with a video-id per line (batch mode)')
+    p.add_argument('-iav', '--all-videos', action='store_true',
+                   help='Process all the videos in the HDF5-file (batch mode)')
     p.add_argument('-ic3d', '--c3d-hdf5', required=True,
-                   help='HDF5 file with features for each video')
-    p.add_argument('-imd', '--model-file', required=True,
-                   help='npz file with sequence encoder parameters')
-    p.add_argument('-iaf', '--anchors-hdf5', default='non-existent.hdf5',
-                   help='HDF5 file with anchor segments')
+                   help=('HDF5 file with features for each video or npy '
+                         'file created by tools/pack_c3d_features.py'))
+    p.add_argument('-imd', '--model-file', required=True, nargs='+',
+                   help=('npz file with sequence encoder parameters. Pass '
+                         'several files to run them as an ensemble: the '
+                         'features of each video are read once, the '
+                         'architecture is inferred from each file and the '
+                         'proposals of all the models share a single NMS'))
+    p.add_argument('-iaf', '--anchors-hdf5', default=['non-existent.hdf5'],
+                   nargs='+',
+                   help='HDF5 file with anchor segments (one per model)')
     # Output arguments
     p.add_argument('-io', '--output-csv', default='',
-                   help=('Filename to save proposals of video as CSV-file. If '
-                         'empty "", it uses the same video-name'))
+                   help=('Filename to save proposals of video (format given '
+                         'by -iof). If empty "", it uses the same video-name '
+                         'or proposals in batch mode'))
+    p.add_argument('-iof', '--output-format', default='csv',
+                   choices=['csv', 'hdf5'],
+                   help=('Format of output file. hdf5 stores the proposals '
+                         'of all the videos in compressed columns with an '
+                         'index to read each video on its own'))
     p.add_argument('-c', '--clobber', action='store_true',
                    help='Overwrite outputs')
+    p.add_argument('-rcd', '--result-cache-dir', default=None,
+                   help=('Folder to cache the proposals of each video. '
+                         'Re-runs only process videos whose features, '
+                         'model, anchors or parameters changed'))
+    p.add_argument('-rcb', '--result-cache-bytes', default=0, type=int,
+                   help=('Max bytes of the result cache, least recently '
+                         'used videos are removed first. 0 means no limit'))
+    p.add_argument('-rcsd', '--result-cache-sampled-digest',
+                   action='store_true',
+                   help=('UNSAFE. Identify videos in the result cache by '
+                         'size and mtime of the C3D file, dataset name and a '
+                         'sample of rows instead of all their features. '
+                         'Edits of other rows that keep size and mtime of '
+                         'the file serve stale proposals'))
     # DAPs arguments
     p.add_argument('-ses', '--seq-encoder-stride', default=64, type=int,
                    help='Sliding stride for sequence encoder along the video')
-    p.add_argument('-sel', '--seq-encoder-length', default=32, type=int,
-                   help='Length of sequence encoder')
-    p.add_argument('-sew', '--seq-encoder-width', default=256, type=int,
-                   help='Number of hidden units per layer')
-    p.add_argument('-sed', '--seq-encoder-depth', default=1, type=int,
-                   help='Depth of sequence encoder')
+    p.add_argument('-sel', '--seq-encoder-length', default=[32], type=int,
+                   nargs='+',
+                   help='Length of sequence encoder (one per model)')
+    p.add_argument('-sew', '--seq-encoder-width', default=None, type=int,
+                   help=('Number of hidden units per layer (256 if not '
+                         'given). Ensembles infer it from each file'))
+    p.add_argument('-sed', '--seq-encoder-depth', default=None, type=int,
+                   help=('Depth of sequence encoder (1 if not given). '
+                         'Ensembles infer it from each file'))
+    p.add_argument('-seb', '--seq-encoder-backend', default='theano',
+                   choices=['theano', 'numpy'],
+                   help=('Inference engine of sequence encoder. numpy does '
+                         'not require Theano and has no compilation step'))
+    p.add_argument('-secd', '--seq-encoder-compiled-dir', default=None,
+                   help=('Folder to cache compiled sequence encoders. Warm '
+                         'runs skip building and compiling the model'))
+    p.add_argument('-bs', '--batch-size', default=512, type=int,
+                   help=('Max number of windows, possibly from several '
+                         'videos, per forward pass of the sequence encoder'))
+    p.add_argument('-semb', '--seq-encoder-micro-batch', default=None,
+                   type=int,
+                   help=('Max number of windows per call of the network '
+                         'inside each forward pass. By default, all of them'))
+    p.add_argument('-semm', '--seq-encoder-max-memory', default=None,
+                   type=int,
+                   help=('Max bytes of temporary arrays per call of the '
+                         'network, it caps the micro-batch size'))
+    p.add_argument('-seat', '--seq-encoder-autotune', action='store_true',
+                   help=('Pick the micro-batch size with the best measured '
+                         'throughput on this machine'))
+    p.add_argument('-nw', '--num-workers', default=1, type=int,
+                   help=('Number of processes sharing the videos. The '
+                         'sequence encoder is loaded once and shared with '
+                         'all of them (Theano on CPU or numpy backend)'))
+    p.add_argument('-pf', '--prefetch', default=0, type=int,
+                   help=('Number of videos read ahead on a background '
+                         'thread while the sequence encoder runs. 0 reads '
+                         'them on demand'))
+    p.add_argument('-il', '--instrument-log', default=None,
+                   help=('JSON-lines file to log wall time and metrics of '
+                         'each stage of the pipeline'))
     # Extra arguments
     p.add_argument('-vefr', '--c3d-f-res', default=16, type=int,
                    help='temporal resolution of C3D')
@@ -56,94 +137,732 @@ def input_parser():
                    help='Pooling strategy for C3D features')
     p.add_argument('-vefd', '--c3d-feat-dim', default=500, type=int,
                    help='Dimensionality of visual representation')
+    p.add_argument('-vecd', '--c3d-cache-dir', default=None,
+                   help=('Folder to spill pooled windows evicted from '
+                         'memory (one file per video). Re-runs over the '
+                         'same videos, e.g. with other models of the same '
+                         'length or NMS setup, skip reading and pooling. '
+                         'Requires --c3d-cache-bytes'))
+    p.add_argument('-vecb', '--c3d-cache-bytes', default=0, type=int,
+                   help=('Max bytes of pooled windows cached in memory per '
+                         'process'))
+    p.add_argument('-vepca', '--c3d-pca-file', default=None,
+                   help=('HDF5 file with PCA of raw C3D features e.g. '
+                         'data/models/pca_c3d_fc7_thumos14.hdf5. Features '
+                         'are reduced to --c3d-feat-dim on the fly'))
     p.add_argument('-vefi', '--c3d-feat-id', default='c3d_features',
                    help=('id used for HDF5-dataset corresponding to C3D '
                          'features'))
     return p
 
 
-def main(video_name, c3d_hdf5, model_file, anchors_hdf5='non-existent',
-         output_csv=None, clobber=False, seq_encoder_stride=64,
-         num_proposals_per_seq_length=64, seq_encoder_length=32,
-         seq_encoder_depth=1, seq_encoder_width=256, c3d_f_res=16,
-         c3d_f_stride=8, c3d_pool_type='concat-32-mean', c3d_feat_dim=500,
-         c3d_feat_id='c3d_features'):
-    # Setup DAPs model
-    # Infer receptive-field in terms of number of frames
-    daps_receptive_field = seq_encoder_length * c3d_f_res
+def load_anchors(anchors_hdf5):
+    """Return anchors in HDF5-file or None if it does not exist"""
+    anchors = None
+    if os.path.exists(anchors_hdf5):
+        with h5py.File(anchors_hdf5) as f:
+            anchors = f['anchors'].value
+    return anchors
 
-    # Visual Enconder
-    print 'Setup interface with visual encoder'
-    visual_encoder = C3D(c3d_hdf5, c3d_f_res, c3d_f_stride, c3d_pool_type,
-                         c3d_feat_id)
-    visual_encoder.open_instance()
+
+def setup_sequence_encoder(model_file, anchors=None, num_outputs=64,
+                           seq_length=32, depth=1, width=256, input_size=500,
+                           receptive_field=512, backend='theano',
+                           compiled_dir=None):
+    """Instantiate a compiled DAPs model
+
+    If compiled_dir is given, the compiled model is loaded from there when
+    it is available, otherwise it is compiled and saved there.
+
+    """
+    compiled_file = None
+    if compiled_dir is not None:
+        key = compiled_key(num_outputs, seq_length, depth, width, input_size,
+                           backend)
+        compiled_file = os.path.join(compiled_dir, 'daps-{}-{}.pkl'.format(
+            key[:16], file_digest(model_file)[:16]))
+        if os.path.isfile(compiled_file):
+            print 'Loading compiled sequence encoder'
+            return DAPs.load_compiled(compiled_file, receptive_field, anchors)
+
+    print 'Setup sequence encoder'
+    sequence_encoder = DAPs(num_outputs, seq_length, depth, width, input_size,
+                            receptive_field, anchors, backend=backend)
+    print 'Loading sequence encoder model'
+    sequence_encoder.load_model(model_file)
+    print 'Compiling sequence encoder'
+    sequence_encoder.compile()
+
+    if compiled_file is not None:
+        if not os.path.isdir(compiled_dir):
+            os.makedirs(compiled_dir)
+        sequence_encoder.save_compiled(compiled_file)
+    return sequence_encoder
+
+
+def sliding_windows(num_c3d_features, c3d_f_res=16, seq_encoder_length=32,
+                    seq_encoder_stride=64):
+    """Initial frame of each window of DAPs along a video
+
+    Parameters
+    ----------
+    num_c3d_features : int
+        Number of C3D features of the video (one per frame).
+    c3d_f_res : int, optional
+        Temporal resolution of C3D.
+    seq_encoder_length : int, optional
+        Length of sequence encoder.
+    seq_encoder_stride : int, optional
+        Sliding stride for sequence encoder along the video.
+
+    Returns
+    -------
+    f_init_arr : ndarray
+        1d-ndarray with initial frame of each window.
+    receptive_field : int
+        Receptive field (in frames) of DAPs for this video.
+
+    """
+    daps_receptive_field = seq_encoder_length * c3d_f_res
 
     # Infer video length (it assumes C3D were densely extracted at every frame)
-    num_c3d_features = visual_encoder.fobj[video_name][c3d_feat_id].shape[0]
     video_length = num_c3d_features + c3d_f_res
-    # If num-frames less than DAPs-res, change t_stride
     if video_length < seq_encoder_length:
         raise ValueError('video-length < seq-encoder-time-steps.\nWe never '
                          'consider to create proposals for short clips')
     elif video_length < daps_receptive_field:
         warnings.warn(('video-length < DAPs-temporal-span. Increasing '
                        'sampling of c3d to compensate this.'), RuntimeWarning)
-        visual_encoder.t_stride = int(num_c3d_features / seq_encoder_length)
         daps_receptive_field = video_length
         f_init_arr = np.arange(0, 1)
     else:
         f_init_arr = np.arange(0, video_length - daps_receptive_field + 1,
                                seq_encoder_stride)
+    return f_init_arr, daps_receptive_field
+
+
+def video_windows(visual_encoder, video_name, seq_encoder_length=32,
+                  seq_encoder_stride=64):
+    """Initial frame of each window of DAPs along a video
+
+    Check sliding_windows for details about the outputs.
+
+    """
+    c3d_f_res = visual_encoder.f_res
+    num_c3d_features = visual_encoder.num_features(video_name)
+    f_init_arr, daps_receptive_field = sliding_windows(
+        num_c3d_features, c3d_f_res, seq_encoder_length, seq_encoder_stride)
+    # If num-frames less than DAPs-res, change t_stride
+    if daps_receptive_field < seq_encoder_length * c3d_f_res:
+        visual_encoder.t_stride = int(num_c3d_features / seq_encoder_length)
+    return f_init_arr, daps_receptive_field
+
+
+def proposals_dataframe(video_names, proposals, score,
+                        nms_overlap=NMS_OVERLAP):
+    """Post-process proposals of several videos and arrange them as DataFrame
+
+    Parameters
+    ----------
+    video_names : list of str
+        Name of each video.
+    proposals : list of ndarray
+        Proposals of each video [num-windows, num-outputs, 2].
+    score : list of ndarray
+        Score of each video [num-windows, num-outputs].
+    nms_overlap : float, optional
+        Overlap threshold of non-maxima suppression.
+
+    """
+    pp_proposals = np.vstack([i.reshape((-1, 2)) for i in proposals])
+    pp_score = np.hstack([i.reshape(-1) for i in score])
+    pp_video = np.repeat(np.arange(len(video_names)),
+                         [i.size for i in score])
+    # A single NMS call over all the videos
+    pick = non_maxima_supression_batch(pp_proposals, pp_score, pp_video,
+                                       nms_overlap)
+
+    return pd.DataFrame({'f-init': pp_proposals[pick, 0],
+                         'f-end': pp_proposals[pick, 1],
+                         'score': pp_score[pick],
+                         'video-name': np.array(video_names)[pp_video[pick]]})
+
+
+def video_dataframe(video_name, proposals):
+    """Proposals of a video, from a ResultCache entry, arranged as DataFrame
+
+    Parameters
+    ----------
+    video_name : str
+        Name of the video.
+    proposals : dict
+        f-init, f-end and score ndarrays of the video after NMS (check
+        proposals_dataframe).
+
+    """
+    num_proposals = proposals['score'].size
+    return pd.DataFrame({'f-init': proposals['f-init'],
+                         'f-end': proposals['f-end'],
+                         'score': proposals['score'],
+                         'video-name': np.repeat(np.array([video_name]),
+                                                 num_proposals)})
+
+
+def retrieve_proposals_batch(sequence_encoder, video_stream, batch_size=512):
+    """Retrieve proposals of several videos packing their windows together
+
+    Parameters
+    ----------
+    sequence_encoder : DAPs
+        Compiled instance of DAPs.
+    video_stream : iterable
+        Sequence of tuples (video-name, visual-encoder-representation,
+        f_init_arr, receptive-field) for each video.
+    batch_size : int, optional
+        Number of windows per forward-pass.
+
+    Yields
+    ------
+    video_name : str
+    proposals : ndarray
+        3d-ndarray [num-windows, num-outputs, 2] with proposals of the video.
+    score : ndarray
+        2d-ndarray [num-windows, num-outputs] with score of the proposals.
+
+    """
+    pending = []  # video-name and number of windows waiting for results
+    feat_buffer, f_init_buffer, rf_buffer = [], [], []
+    proposals_buffer, score_buffer = [], []
+    num_buffered, num_done = 0, 0
+
+    def forward(num_windows):
+        feat = np.concatenate(feat_buffer)
+        f_init = np.concatenate(f_init_buffer)
+        rf = np.concatenate(rf_buffer)
+        proposals, score = sequence_encoder.retrieve_proposals(
+            feat[:num_windows], f_init[:num_windows],
+            receptive_field=rf[:num_windows])
+        proposals_buffer.append(proposals)
+        score_buffer.append(score)
+        feat_buffer[:] = [feat[num_windows:]]
+        f_init_buffer[:] = [f_init[num_windows:]]
+        rf_buffer[:] = [rf[num_windows:]]
+
+    def completed_videos():
+        proposals = np.concatenate(proposals_buffer)
+        score = np.concatenate(score_buffer)
+        idx = 0
+        while pending and idx + pending[0][1] <= proposals.shape[0]:
+            video_name, num_windows = pending.pop(0)
+            yield (video_name, proposals[idx:idx + num_windows],
+                   score[idx:idx + num_windows])
+            idx += num_windows
+        proposals_buffer[:] = [proposals[idx:]]
+        score_buffer[:] = [score[idx:]]
+
+    for video_name, feat, f_init_arr, receptive_field in video_stream:
+        pending.append((video_name, f_init_arr.size))
+        feat_buffer.append(feat)
+        f_init_buffer.append(f_init_arr)
+        rf_buffer.append(np.repeat(receptive_field, f_init_arr.size))
+        num_buffered += f_init_arr.size
+        if num_buffered - num_done < batch_size:
+            continue
+
+        while num_buffered - num_done >= batch_size:
+            forward(batch_size)
+            num_done += batch_size
+        for output in completed_videos():
+            yield output
+
+    if num_buffered > num_done:
+        forward(num_buffered - num_done)
+    if pending:
+        for output in completed_videos():
+            yield output
+
+
+def generate_proposals(visual_encoder, sequence_encoder, video_names,
+                       seq_encoder_length=32, seq_encoder_stride=64,
+                       batch_size=512, verbose=True, prefetch=0):
+    """Proposals, after NMS, of several videos arranged as DataFrame
+
+    Parameters
+    ----------
+    visual_encoder : C3D
+        Interface with C3D features of the videos.
+    sequence_encoder : DAPs
+        Compiled instance of DAPs.
+    video_names : list of str
+        Name of the videos.
+    seq_encoder_length : int, optional
+        Length of sequence encoder.
+    seq_encoder_stride : int, optional
+        Sliding stride for sequence encoder along the video.
+    batch_size : int, optional
+        Number of windows per forward-pass.
+    verbose : bool, optional
+        Report progress.
+    prefetch : int, optional
+        Number of videos read and pooled ahead, on a background thread,
+        while the sequence encoder processes the current batch.
+
+    """
+    batch_mode = len(video_names) > 1
+
+    def video_stream():
+        for i, video_name in enumerate(video_names):
+            if verbose and batch_mode:
+                print 'Reading C3D features [{}/{}]: {}'.format(
+                    i + 1, len(video_names), video_name)
+            elif verbose:
+                print 'Reading C3D features'
+            f_init_arr, receptive_field = video_windows(
+                visual_encoder, video_name, seq_encoder_length,
+                seq_encoder_stride)
+            ve_representation = visual_encoder.read_feat_batch_from_video(
+                video_name, f_init_arr, duration=receptive_field)
+            yield video_name, ve_representation, f_init_arr, receptive_field
+
+    stream = video_stream()
+    if prefetch > 0:
+        stream = Prefetcher(stream, prefetch)
+    try:
+        results = zip(*retrieve_proposals_batch(
+            sequence_encoder, stream, batch_size))
+    finally:
+        if prefetch > 0:
+            stream.close()
+    if verbose and prefetch > 0:
+        print 'Prefetch {}'.format(stream.stats())
+    # Post-processing
+    if verbose:
+        print 'Post-processing segments'
+    return proposals_dataframe(*results)
+
+
+def model_pool_type(pool_type, seq_length):
+    """Pooling strategy of C3D features yielding seq_length time-steps"""
+    if pool_type and 'concat' in pool_type:
+        return 'concat-{}-{}'.format(seq_length, pool_type.split('-')[-1])
+    return pool_type
+
+
+def generate_proposals_ensemble(visual_encoder, sequence_encoders,
+                                video_names, seq_encoder_stride=64,
+                                batch_size=512, verbose=True, prefetch=0):
+    """Proposals of several DAPs models merged before a single NMS
+
+    The features of each video are read once and pooled for the windows of
+    every model e.g. models with different receptive fields. The cache and
+    pooling index of the visual encoder are not used.
+
+    Parameters
+    ----------
+    visual_encoder : C3D
+        Interface with C3D features of the videos. Its pooling strategy is
+        adapted to the sequence length of each model.
+    sequence_encoders : list of DAPs
+        Compiled instances of DAPs.
+    video_names : list of str
+        Name of the videos.
+    seq_encoder_stride : int, optional
+        Sliding stride for sequence encoders along the video.
+    batch_size : int, optional
+        Number of windows per forward-pass.
+    verbose : bool, optional
+        Report progress.
+    prefetch : int, optional
+        Number of videos read and pooled ahead on a background thread.
+
+    """
+    pool_types = [model_pool_type(visual_encoder.pool_type, i.seq_length)
+                  for i in sequence_encoders]
+
+    def video_stream():
+        for i, video_name in enumerate(video_names):
+            if verbose:
+                print 'Reading C3D features [{}/{}]: {}'.format(
+                    i + 1, len(video_names), video_name)
+            windows = [video_windows(visual_encoder, video_name, j.seq_length,
+                                     seq_encoder_stride)
+                       for j in sequence_encoders]
+            feat_stacks = visual_encoder.read_feat_batches_from_video(
+                video_name, [(f_init_arr, receptive_field, pool_type)
+                             for (f_init_arr, receptive_field), pool_type
+                             in zip(windows, pool_types)])
+            yield video_name, feat_stacks, windows
+
+    def forward(chunk):
+        # Pack windows of the videos in the chunk per model
+        proposals = [[] for _ in chunk]
+        score = [[] for _ in chunk]
+        for j, model in enumerate(sequence_encoders):
+            model_stream = ((video_name, feat_stacks[j], windows[j][0],
+                             windows[j][1])
+                            for video_name, feat_stacks, windows in chunk)
+            for i, (_, video_proposals, video_score) in enumerate(
+                    retrieve_proposals_batch(model, model_stream,
+                                             batch_size)):
+                proposals[i].append(video_proposals.reshape((-1, 2)))
+                score[i].append(video_score.reshape(-1))
+        for i, (video_name, _, _) in enumerate(chunk):
+            results[0].append(video_name)
+            results[1].append(np.vstack(proposals[i]))
+            results[2].append(np.hstack(score[i]))
+
+    stream = video_stream()
+    if prefetch > 0:
+        stream = Prefetcher(stream, prefetch)
+    results, chunk, num_windows = ([], [], []), [], 0
+    try:
+        for video in stream:
+            chunk.append(video)
+            num_windows += video[2][0][0].size
+            if num_windows >= batch_size:
+                forward(chunk)
+                chunk, num_windows = [], 0
+        if chunk:
+            forward(chunk)
+    finally:
+        if prefetch > 0:
+            stream.close()
+    if verbose and prefetch > 0:
+        print 'Prefetch {}'.format(stream.stats())
+    # Post-processing
+    if verbose:
+        print 'Post-processing segments'
+    return proposals_dataframe(*results)
+
+
+# State of worker processes. The parent sets the sequence encoder before
+# forking, thus the workers share its parameters (copy-on-write pages)
+# instead of loading or unpickling a copy each.
+_worker = {}
+
+
+def _as_list(value):
+    """Wrap a single value (e.g. argument given by a script) as list"""
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def setup_visual_encoder(c3d_file, *args, **kwargs):
+    """Interface with C3D features: memory map for npy-files or HDF5-file"""
+    if os.path.splitext(c3d_file)[1] == '.npy':
+        return C3DMemmap(c3d_file, *args, **kwargs)
+    return C3D(c3d_file, *args, **kwargs)
+
+
+def _init_worker(c3d_args, instrument_log=None, c3d_kwargs=None):
+    """Open an interface with the visual encoder per worker"""
+    instrument.clear_hooks()
+    _worker['summary'] = None
+    if instrument_log is not None:
+        instrument.log_to(instrument_log)
+        # Stages of each shard are sent back to the parent
+        _worker['summary'] = instrument.add_hook(instrument.StageSummary())
+    visual_encoder = setup_visual_encoder(*c3d_args, **(c3d_kwargs or {}))
+    visual_encoder.open_instance()
+    _worker['visual_encoder'] = visual_encoder
+
+
+def _worker_proposals(args):
+    """Generate proposals of a shard of videos inside a worker"""
+    shard_id, video_names = args
+    generate = generate_proposals
+    if isinstance(_worker['sequence_encoder'], list):
+        generate = generate_proposals_ensemble
+    df = generate(_worker['visual_encoder'], _worker['sequence_encoder'],
+                  video_names, verbose=False, **_worker['kwargs'])
+    if _worker['visual_encoder'].cache is not None:
+        _worker['visual_encoder'].cache.flush()
+    stages = None
+    if _worker['summary'] is not None:
+        stages = _worker['summary'].stages
+        _worker['summary'].stages = {}
+    return shard_id, len(video_names), df, stages
+
+
+def generate_proposals_parallel(c3d_args, sequence_encoder, video_names,
+                                num_workers=2, shard_size=None,
+                                instrument_log=None, c3d_kwargs=None,
+                                summary=None, **kwargs):
+    """Proposals of several videos sharded across a pool of processes
+
+    Parameters
+    ----------
+    c3d_args : tuple
+        Arguments to instantiate C3D in each worker.
+    sequence_encoder : DAPs or list of DAPs
+        Compiled instance of DAPs shared by all the workers. A list of them
+        is run as an ensemble (check generate_proposals_ensemble).
+    video_names : list of str
+        Name of the videos.
+    num_workers : int, optional
+        Number of processes.
+    shard_size : int, optional
+        Number of videos per task. By default, four tasks per worker.
+    instrument_log : str, optional
+        JSON-lines file where workers log their stages.
+    c3d_kwargs : dict, optional
+        Keyword arguments to instantiate C3D in each worker.
+    summary : StageSummary, optional
+        Summary where the stages of the workers are merged. Workers only
+        report them if there is an instrument_log.
+    **kwargs
+        Extra arguments of generate_proposals or
+        generate_proposals_ensemble.
+
+    Returns
+    -------
+    df : DataFrame
+        Proposals of all the videos in the same order as video_names.
+
+    """
+    if shard_size is None:
+        shard_size = int(np.ceil(len(video_names) / (4.0 * num_workers)))
+    shards = [video_names[i:i + shard_size]
+              for i in range(0, len(video_names), shard_size)]
+
+    if c3d_kwargs and c3d_kwargs.get('index_file') is not None:
+        # Workers read the pooling indices, HDF5 has no concurrent writers
+        c3d_kwargs = dict(c3d_kwargs, save_index=False)
+    _worker['sequence_encoder'] = sequence_encoder
+    _worker['kwargs'] = kwargs
+    pool = multiprocessing.Pool(num_workers, _init_worker,
+                                (c3d_args, instrument_log, c3d_kwargs))
+    # The parent is the only writer, results arrive as soon as each shard
+    # is done
+    df_list, num_done = [None] * len(shards), 0
+    try:
+        for shard_id, num_videos, df, stages in pool.imap_unordered(
+                _worker_proposals, enumerate(shards)):
+            df_list[shard_id] = df
+            if summary is not None and stages is not None:
+                summary.merge(stages)
+            num_done += num_videos
+            print 'Processed videos [{}/{}]'.format(num_done,
+                                                    len(video_names))
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker.clear()
+    return pd.concat(df_list, ignore_index=True)
+
+
+def main(video_name=None, c3d_hdf5=None, model_file=None,
+         anchors_hdf5='non-existent', output_csv=None, clobber=False,
+         seq_encoder_stride=64, num_proposals_per_seq_length=None,
+         seq_encoder_length=32, seq_encoder_depth=None, seq_encoder_width=None,
+         c3d_f_res=16, c3d_f_stride=8, c3d_pool_type='concat-32-mean',
+         c3d_feat_dim=500, c3d_feat_id='c3d_features', video_list=None,
+         all_videos=False, batch_size=512, seq_encoder_backend='theano',
+         seq_encoder_compiled_dir=None, num_workers=1, instrument_log=None,
+         output_format='csv', c3d_cache_dir=None, c3d_cache_bytes=0,
+         prefetch=0, seq_encoder_micro_batch=None, seq_encoder_max_memory=None,
+         seq_encoder_autotune=False, c3d_pca_file=None,
+         result_cache_dir=None, result_cache_bytes=0,
+         result_cache_sampled_digest=False):
+    # Instrumentation of each stage
+    log, summary = None, None
+    if instrument_log is not None:
+        log = instrument.log_to(instrument_log)
+        summary = instrument.add_hook(instrument.StageSummary())
+
+    # Setup DAPs model(s), a list of model files is run as an ensemble
+    model_files = _as_list(model_file)
+    anchors_files = _as_list(anchors_hdf5)
+    seq_encoder_lengths = _as_list(seq_encoder_length)
+    if len(anchors_files) == 1:
+        anchors_files *= len(model_files)
+    if len(seq_encoder_lengths) == 1:
+        seq_encoder_lengths *= len(model_files)
+    if not len(model_files) == len(anchors_files) == len(seq_encoder_lengths):
+        raise ValueError('Provide anchors and length for each model.')
+    ensemble = len(model_files) > 1
+    if ensemble:
+        ignored = [name for name, value in [
+            ('seq-encoder-width', seq_encoder_width),
+            ('seq-encoder-depth', seq_encoder_depth),
+            ('num-proposals-per-seq-length', num_proposals_per_seq_length)]
+            if value is not None]
+        if ignored:
+            warnings.warn(('The architecture of each model in the ensemble '
+                           'is inferred from its file, ignoring: {}').format(
+                               ', '.join(ignored)), RuntimeWarning)
+        if c3d_cache_dir is not None or c3d_cache_bytes > 0:
+            raise ValueError('Ensembles do not use the C3D cache (-vecd, '
+                             '-vecb).')
+
+    # Visual Enconder
+    print 'Setup interface with visual encoder'
+    c3d_args = (c3d_hdf5, c3d_f_res, c3d_f_stride, c3d_pool_type,
+                c3d_feat_id)
+    # Pool straight into the dtype of the model, batches are not copied
+    c3d_kwargs = {'dtype': FLOATX}
+    if c3d_pca_file is not None:
+        c3d_kwargs.update(pca_file=c3d_pca_file, pca_dim=c3d_feat_dim)
+    if c3d_cache_dir is not None and c3d_cache_bytes <= 0:
+        raise ValueError('Set the memory of the C3D cache (-vecb) to use '
+                         'its folder (-vecd).')
+    if c3d_cache_bytes > 0:
+        c3d_kwargs['cache'] = LRUCache(c3d_cache_bytes, c3d_cache_dir)
+    visual_encoder = setup_visual_encoder(*c3d_args, **c3d_kwargs)
+    visual_encoder.open_instance()
+
+    # Videos of interest
+    if video_name is not None and not isinstance(video_name, (list, tuple)):
+        video_name = [video_name]
+    video_names = list(video_name or [])
+    if video_list is not None:
+        with open(video_list) as f:
+            video_names += [line.strip() for line in f if line.strip()]
+    if all_videos:
+        video_names += visual_encoder.video_names()
+    if len(video_names) == 0:
+        raise ValueError('Provide at least one video.')
+    batch_mode = len(video_names) > 1
 
     # Sequence Enconder
-    # Load anchors file
-    anchors = None
-    if os.path.exists(anchors_hdf5):
-        with h5py.File(anchors_hdf5) as f:
-            anchors = f['anchors'].value
+    sequence_encoders = []
+    for model_file, anchors_hdf5, seq_encoder_length in zip(
+            model_files, anchors_files, seq_encoder_lengths):
+        # Load anchors file
+        anchors = load_anchors(anchors_hdf5)
+        # Infer receptive-field in terms of number of frames
+        daps_receptive_field = seq_encoder_length * c3d_f_res
+        if ensemble:
+            architecture = model_architecture(model_file)
+        else:
+            architecture = {
+                'num_outputs': num_proposals_per_seq_length or 64,
+                'depth': seq_encoder_depth or 1,
+                'width': seq_encoder_width or 256,
+                'input_size': c3d_feat_dim}
 
-    print 'Setup sequence encoder'
-    sequence_encoder = DAPs(num_proposals_per_seq_length, seq_encoder_length,
-                            seq_encoder_depth, seq_encoder_width, c3d_feat_dim,
-                            daps_receptive_field, anchors)
-    print 'Loading sequence encoder model'
-    sequence_encoder.load_model(model_file)
-    print 'Compiling sequence encoder'
-    sequence_encoder.compile()
+        start_time = time.time()
+        sequence_encoder = setup_sequence_encoder(
+            model_file, anchors, seq_length=seq_encoder_length,
+            receptive_field=daps_receptive_field,
+            backend=seq_encoder_backend,
+            compiled_dir=seq_encoder_compiled_dir, **architecture)
+        sequence_encoder.batch_size = seq_encoder_micro_batch
+        sequence_encoder.max_memory = seq_encoder_max_memory
+        if seq_encoder_autotune:
+            micro_batch, throughput = sequence_encoder.autotune_batch_size()
+            print 'Micro-batch size: {} (windows/s: {})'.format(
+                micro_batch, ', '.join('{}={:.0f}'.format(k, v)
+                                       for k, v in sorted(throughput.items())))
+        print 'Sequence encoder ready in {:.3f}s {}'.format(
+            time.time() - start_time, sequence_encoder.timings)
+        sequence_encoders.append(sequence_encoder)
 
-    # Using DAPs
-    print 'Reading C3D features'
-    ve_representation = visual_encoder.read_feat_batch_from_video(
-        video_name, f_init_arr, duration=daps_receptive_field)
+    # Results of previous runs with the same features, models and
+    # parameters. Batch sizes, workers and prefetch do not change results.
+    results, result_cache, result_keys = {}, None, {}
+    if result_cache_dir is not None:
+        result_cache = ResultCache(result_cache_dir, result_cache_bytes)
+        digests = [file_digest(i) for i in model_files + anchors_files]
+        if c3d_pca_file is not None:
+            digests.append(file_digest(c3d_pca_file))
+        params = {'seq_encoder_lengths': tuple(seq_encoder_lengths),
+                  'seq_encoder_stride': seq_encoder_stride,
+                  'architectures': tuple(
+                      (i.num_outputs, i.depth, i.width, i.input_size)
+                      for i in sequence_encoders),
+                  'backend': seq_encoder_backend, 'floatx': FLOATX,
+                  'c3d_f_res': c3d_f_res, 'c3d_f_stride': c3d_f_stride,
+                  'c3d_pool_type': c3d_pool_type, 'c3d_feat_id': c3d_feat_id,
+                  'nms_overlap': NMS_OVERLAP, 'version': RESULT_CACHE_VERSION}
+        pipeline_key = content_key(*digests, **params)
+        for video in video_names:
+            result_keys[video] = content_key(
+                visual_encoder.feature_digest(
+                    video, result_cache_sampled_digest), pipeline_key)
+            proposals = result_cache.get(result_keys[video])
+            if proposals is not None:
+                results[video] = proposals
+        print 'Videos in result cache: {}/{}'.format(len(results),
+                                                    len(video_names))
+    pending_videos = [i for i in video_names if i not in results]
+
+    kwargs = {'seq_encoder_stride': seq_encoder_stride,
+              'batch_size': batch_size, 'prefetch': prefetch}
+    if ensemble:
+        sequence_encoder = sequence_encoders
+        generate = generate_proposals_ensemble
+    else:
+        sequence_encoder = sequence_encoders[0]
+        kwargs['seq_encoder_length'] = seq_encoder_lengths[0]
+        generate = generate_proposals
 
     # Generate proposals along the whole video
     print 'Generating segments'
-    proposals, score = sequence_encoder.retrieve_proposals(
-        ve_representation, f_init_arr)
+    start_time = time.time()
+    if len(pending_videos) == 0:
+        visual_encoder.close_instance()
+    elif num_workers > 1 and len(pending_videos) > 1:
+        # Workers open their own interface with the visual encoder
+        visual_encoder.close_instance()
+        df_out = generate_proposals_parallel(
+            c3d_args, sequence_encoder, pending_videos, num_workers,
+            instrument_log=instrument_log, c3d_kwargs=c3d_kwargs,
+            summary=summary, **kwargs)
+    else:
+        df_out = generate(visual_encoder, sequence_encoder, pending_videos,
+                          **kwargs)
+        # Close visual encoder interface
+        visual_encoder.close_instance()
+        if visual_encoder.cache is not None:
+            visual_encoder.cache.flush()
+            print 'Cache of C3D windows {}'.format(
+                visual_encoder.cache.stats())
+
+    if result_cache is not None:
+        # Proposals are sorted by video, thus each video is a slice
+        if pending_videos:
+            names = df_out['video-name'].values
+            for video in pending_videos:
+                idx = np.flatnonzero(names == video)
+                results[video] = dict(
+                    (i, df_out[i].values[idx])
+                    for i in ('f-init', 'f-end', 'score'))
+                result_cache.put(result_keys[video], **results[video])
+        df_out = pd.concat([video_dataframe(i, results[i])
+                            for i in video_names], ignore_index=True)
+        result_cache.prune()
+        print 'Result cache {}'.format(result_cache.stats())
+    elapsed_time = time.time() - start_time
+
+    if batch_mode:
+        print 'Processed {} videos in {:.2f}s ({:.2f} videos/s)'.format(
+            len(video_names), elapsed_time,
+            len(video_names) / max(elapsed_time, 1e-8))
+    if summary is not None and summary.stages:
+        print 'Time per stage (summed over all the processes)'
+        for line in summary.report():
+            print '  ' + line
+    if log is not None:
+        instrument.clear_hooks()
+        log.close()
 
-    # Post-processing
-    print 'Post-processing segments'
-    pp_proposals = proposals.reshape((-1, 2))
-    pp_score = score.reshape(-1)
-    nms_proposals, nms_score = non_maxima_supression(pp_proposals, pp_score)
-
-    # Close visual encoder interface
-    visual_encoder.close_instance()
-
-    num_proposals = nms_proposals.shape[0]
-    df_out = pd.DataFrame({'f-init': nms_proposals[:, 0],
-                           'f-end': nms_proposals[:, 1],
-                           'score': nms_score,
-                           'video-name': [video_name] * num_proposals})
     # Dumping output
     if output_csv is not None:
         print 'Dumping results to disk'
         if len(output_csv) == 0:
-            output_csv = video_name + '.csv'
+            output_csv = video_names[0] + '.' + output_format
+            if batch_mode:
+                output_csv = 'proposals.' + output_format
         if not clobber and os.path.isfile(output_csv):
             raise ValueError('Existent output: {}'.format(output_csv))
 
-        df_out.to_csv(output_csv, index=None, sep=' ')
+        if output_format == 'hdf5':
+            with ProposalWriter(output_csv) as writer:
+                writer.write_dataframe(df_out)
+        else:
+            df_out.to_csv(output_csv, index=None, sep=' ')
     return df_out
 
 
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+
+Pack C3D features of all the videos into a contiguous npy-file
+
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import numpy as np
+
+from daps.visual_encoder import index_filename, pack_features
+
+
+def input_parser():
+    description = ('Pack C3D features of an HDF5-file into a contiguous '
+                   'npy-file (plus an index with the offset of each video). '
+                   'Read it with C3DMemmap or pass it to '
+                   'generate_proposals.py.')
+    p = ArgumentParser(description=description,
+                       formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument('c3d_hdf5', help='HDF5 file with features for each video')
+    p.add_argument('filename', help='npy-file with packed features')
+    p.add_argument('-ivl', '--video-list', default=None,
+                   help=('Text file with a video-id per line. By default, '
+                         'all the videos'))
+    p.add_argument('-vefi', '--feat-id', default='c3d_features',
+                   help=('id used for HDF5-dataset corresponding to C3D '
+                         'features'))
+    p.add_argument('-dt', '--dtype', default=None,
+                   choices=['float16', 'float32', 'float64'],
+                   help=('Data type on disk. By default, the one of the '
+                         'HDF5 file. A narrower one e.g. float16 reduces '
+                         'the size, features are upcast per batch when '
+                         'pooled'))
+    return p
+
+
+def main(c3d_hdf5, filename, video_list=None, feat_id='c3d_features',
+         dtype=None):
+    video_names = None
+    if video_list is not None:
+        with open(video_list) as f:
+            video_names = [line.strip() for line in f if line.strip()]
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+    pack_features(c3d_hdf5, filename, feat_id, video_names, dtype)
+    print 'Features: {}\nIndex: {}'.format(filename, index_filename(filename))
+
+
+if __name__ == '__main__':
+    p = input_parser()
+    main(**vars(p.parse_args()))
@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+"""
+
+Resident HTTP server retrieving action proposals on demand
+
+"""
+import BaseHTTPServer
+import json
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import deque
+
+import numpy as np
+
+from daps.sequence_encoder import FLOATX, model_architecture
+from daps.utils.instrument import to_builtin
+from daps.utils.pooling import pool_and_project
+from daps.utils.segment import non_maxima_supression
+from daps.visual_encoder import load_pca
+from generate_proposals import load_anchors, setup_sequence_encoder
+from generate_proposals import setup_visual_encoder, sliding_windows
+
+
+def input_parser():
+    description = ('Serve action proposals over HTTP. The sequence encoder '
+                   'is compiled once and the C3D features stay open. '
+                   'Windows of concurrent requests share forward passes.')
+    epilog = ('POST /proposals with a JSON object: "video-name" (video in '
+              'the C3D file) or "features" (raw C3D features [num-frames, '
+              'feat-dim], projected with the PCA of -vepca), optional '
+              '"f-init" (initial frame of each window, '
+              'by default sliding windows along the video), "duration" '
+              '(receptive field), "nms" (true) and "num-proposals". '
+              'GET /stats reports throughput and latency percentiles.')
+    p = ArgumentParser(description=description, epilog=epilog,
+                       formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument('-imd', '--model-file', required=True,
+                   help=('npz file with sequence encoder parameters. Its '
+                         'architecture is inferred from the file'))
+    p.add_argument('-ic3d', '--c3d-hdf5', default=None,
+                   help=('HDF5 file with features for each video or npy '
+                         'file created by tools/pack_c3d_features.py. '
+                         'Without it, requests must carry their features'))
+    p.add_argument('-iaf', '--anchors-hdf5', default='non-existent.hdf5',
+                   help='HDF5 file with anchor segments')
+    # Server arguments
+    p.add_argument('-H', '--host', default='127.0.0.1',
+                   help='Address to listen on')
+    p.add_argument('-p', '--port', default=8000, type=int,
+                   help='Port to listen on')
+    p.add_argument('-us', '--unix-socket', default=None,
+                   help='Listen on a Unix socket instead of host:port')
+    p.add_argument('-ml', '--max-latency', default=5.0, type=float,
+                   help=('Max time (ms) that a request waits for others to '
+                         'share a forward pass'))
+    p.add_argument('-bs', '--batch-size', default=512, type=int,
+                   help=('Number of windows that triggers a forward pass '
+                         'before max-latency'))
+    p.add_argument('-v', '--verbose', action='store_true',
+                   help='Log each request')
+    # DAPs arguments
+    p.add_argument('-ses', '--seq-encoder-stride', default=64, type=int,
+                   help='Sliding stride for sequence encoder along the video')
+    p.add_argument('-sel', '--seq-encoder-length', default=32, type=int,
+                   help='Length of sequence encoder')
+    p.add_argument('-seb', '--seq-encoder-backend', default='theano',
+                   choices=['theano', 'numpy'],
+                   help='Inference engine of sequence encoder')
+    p.add_argument('-secd', '--seq-encoder-compiled-dir', default=None,
+                   help='Folder to cache compiled sequence encoders')
+    p.add_argument('-nms', '--nms-overlap', default=0.7, type=float,
+                   help='Overlap threshold of non-maxima suppression')
+    # Extra arguments
+    p.add_argument('-vefr', '--c3d-f-res', default=16, type=int,
+                   help='temporal resolution of C3D')
+    p.add_argument('-vefs', '--c3d-f-stride', default=8, type=int,
+                   help='temporal stride for C3D sampling')
+    p.add_argument('-vept', '--c3d-pool-type', default='concat-32-mean',
+                   help='Pooling strategy for C3D features')
+    p.add_argument('-vefi', '--c3d-feat-id', default='c3d_features',
+                   help=('id used for HDF5-dataset corresponding to C3D '
+                         'features'))
+    p.add_argument('-vepca', '--c3d-pca-file', default=None,
+                   help=('HDF5 file with PCA of raw C3D features, they are '
+                         'projected on the fly (features of requests too)'))
+    return p
+
+
+class ServerStats(object):
+    """Throughput and latency of the requests served
+
+    Parameters
+    ----------
+    history : int, optional
+        Number of recent requests used to compute latency percentiles.
+
+    """
+    def __init__(self, history=10000):
+        self.start_time = time.time()
+        self.latency = deque(maxlen=history)
+        self.requests = 0
+        self.errors = 0
+        self.windows = 0
+        self.batches = 0
+        self.batch_requests = 0
+        self._lock = threading.Lock()
+
+    def add_request(self, latency, num_windows=0, error=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.windows += num_windows
+            if not error:
+                self.latency.append(latency)
+
+    def add_batch(self, num_requests):
+        with self._lock:
+            self.batches += 1
+            self.batch_requests += num_requests
+
+    def report(self):
+        """Dict with throughput and latency percentiles (ms)
+        """
+        with self._lock:
+            elapsed_time = max(time.time() - self.start_time, 1e-8)
+            latency = np.array(self.latency) * 1000
+            report = {'uptime': elapsed_time, 'requests': self.requests,
+                      'errors': self.errors, 'windows': self.windows,
+                      'batches': self.batches,
+                      'requests_per_s': self.requests / elapsed_time,
+                      'windows_per_s': self.windows / elapsed_time,
+                      'requests_per_batch': (self.batch_requests /
+                                             max(self.batches, 1.0))}
+        for q in (50, 90, 99):
+            report['latency_p{}'.format(q)] = (
+                np.percentile(latency, q) if latency.size else None)
+        report['latency_max'] = latency.max() if latency.size else None
+        return report
+
+
+class DynamicBatcher(object):
+    """Coalesce windows of concurrent requests into shared forward passes
+
+    A background thread waits for the first pending request and gathers
+    the ones arriving during max_latency, or until batch_size windows, then
+    retrieves the proposals of all of them with a single call of the
+    sequence encoder.
+
+    Parameters
+    ----------
+    sequence_encoder : DAPs
+        Compiled instance of DAPs.
+    batch_size : int, optional
+        Number of windows that triggers a forward pass.
+    max_latency : float, optional
+        Max time (seconds) that a request waits for others.
+    stats : ServerStats, optional
+        Counter of batches.
+
+    """
+    def __init__(self, sequence_encoder, batch_size=512, max_latency=0.005,
+                 stats=None):
+        self.sequence_encoder = sequence_encoder
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.stats = stats or ServerStats()
+        self._queue = Queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def retrieve_proposals(self, feat_stack, f_init_arr, receptive_field):
+        """Proposals of a set of windows, blocks until they are ready
+
+        Check DAPs.retrieve_proposals for details about the arguments.
+
+        """
+        job = {'feat': feat_stack, 'f_init': f_init_arr,
+               'receptive_field': np.repeat(receptive_field, len(f_init_arr)),
+               'done': threading.Event()}
+        self._queue.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['proposals'], job['score']
+
+    def close(self):
+        """Stop the background thread
+        """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        """Gather pending requests and process them together"""
+        while not self._stop.is_set():
+            try:
+                jobs = [self._queue.get(timeout=0.1)]
+            except Queue.Empty:
+                continue
+            num_windows = len(jobs[0]['f_init'])
+            deadline = time.time() + self.max_latency
+            while num_windows < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(self._queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+                num_windows += len(jobs[-1]['f_init'])
+            self._forward(jobs)
+
+    def _forward(self, jobs):
+        """Single forward pass over the windows of several requests"""
+        try:
+            proposals, score = self.sequence_encoder.retrieve_proposals(
+                np.concatenate([i['feat'] for i in jobs]),
+                np.concatenate([i['f_init'] for i in jobs]),
+                receptive_field=np.concatenate(
+                    [i['receptive_field'] for i in jobs]))
+            edges = np.cumsum([0] + [len(i['f_init']) for i in jobs])
+            for i, job in enumerate(jobs):
+                job['proposals'] = proposals[edges[i]:edges[i + 1]]
+                job['score'] = score[edges[i]:edges[i + 1]]
+        except Exception as e:
+            for job in jobs:
+                job['error'] = e
+        finally:
+            self.stats.add_batch(len(jobs))
+            for job in jobs:
+                job['done'].set()
+
+
+class ProposalService(object):
+    """Retrieve proposals of a request (independent of the transport)
+
+    Parameters
+    ----------
+    sequence_encoder : DAPs
+        Compiled instance of DAPs.
+    visual_encoder : C3D, optional
+        Open interface with C3D features. Without it, requests must carry
+        their raw features.
+    c3d_f_res, c3d_f_stride, c3d_pool_type : optional
+        Setup of C3D features (used for raw features in requests).
+    seq_encoder_stride : int, optional
+        Sliding stride for sequence encoder along the video.
+    nms_overlap : float, optional
+        Overlap threshold of non-maxima suppression.
+    batch_size, max_latency : optional
+        Check DynamicBatcher.
+    pca : tuple, optional
+        Principal components and mean, output of load_pca, projecting the
+        raw features of requests. By default, the PCA of visual_encoder.
+
+    """
+    def __init__(self, sequence_encoder, visual_encoder=None, c3d_f_res=16,
+                 c3d_f_stride=8, c3d_pool_type='concat-32-mean',
+                 seq_encoder_stride=64, nms_overlap=0.7, batch_size=512,
+                 max_latency=0.005, pca=None):
+        self.sequence_encoder = sequence_encoder
+        self.visual_encoder = visual_encoder
+        self.c3d_f_res = c3d_f_res
+        self.c3d_f_stride = c3d_f_stride
+        self.c3d_pool_type = c3d_pool_type
+        self.pca = pca
+        if visual_encoder is not None:
+            self.c3d_f_res = visual_encoder.f_res
+            self.c3d_f_stride = visual_encoder.f_stride
+            self.c3d_pool_type = visual_encoder.pool_type
+            self.pca = visual_encoder.pca
+        self.seq_encoder_stride = seq_encoder_stride
+        self.nms_overlap = nms_overlap
+        self.stats = ServerStats()
+        self.batcher = DynamicBatcher(sequence_encoder, batch_size,
+                                      max_latency, self.stats)
+        # h5py handles are not meant to be shared among threads
+        self._c3d_lock = threading.Lock()
+
+    def proposals(self, request):
+        """Proposals of a request
+
+        Parameters
+        ----------
+        request : dict
+            video-name or features, and optionally f-init, duration, nms
+            and num-proposals.
+
+        Returns
+        -------
+        response : dict
+            proposals (list of [f-init, f-end]) sorted by decreasing score,
+            score and video-name (if any).
+
+        Raises
+        ------
+        ValueError
+            Invalid request e.g. features that do not fit the sequence
+            encoder.
+        KeyError
+            Unknown video.
+
+        """
+        start_time = time.time()
+        num_windows = 0
+        try:
+            f_init_arr, receptive_field, feat_stack = self._features(request)
+            num_windows = len(f_init_arr)
+            proposals, score = self.batcher.retrieve_proposals(
+                feat_stack, f_init_arr, receptive_field)
+            proposals, score = proposals.reshape((-1, 2)), score.reshape(-1)
+            if request.get('nms', True):
+                proposals, score = non_maxima_supression(
+                    proposals, score, self.nms_overlap)
+            else:
+                idx = np.argsort(-score, kind='mergesort')
+                proposals, score = proposals[idx, :], score[idx]
+            num_proposals = request.get('num-proposals')
+            if num_proposals is not None:
+                proposals = proposals[:int(num_proposals)]
+                score = score[:int(num_proposals)]
+        except Exception:
+            self.stats.add_request(time.time() - start_time, error=True)
+            raise
+        self.stats.add_request(time.time() - start_time, num_windows)
+        response = {'proposals': proposals.tolist(), 'score': score.tolist()}
+        if 'video-name' in request:
+            response['video-name'] = request['video-name']
+        return response
+
+    def _features(self, request):
+        """Windows and their features of a request"""
+        seq_length = self.sequence_encoder.seq_length
+        if 'features' in request:
+            feat = np.asarray(request['features'], dtype=FLOATX)
+            if feat.ndim != 2:
+                raise ValueError('features must be [num-frames, feat-dim].')
+            if self.pca is not None and feat.shape[1] != self.pca[0].shape[0]:
+                raise ValueError('Dimension of features must be {}.'.format(
+                    self.pca[0].shape[0]))
+            num_features = feat.shape[0]
+        elif 'video-name' in request:
+            if self.visual_encoder is None:
+                raise ValueError('Server without C3D file, send features.')
+            with self._c3d_lock:
+                num_features = self.visual_encoder.num_features(
+                    request['video-name'])
+        else:
+            raise ValueError('Request needs video-name or features.')
+
+        f_init_arr, receptive_field = sliding_windows(
+            num_features, self.c3d_f_res, seq_length,
+            self.seq_encoder_stride)
+        if request.get('f-init') is not None:
+            f_init_arr = np.array(request['f-init'], dtype=int).reshape(-1)
+        receptive_field = int(request.get('duration', receptive_field))
+        if f_init_arr.size == 0:
+            raise ValueError('Request without windows.')
+
+        if 'features' in request:
+            windows = np.stack([f_init_arr, f_init_arr + receptive_field -
+                                self.c3d_f_res + 1], axis=-1)
+            feat_stack = pool_and_project(
+                feat, windows, self.c3d_pool_type, self.c3d_f_stride, FLOATX,
+                self.pca)
+        else:
+            with self._c3d_lock:
+                feat_stack = self.visual_encoder.read_feat_batch_from_video(
+                    request['video-name'], f_init_arr, receptive_field)
+        # Reject it here, a wrong shape would fail the whole shared batch
+        expected_shape = (seq_length, self.sequence_encoder.input_size)
+        if feat_stack.shape[1:] != expected_shape:
+            raise ValueError(
+                'Features of each window are {}, sequence encoder expects '
+                '{}.'.format(feat_stack.shape[1:], expected_shape))
+        return f_init_arr, receptive_field, feat_stack
+
+    def close(self):
+        self.batcher.close()
+
+
+class ProposalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """POST /proposals and GET /stats"""
+    server_version = 'DAPsProposalServer/0.1'
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self._reply(200, self.server.service.stats.report())
+        else:
+            self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/proposals':
+            self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object.')
+            response = self.server.service.proposals(request)
+        except KeyError as e:
+            self._reply(404, {'error': 'Unknown video {}'.format(e)})
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+        else:
+            self._reply(200, response)
+
+    def _reply(self, code, content):
+        body = json.dumps(content, default=to_builtin)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a Unix socket do not have an address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix-socket'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class ProposalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server, each request is handled by its own thread"""
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        self.service = service
+        self.verbose = verbose
+        BaseHTTPServer.HTTPServer.__init__(self, address, ProposalHandler)
+
+
+class UnixProposalServer(ProposalServer):
+    """ProposalServer listening on a Unix socket"""
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        SocketServer.TCPServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def main(model_file, c3d_hdf5=None, anchors_hdf5='non-existent.hdf5',
+         host='127.0.0.1', port=8000, unix_socket=None, max_latency=5.0,
+         batch_size=512, verbose=False, seq_encoder_stride=64,
+         seq_encoder_length=32, seq_encoder_backend='theano',
+         seq_encoder_compiled_dir=None, nms_overlap=0.7, c3d_f_res=16,
+         c3d_f_stride=8, c3d_pool_type='concat-32-mean',
+         c3d_feat_id='c3d_features', c3d_pca_file=None):
+    architecture = model_architecture(model_file)
+    visual_encoder, pca = None, None
+    if c3d_hdf5 is not None:
+        print 'Setup interface with visual encoder'
+        c3d_kwargs = {'dtype': FLOATX}
+        if c3d_pca_file is not None:
+            c3d_kwargs.update(pca_file=c3d_pca_file,
+                              pca_dim=architecture['input_size'])
+        visual_encoder = setup_visual_encoder(
+            c3d_hdf5, c3d_f_res, c3d_f_stride, c3d_pool_type, c3d_feat_id,
+            **c3d_kwargs)
+        visual_encoder.open_instance()
+    elif c3d_pca_file is not None:
+        pca = load_pca(c3d_pca_file, architecture['input_size'], FLOATX)
+
+    start_time = time.time()
+    sequence_encoder = setup_sequence_encoder(
+        model_file, load_anchors(anchors_hdf5),
+        seq_length=seq_encoder_length,
+        receptive_field=seq_encoder_length * c3d_f_res,
+        backend=seq_encoder_backend, compiled_dir=seq_encoder_compiled_dir,
+        **architecture)
+    print 'Sequence encoder ready in {:.3f}s'.format(time.time() - start_time)
+
+    service = ProposalService(
+        sequence_encoder, visual_encoder, c3d_f_res, c3d_f_stride,
+        c3d_pool_type, seq_encoder_stride, nms_overlap, batch_size,
+        max_latency / 1000.0, pca)
+    if unix_socket is not None:
+        server = UnixProposalServer(unix_socket, service, verbose)
+        print 'Serving proposals on {}'.format(unix_socket)
+    else:
+        server = ProposalServer((host, port), service, verbose)
+        print 'Serving proposals on http://{}:{}'.format(
+            host, server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print 'Shutting down'
+    finally:
+        server.server_close()
+        service.close()
+        if visual_encoder is not None:
+            visual_encoder.close_instance()
+        print json.dumps(service.stats.report(), default=to_builtin,
+                         sort_keys=True)
+
+
+if __name__ == '__main__':
+    p = input_parser()
+    main(**vars(p.parse_args()))
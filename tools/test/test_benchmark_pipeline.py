@@ -0,0 +1,35 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import warnings
+
+import pandas as pd
+
+# Scripts in tools are not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from benchmark_pipeline import main, synthetic_c3d
+
+
+def test_existing_c3d_file():
+    tmp_dir = tempfile.mkdtemp()
+    c3d_hdf5 = os.path.join(tmp_dir, 'c3d.hdf5')
+    output_json = os.path.join(tmp_dir, 'results.json')
+    synthetic_c3d(c3d_hdf5, num_videos=2, num_features=700, feat_dim=6)
+    kwargs = {'c3d_hdf5': c3d_hdf5, 'batch_size': (16,),
+              'num_outputs': (4,), 'seq_encoder_length': 16,
+              'pool_type': ('concat-16-mean',), 'seq_encoder_width': 5,
+              'repeat': 1, 'output_json': output_json}
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        assert main(feat_dim=500, **kwargs) == 0
+    assert any('feat-dim' in str(i.message) for i in w)
+    # The model and the setup follow the features of the file
+    with open(output_json) as f:
+        df = pd.DataFrame(json.load(f))
+    assert (df['feat_dim'] == 6).all()
+    assert (df['num_videos'] == 2).all()
+    assert (df['total_features'] == 1400).all()
+    shutil.rmtree(tmp_dir)
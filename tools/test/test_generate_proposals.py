@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+# Scripts in tools are not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from daps.sequence_encoder import DAPs, FLOATX
+from daps.utils.lstm import random_param_values
+from daps.visual_encoder import C3D
+from generate_proposals import generate_proposals_ensemble, main
+from generate_proposals import model_pool_type
+from generate_proposals import proposals_dataframe, retrieve_proposals_batch
+from generate_proposals import video_windows
+
+
+class test_generate_proposals(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.c3d_hdf5 = os.path.join(self.tmp_dir, 'c3d.hdf5')
+        rng = np.random.RandomState(0)
+        with h5py.File(self.c3d_hdf5, 'w') as f:
+            for i, n in enumerate([700, 1500, 400]):
+                f.create_group('video_{}'.format(i)).create_dataset(
+                    'c3d_features', data=rng.randn(n, 8).astype(np.float32))
+        self.video_names = ['video_0', 'video_1', 'video_2']
+        self.visual_encoder = C3D(self.c3d_hdf5, dtype=FLOATX)
+        self.visual_encoder.open_instance()
+        # Models with different length, depth and number of outputs
+        self.models = []
+        for i, (num_outputs, seq_length, depth) in enumerate(
+                [(4, 16, 1), (6, 8, 2)]):
+            model = DAPs(num_outputs, seq_length, depth, 5, 8,
+                         16 * seq_length, backend='numpy')
+            model.set_param_values(random_param_values(
+                num_outputs, depth, 5, 8, seed=i))
+            model.compile()
+            self.models.append(model)
+
+    def tearDown(self):
+        self.visual_encoder.close_instance()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_generate_proposals_ensemble(self):
+        df = generate_proposals_ensemble(
+            self.visual_encoder, self.models, self.video_names,
+            batch_size=7, verbose=False)
+
+        # Proposals of each model, before NMS, concatenated per video
+        pool_type = self.visual_encoder.pool_type
+        proposals, score = [], []
+        for video_name in self.video_names:
+            video_proposals, video_score = [], []
+            for model in self.models:
+                self.visual_encoder.pool_type = model_pool_type(
+                    pool_type, model.seq_length)
+                f_init, receptive_field = video_windows(
+                    self.visual_encoder, video_name, model.seq_length)
+                feat = self.visual_encoder.read_feat_batch_from_video(
+                    video_name, f_init, receptive_field)
+                _, model_proposals, model_score = next(
+                    retrieve_proposals_batch(model, [(
+                        video_name, feat, f_init, receptive_field)]))
+                video_proposals.append(model_proposals.reshape((-1, 2)))
+                video_score.append(model_score.reshape(-1))
+            proposals.append(np.vstack(video_proposals))
+            score.append(np.hstack(video_score))
+        self.visual_encoder.pool_type = pool_type
+        df_ref = proposals_dataframe(self.video_names, proposals, score)
+        self.assertTrue(df_ref.equals(df))
+        self.visual_encoder.open_instance()
+
+    def test_result_cache(self):
+        model_file = os.path.join(self.tmp_dir, 'daps.npz')
+        np.savez(model_file, *random_param_values(4, 1, 5, 8))
+        kwargs = {'c3d_hdf5': self.c3d_hdf5, 'model_file': model_file,
+                  'all_videos': True, 'seq_encoder_backend': 'numpy',
+                  'seq_encoder_length': 16, 'seq_encoder_width': 5,
+                  'num_proposals_per_seq_length': 4, 'c3d_feat_dim': 8,
+                  'c3d_pool_type': 'concat-16-mean', 'batch_size': 7,
+                  'instrument_log': os.path.join(self.tmp_dir, 'log.jsonl'),
+                  'result_cache_dir': os.path.join(self.tmp_dir, 'rc')}
+        # The HDF5-file is modified below
+        self.visual_encoder.close_instance()
+        main(**kwargs)
+
+        def rerun(log_name):
+            """Proposals and videos processed by a re-run"""
+            log_file = os.path.join(self.tmp_dir, log_name)
+            df = main(**dict(kwargs, instrument_log=log_file))
+            with open(log_file) as f:
+                videos = set(json.loads(line).get('video') for line in f)
+            return df, videos - set([None])
+
+        # A new video is the only one processed by the re-run
+        with h5py.File(self.c3d_hdf5, 'a') as f:
+            f.create_group('video_3').create_dataset(
+                'c3d_features', data=np.random.RandomState(1).randn(
+                    900, 8).astype(np.float32))
+        _, videos = rerun('new_video.jsonl')
+        self.assertEqual(set(['video_3']), videos)
+
+        # Same for a video whose interior rows were edited
+        with h5py.File(self.c3d_hdf5, 'a') as f:
+            f['video_1/c3d_features'][777] += 1
+        df, videos = rerun('edited_video.jsonl')
+        self.assertEqual(set(['video_1']), videos)
+
+        kwargs.update(instrument_log=None, result_cache_dir=None)
+        df_ref = main(**kwargs)
+        self.assertTrue(df_ref.equals(df))
+        self.visual_encoder.open_instance()
@@ -0,0 +1,130 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import h5py
+import numpy as np
+
+# Scripts in tools are not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from daps.sequence_encoder import DAPs, FLOATX
+from daps.utils.lstm import random_param_values
+from daps.utils.segment import non_maxima_supression
+from daps.visual_encoder import C3D, load_pca
+from generate_proposals import sliding_windows
+from proposal_server import DynamicBatcher, ProposalService, ServerStats
+
+
+def test_server_stats():
+    stats = ServerStats()
+    report = stats.report()
+    assert report['requests'] == 0 and report['latency_p50'] is None
+    for latency, num_windows in [(0.003, 4), (0.001, 2), (0.002, 1)]:
+        stats.add_request(latency, num_windows)
+    stats.add_request(0.5, error=True)
+    stats.add_batch(2)
+    stats.add_batch(1)
+    report = stats.report()
+    assert report['requests'] == 4
+    assert report['errors'] == 1
+    assert report['windows'] == 7
+    assert report['batches'] == 2
+    assert report['requests_per_batch'] == 1.5
+    # Latency of failed requests is ignored
+    np.testing.assert_allclose(report['latency_p50'], 2.0)
+    np.testing.assert_allclose(report['latency_max'], 3.0)
+    assert report['latency_p50'] <= report['latency_p90'] <= \
+        report['latency_p99'] <= report['latency_max']
+
+
+class test_proposal_server(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.feat = rng.randn(700, 12).astype(np.float32)
+        self.c3d_hdf5 = os.path.join(self.tmp_dir, 'c3d.hdf5')
+        with h5py.File(self.c3d_hdf5, 'w') as f:
+            f.create_group('video_0').create_dataset('c3d_features',
+                                                     data=self.feat)
+        self.pca_file = os.path.join(self.tmp_dir, 'pca.hdf5')
+        with h5py.File(self.pca_file, 'w') as f:
+            f.create_dataset('U', data=rng.randn(12, 12))
+            f.create_dataset('x_mean', data=rng.randn(12))
+        self.model = DAPs(4, 16, 1, 5, 8, 256, backend='numpy')
+        self.model.set_param_values(random_param_values(4, 1, 5, 8))
+        self.model.compile()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dynamic_batcher(self):
+        f_init = [np.arange(n) * 64 for n in [3, 1, 5]]
+        rng = np.random.RandomState(1)
+        feat = [rng.randn(len(i), 16, 8).astype(FLOATX) for i in f_init]
+        # All the requests are needed to reach the batch size
+        batcher = DynamicBatcher(self.model, batch_size=9, max_latency=60)
+        results = [None] * 3
+
+        def request(i):
+            results[i] = batcher.retrieve_proposals(feat[i], f_init[i], 256)
+        threads = [threading.Thread(target=request, args=(i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batcher.close()
+        self.assertEqual(1, batcher.stats.batches)
+        self.assertEqual(3, batcher.stats.batch_requests)
+        for i in range(3):
+            proposals, score = self.model.retrieve_proposals(
+                feat[i], f_init[i], receptive_field=256)
+            np.testing.assert_array_equal(proposals, results[i][0])
+            np.testing.assert_allclose(score, results[i][1], rtol=1e-6)
+
+    def test_proposals(self):
+        visual_encoder = C3D(self.c3d_hdf5, pool_type='concat-16-mean',
+                             dtype=FLOATX, pca_file=self.pca_file, pca_dim=8)
+        visual_encoder.open_instance()
+        # Same input through the sequence encoder and NMS
+        f_init, receptive_field = sliding_windows(700, 16, 16, 64)
+        feat_stack = visual_encoder.read_feat_batch_from_video(
+            'video_0', f_init, receptive_field)
+        proposals, score = self.model.retrieve_proposals(
+            feat_stack, f_init, receptive_field=receptive_field)
+        proposals, score = non_maxima_supression(
+            proposals.reshape((-1, 2)), score.reshape(-1), 0.7)
+
+        # Raw features are projected with the PCA as the visual encoder does
+        service = ProposalService(
+            self.model, c3d_pool_type='concat-16-mean', max_latency=0,
+            pca=load_pca(self.pca_file, 8, FLOATX))
+        response = service.proposals({'features': self.feat.tolist(),
+                                      'num-proposals': 5})
+        np.testing.assert_array_equal(proposals[:5], response['proposals'])
+        np.testing.assert_allclose(score[:5], response['score'], rtol=1e-5)
+        service.close()
+
+        service = ProposalService(self.model, visual_encoder, max_latency=0)
+        response = service.proposals({'video-name': 'video_0'})
+        np.testing.assert_array_equal(proposals, response['proposals'])
+        np.testing.assert_allclose(score, response['score'], rtol=1e-5)
+        self.assertEqual('video_0', response['video-name'])
+        self.assertRaises(KeyError, service.proposals, {'video-name': 'foo'})
+        service.close()
+        visual_encoder.close_instance()
+
+    def test_reject_features(self):
+        service = ProposalService(self.model, c3d_pool_type='concat-16-mean',
+                                  max_latency=0)
+        # Raw features without PCA must fit the sequence encoder
+        self.assertRaises(ValueError, service.proposals,
+                          {'features': self.feat.tolist()})
+        service.proposals({'features': self.feat[:, :8].tolist()})
+        service.close()
+        self.assertEqual(1, service.stats.batches)
+        self.assertEqual(1, service.stats.errors)